@@ -1 +1 @@
-from .exceptions import TimeoutError, ExpirationError, TaskError, DuplicateTaskId, ConnectionError
+from .exceptions import TimeoutError, ExpirationError, TaskError, DuplicateTaskId, ConnectionError, PublishError
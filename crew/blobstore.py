@@ -0,0 +1,137 @@
+# encoding: utf-8
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from .exceptions import ExpirationError
+
+log = logging.getLogger(__name__)
+
+HEADER = 'x-claim-check'
+
+
+class BlobStore(object):
+    """ Keeps the oversized bodies out of the broker, the messages carry the keys only """
+
+    def __init__(self, threshold=1024 * 1024):
+        self.threshold = threshold
+
+    def accepts(self, data):
+        return self.threshold is not None and data is not None and len(data) >= self.threshold
+
+    def put(self, data, ttl):
+        raise NotImplementedError
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    """ Blobs in a directory shared by the clients and the workers of the host.
+
+    The modification time of a blob is its deadline, so any process may drop
+    the expired ones. Blobs are read through ``mmap``, the pages are loaded
+    when the codec gets to them.
+    """
+
+    CLEANUP_INTERVAL = 60
+
+    def __init__(self, path=None, threshold=1024 * 1024):
+        super(LocalBlobStore, self).__init__(threshold)
+        self.path = path or os.path.join(tempfile.gettempdir(), 'crew-blobs')
+        self._lock = threading.Lock()
+        self._cleaned = 0
+
+        self.stored = 0
+        self.loaded = 0
+        self.expired = 0
+
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+
+    def _filename(self, key):
+        if not key or os.path.basename(key) != key or key.startswith('.'):
+            raise ValueError('Invalid blob key {0!r}'.format(key))
+
+        return os.path.join(self.path, key)
+
+    def put(self, data, ttl):
+        self.cleanup()
+
+        key = uuid.uuid4().hex
+        filename = self._filename(key)
+        temp = os.path.join(self.path, '.' + key)
+
+        with open(temp, 'wb') as f:
+            f.write(data)
+
+        deadline = time.time() + ttl
+        os.utime(temp, (deadline, deadline))
+        # The blob appears complete or not at all
+        os.rename(temp, filename)
+
+        self.stored += 1
+        return key
+
+    def get(self, key):
+        try:
+            f = open(self._filename(key), 'rb')
+        except (IOError, OSError):
+            raise ExpirationError('Blob {0} is gone'.format(key))
+
+        with f:
+            self.loaded += 1
+            if not os.fstat(f.fileno()).st_size:
+                return b''
+
+            # The mapping outlives the descriptor
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def delete(self, key):
+        try:
+            os.unlink(self._filename(key))
+        except OSError:
+            pass
+
+    def cleanup(self, force=False):
+        now = time.time()
+
+        with self._lock:
+            if not force and now - self._cleaned < self.CLEANUP_INTERVAL:
+                return
+            self._cleaned = now
+
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+
+            try:
+                mtime = os.stat(filename).st_mtime
+                # Unfinished writes have no deadline yet, they are given some time
+                if mtime < (now - self.CLEANUP_INTERVAL if name.startswith('.') else now):
+                    os.unlink(filename)
+                    self.expired += 1
+            except OSError:
+                continue
+
+    @property
+    def stats(self):
+        return {
+            'threshold': self.threshold,
+            'stored': self.stored,
+            'loaded': self.loaded,
+            'expired': self.expired,
+        }
+
+
+__all__ = ("BlobStore", "LocalBlobStore", "HEADER")
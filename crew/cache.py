@@ -0,0 +1,92 @@
+# encoding: utf-8
+import hashlib
+import mmap
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRU(object):
+    """ Bounded mapping dropping the least recently used and the expired entries """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        assert isinstance(maxsize, int) and maxsize > 0
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key(*parts):
+        digest = hashlib.sha1()
+        for part in parts:
+            if not isinstance(part, (bytes, bytearray, memoryview, mmap.mmap)):
+                part = str(part).encode('utf-8')
+            digest.update(part)
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, default=None, count=True):
+        with self._lock:
+            item = self._data.pop(key, None)
+
+            if item is not None and item[0] is not None and item[0] < time.time():
+                self.expirations += 1
+                item = None
+
+            if item is None:
+                if count:
+                    self.misses += 1
+                return default
+
+            self._data[key] = item
+            if count:
+                self.hits += 1
+
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl if ttl else None, value)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    @property
+    def stats(self):
+        requests = self.hits + self.misses
+
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / requests if requests else 0.,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+__all__ = ("LRU",)
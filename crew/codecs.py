@@ -0,0 +1,319 @@
+# encoding: utf-8
+import bz2
+import json
+import marshal
+import struct
+import sys
+import warnings
+import zlib
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+if sys.version_info >= (3,):
+    import pickle
+else:
+    import cPickle as pickle
+
+
+class Codec(object):
+    content_type = None
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class PickleCodec(Codec):
+    content_type = 'application/python-pickle'
+
+    def __init__(self, protocol=2):
+        self.protocol = protocol
+
+    def encode(self, obj):
+        return pickle.dumps(obj, protocol=self.protocol)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class JSONCodec(Codec):
+    content_type = 'application/json'
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(bytes(data).decode('utf-8'))
+
+
+class TextCodec(Codec):
+    content_type = 'text/plain'
+
+    def encode(self, obj):
+        return str(obj).encode('utf-8')
+
+    def decode(self, data):
+        return bytes(data).decode('utf-8')
+
+
+class MarshalCodec(Codec):
+    """ Fast but unsafe, use it only between trusted peers of the same Python version """
+
+    content_type = 'application/python-marshal'
+
+    def __init__(self, version=marshal.version):
+        self.version = version
+
+    def encode(self, obj):
+        return marshal.dumps(obj, self.version)
+
+    def decode(self, data):
+        return marshal.loads(bytes(data))
+
+
+class BinaryCodec(Codec):
+    """ Passes bytes-like bodies through untouched """
+
+    content_type = 'application/octet-stream'
+
+    def encode(self, obj):
+        if not isinstance(obj, (bytes, bytearray, memoryview)):
+            raise TypeError('Binary body must be bytes-like, not {0}'.format(type(obj).__name__))
+
+        return obj
+
+    def decode(self, data):
+        return data
+
+
+class Pickle5Codec(Codec):
+    """ Pickle protocol 5 with the out-of-band buffers carried as separate frames.
+
+    The body is the number of frames, their lengths and the frames. The
+    first frame is the pickle stream, the rest are the buffers, which are
+    restored as views of the body without copying.
+    """
+
+    content_type = 'application/python-pickle5'
+
+    COUNT = struct.Struct('!I')
+    LENGTH = struct.Struct('!Q')
+
+    def encode(self, obj):
+        buffers = []
+        frames = [pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)]
+        frames.extend(buffer.raw() for buffer in buffers)
+
+        header = [self.COUNT.pack(len(frames))]
+        header.extend(self.LENGTH.pack(frame.nbytes if isinstance(frame, memoryview) else len(frame))
+                      for frame in frames)
+
+        return b''.join(header + frames)
+
+    def decode(self, data):
+        view = memoryview(data)
+        count, = self.COUNT.unpack_from(view)
+        offset = self.COUNT.size + self.LENGTH.size * count
+
+        frames = []
+        for index in range(count):
+            length, = self.LENGTH.unpack_from(view, self.COUNT.size + self.LENGTH.size * index)
+            frames.append(view[offset:offset + length])
+            offset += length
+
+        return pickle.loads(frames[0], buffers=frames[1:])
+
+
+class Compressor(object):
+    name = None
+    encoding = None
+
+    def compress(self, data, level=None):
+        raise NotImplementedError
+
+    def decompress(self, data):
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+    name = 'zlib'
+    # Historical name of the zlib encoding
+    encoding = 'gzip'
+    level = 6
+
+    def compress(self, data, level=None):
+        return zlib.compress(data, self.level if level is None else level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LzmaCompressor(Compressor):
+    name = 'lzma'
+    encoding = 'lzma'
+    level = 6
+
+    def compress(self, data, level=None):
+        return lzma.compress(data, preset=self.level if level is None else level)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+class Bz2Compressor(Compressor):
+    name = 'bz2'
+    encoding = 'bz2'
+    level = 9
+
+    def compress(self, data, level=None):
+        return bz2.compress(data, self.level if level is None else level)
+
+    def decompress(self, data):
+        return bz2.decompress(data)
+
+
+class Serializer(object):
+    """ Codec and optional compressor resolved for one content type and encoding """
+
+    __slots__ = ('codec', 'compressor')
+
+    def __init__(self, codec, compressor=None):
+        self.codec = codec
+        self.compressor = compressor
+
+    @property
+    def content_type(self):
+        return self.codec.content_type
+
+    @property
+    def content_encoding(self):
+        return self.compressor.encoding if self.compressor else 'plain'
+
+    def dumps(self, obj):
+        data = self.codec.encode(obj)
+        return self.compressor.compress(data) if self.compressor else data
+
+    def loads(self, data):
+        if self.compressor:
+            data = self.compressor.decompress(data)
+        return self.codec.decode(data)
+
+
+class Registry(object):
+    DEFAULT_CONTENT_TYPE = TextCodec.content_type
+
+    def __init__(self):
+        self._names = {}
+        self._types = {}
+        self._compressors = {}
+        self._algorithms = {}
+        self._serializers = {}
+
+    def register(self, name, codec):
+        assert isinstance(codec, Codec) and codec.content_type
+        self._names[name] = codec
+        self._types[codec.content_type] = codec
+        self._serializers.clear()
+
+    def register_compressor(self, compressor):
+        assert isinstance(compressor, Compressor) and compressor.encoding
+        self._compressors[compressor.encoding] = compressor
+        self._algorithms[compressor.name or compressor.encoding] = compressor
+        self._serializers.clear()
+
+    def get(self, name, encoding='plain'):
+        if name not in self._names:
+            raise LookupError('Unknown serializer "{0}"'.format(name))
+
+        return self.resolve(self._names[name].content_type, encoding)
+
+    def compressor(self, encoding):
+        """ Compressor by the content encoding or by the algorithm name """
+        compressor = self._compressors.get(encoding) or self._algorithms.get(encoding)
+
+        if compressor is None:
+            raise LookupError('Unknown content encoding "{0}"'.format(encoding))
+
+        return compressor
+
+    def resolve(self, content_type, encoding='plain'):
+        key = (content_type, encoding)
+        serializer = self._serializers.get(key)
+
+        if serializer is None:
+            codec = self._types.get((content_type or '').split(';')[0].strip())
+            compressor = self._compressors.get(encoding)
+
+            if codec is None:
+                # Unknown types are treated as text, like it always was
+                return Serializer(self._types[self.DEFAULT_CONTENT_TYPE], compressor)
+
+            serializer = self._serializers[key] = Serializer(codec, compressor)
+
+        return serializer
+
+
+class ContentTypes(Mapping):
+    """ Read-only view of the content types of the registered codecs by their names """
+
+    def __init__(self, registry):
+        self._registry = registry
+
+    def __getitem__(self, name):
+        return self._registry._names[name].content_type
+
+    def __iter__(self):
+        return iter(self._registry._names)
+
+    def __len__(self):
+        return len(self._registry._names)
+
+
+registry = Registry()
+# The former SERIALIZERS attribute of the clients
+content_types = ContentTypes(registry)
+register = registry.register
+register_compressor = registry.register_compressor
+resolve = registry.resolve
+get = registry.get
+
+
+def get_serializer(name):
+    """ The encoding function and the content type of the codec, like the former get_serializer of the clients """
+    warnings.warn('get_serializer() is deprecated, use crew.codecs.get()', DeprecationWarning, stacklevel=2)
+    serializer = get(name)
+    return serializer.dumps, serializer.content_type
+
+
+register('pickle', PickleCodec())
+register('json', JSONCodec())
+register('text', TextCodec())
+register('marshal', MarshalCodec())
+register('binary', BinaryCodec())
+
+if pickle.HIGHEST_PROTOCOL >= 5:
+    register('pickle5', Pickle5Codec())
+
+register_compressor(ZlibCompressor())
+register_compressor(Bz2Compressor())
+
+if lzma is not None:
+    register_compressor(LzmaCompressor())
+
+
+__all__ = (
+    "Codec", "PickleCodec", "JSONCodec", "TextCodec", "MarshalCodec", "BinaryCodec", "Pickle5Codec",
+    "Compressor", "ZlibCompressor", "LzmaCompressor", "Bz2Compressor", "Serializer", "Registry",
+    "ContentTypes", "registry", "content_types", "register", "register_compressor", "resolve", "get",
+    "get_serializer",
+)
@@ -0,0 +1,94 @@
+# encoding: utf-8
+import threading
+import time
+
+from . import codecs
+
+
+class CompressionPolicy(object):
+    """ Decides whether a body is worth compressing.
+
+    Bodies shorter than ``threshold`` are sent as is. The ratio of the
+    compressed to the original size is tracked as a moving average, and
+    while it stays above ``min_ratio`` only every ``sample_every``-th body
+    is compressed to check whether the payloads became compressible again.
+    A ``force`` policy compresses every body above the threshold, even when
+    it doesn't shrink.
+    """
+
+    SMOOTHING = 0.25
+
+    def __init__(self, algorithm='zlib', level=None, threshold=32 * 1024, min_ratio=0.9, sample_every=16,
+                 force=False):
+        assert threshold >= 0
+        assert sample_every > 0
+        self.compressor = codecs.registry.compressor(algorithm)
+        self.level = level
+        self.threshold = threshold
+        self.min_ratio = min_ratio
+        self.sample_every = sample_every
+        self.force = force
+        self.ratio = None
+        self._lock = threading.Lock()
+
+        self.compressed = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.
+        self._eligible = 0
+
+    @property
+    def encoding(self):
+        return self.compressor.encoding
+
+    def paying_off(self):
+        return self.ratio is None or self.ratio <= self.min_ratio
+
+    def compress(self, data):
+        """ Returns the body to send and its content encoding """
+        if data is None or len(data) < self.threshold:
+            return data, 'plain'
+
+        with self._lock:
+            self._eligible += 1
+            if not self.force and not self.paying_off() and self._eligible % self.sample_every:
+                self.skipped += 1
+                return data, 'plain'
+
+        start = time.time()
+        compressed = self.compressor.compress(data, self.level)
+        elapsed = time.time() - start
+        ratio = float(len(compressed)) / len(data)
+
+        with self._lock:
+            self.ratio = ratio if self.ratio is None else (
+                self.SMOOTHING * ratio + (1 - self.SMOOTHING) * self.ratio
+            )
+            self.cpu_time += elapsed
+
+            if len(compressed) >= len(data) and not self.force:
+                self.skipped += 1
+                return data, 'plain'
+
+            self.compressed += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(compressed)
+
+        return compressed, self.compressor.encoding
+
+    @property
+    def stats(self):
+        return {
+            'algorithm': self.compressor.name,
+            'compressed': self.compressed,
+            'skipped': self.skipped,
+            'ratio': self.ratio,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'bytes_saved': self.bytes_in - self.bytes_out,
+            'cpu_time': self.cpu_time,
+        }
+
+
+__all__ = ("CompressionPolicy",)
@@ -9,6 +9,10 @@ class ConnectionError(Exception):
     pass
 
 
+class PublishError(ConnectionError):
+    pass
+
+
 class TimeoutError(TaskError):
     pass
 
@@ -0,0 +1,354 @@
+# encoding: utf-8
+import asyncio
+import logging
+import time
+from collections import deque
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.credentials import ExternalCredentials, PlainCredentials
+from shortuuid import uuid
+
+from .multitask import MultitaskCall
+from ... import ExpirationError, DuplicateTaskId, ConnectionError, codecs, blobstore
+from ...compression import CompressionPolicy
+
+log = logging.getLogger(__name__)
+
+
+class Client(object):
+    """ Client running on the asyncio event loop.
+
+    The futures are resolved right in the consumer callbacks, which are
+    called by the loop the connection is running on.
+    """
+
+    RECONNECT_TIMEOUT = 5
+
+    def __init__(self, host='localhost', port=5672, virtualhost='/', credentials=None, loop=None,
+                 compression=None, blob_store=None):
+        if credentials is not None:
+            assert isinstance(credentials, (PlainCredentials, ExternalCredentials))
+
+        self.parameters = pika.ConnectionParameters(
+            host=host,
+            port=port,
+            credentials=credentials,
+            virtual_host=virtualhost,
+        )
+
+        client_uid = uuid()
+        self.loop = loop or asyncio.get_event_loop()
+        self._res_queue = "crew.master.%s" % client_uid
+        self._pubsub_queue = "crew.subscribe.%s" % client_uid
+        self.callbacks_hash = {}
+        self._subscribe_cache = {}
+        self._consumers = {}
+        self._outbox = deque()
+        self.compression = compression or CompressionPolicy()
+        self._compression = {}
+        self.blob_store = blob_store
+
+        self.connection = None
+        self.channel = None
+        self._closing = False
+
+    def _callback(self):
+        future = self.loop.create_future()
+
+        def callback(result=None, *args):
+            if not future.done():
+                future.set_result(result)
+
+        return future, callback
+
+    @property
+    def is_connected(self):
+        return self.channel is not None and self.channel.is_open
+
+    async def connect(self):
+        opened, callback = self._callback()
+
+        def on_open_error(*args):
+            if not opened.done():
+                opened.set_exception(ConnectionError(*args))
+
+        self.connection = AsyncioConnection(
+            self.parameters,
+            on_open_callback=callback,
+            on_open_error_callback=on_open_error,
+            on_close_callback=self._on_close,
+            custom_ioloop=self.loop,
+        )
+        await opened
+
+        future, callback = self._callback()
+        self.connection.channel(on_open_callback=callback)
+        channel = await future
+
+        for exchange in ("crew.PUBSUB", "crew.DLX"):
+            future, callback = self._callback()
+            channel.exchange_declare(callback, exchange=exchange, exchange_type="headers", auto_delete=True)
+            await future
+
+        for queue, arguments in (
+            ("crew.DLX", dict(auto_delete=False)),
+            (self._res_queue, dict(exclusive=True, auto_delete=True, arguments={"x-message-ttl": 60000})),
+            (self._pubsub_queue, dict(exclusive=True, auto_delete=True, arguments={"x-message-ttl": 60000})),
+        ):
+            future, callback = self._callback()
+            channel.queue_declare(callback, queue=queue, **arguments)
+            await future
+
+        future, callback = self._callback()
+        channel.queue_bind(callback, "crew.DLX", "crew.DLX", arguments={"x-original-sender": self._res_queue})
+        await future
+
+        for name in self._subscribe_cache:
+            future, callback = self._callback()
+            channel.queue_bind(
+                callback, self._pubsub_queue, exchange="crew.PUBSUB", arguments={"x-channel-name": name}
+            )
+            await future
+
+        channel.basic_consume(self._on_dlx_received, queue="crew.DLX")
+        channel.basic_consume(self._on_subscribed_message, queue=self._pubsub_queue)
+        channel.basic_consume(self._on_result, queue=self._res_queue)
+
+        for queue, callback in self._consumers.items():
+            channel.basic_consume(self._custom_consumer(callback), queue=queue)
+
+        self.channel = channel
+        self._flush()
+
+    def _on_close(self, connection, code, reason):
+        self.channel = None
+
+        if self._closing:
+            return
+
+        log.error('Connection closed: (%s) %s, reconnecting', code, reason)
+        self.loop.call_later(self.RECONNECT_TIMEOUT, lambda: self.loop.create_task(self._reconnect()))
+
+    async def _reconnect(self):
+        try:
+            await self.connect()
+        except Exception as e:
+            log.error('Reconnection failed: %r', e)
+            self._on_close(None, None, e)
+
+    def _publish(self, **kwargs):
+        if self.is_connected:
+            self.channel.basic_publish(**kwargs)
+        else:
+            # Sent in order once the channel is open
+            self._outbox.append(kwargs)
+
+    def _flush(self):
+        while self._outbox and self.is_connected:
+            self.channel.basic_publish(**self._outbox.popleft())
+
+    def set_compression(self, channel, policy):
+        """ Compression policy of the requests sent to the channel """
+        self._compression[channel] = policy
+
+    def get_compression(self, channel):
+        return self._compression.get(channel, self.compression)
+
+    def parse_body(self, body, props):
+        serializer = codecs.resolve(getattr(props, 'content_type', None), props.content_encoding or 'plain')
+        key = (props.headers or {}).get(blobstore.HEADER)
+
+        if key is None:
+            return serializer.loads(body)
+
+        if self.blob_store is None:
+            raise LookupError('Result is stored in the blob {0}, but the blob store is not configured'.format(key))
+
+        try:
+            return serializer.loads(self.blob_store.get(key))
+        finally:
+            self.blob_store.delete(key)
+
+    def _resolve(self, cb, body, headers):
+        if isinstance(cb, asyncio.Future):
+            if cb.done():
+                return
+            if isinstance(body, Exception):
+                cb.set_exception(body)
+            else:
+                cb.set_result(body)
+        else:
+            cb(body, headers=headers)
+
+    def _on_result(self, channel, method, props, body):
+        log.debug('Result message received, tag #%i len %d', method.delivery_tag, len(body))
+
+        try:
+            cb = self.callbacks_hash.pop(getattr(props, 'correlation_id', None), None)
+            if cb is None:
+                log.info('Got result for task "%s", but no has callback', props.correlation_id)
+                return
+
+            try:
+                body = self.parse_body(body, props)
+            except Exception as e:
+                log.exception(e)
+                body = e
+
+            self._resolve(cb, body, props.headers)
+        finally:
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def _on_dlx_received(self, channel, method, props, body):
+        try:
+            cb = self.callbacks_hash.pop(getattr(props, 'correlation_id', None), None)
+            if cb is None:
+                log.error("Method callback %s is not found", props.correlation_id)
+                return
+
+            dl = props.headers['x-death'][0]
+            body = ExpirationError("Dead letter received. Reason: {0}".format(dl.get('reason')))
+            body.reason = dl.get('reason')
+            body.time = dl.get('time')
+            body.expiration = int(dl.get('original-expiration')) / 1000
+
+            self._resolve(cb, body, props.headers)
+        finally:
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def call(self, channel, data=None, callback=None, serializer='pickle', headers=None, persistent=True, priority=0,
+             expiration=86400, timestamp=None, gzip=None, gzip_level=6, set_cid=None, routing_key=None, exchange=''):
+
+        headers = dict(headers or {})
+
+        assert priority <= 255
+        assert isinstance(expiration, int) and expiration > 0
+
+        qname = "crew.tasks.%s" % channel
+        serializer = codecs.get(serializer)
+
+        if set_cid:
+            cid = str(set_cid)
+            if cid in self.callbacks_hash:
+                raise DuplicateTaskId('Task ID: {0} already exists'.format(cid))
+        else:
+            cid = "{0}.{1}".format(channel, uuid())
+
+        data = serializer.dumps(data)
+
+        if gzip is None:
+            data, encoding = self.get_compression(channel).compress(data)
+        elif gzip:
+            data, encoding = codecs.registry.compressor('gzip').compress(data, gzip_level), 'gzip'
+        else:
+            encoding = 'plain'
+
+        if self.blob_store is not None and self.blob_store.accepts(data):
+            headers[blobstore.HEADER] = self.blob_store.put(data, expiration)
+            data = b''
+
+        headers["x-original-sender"] = self._res_queue
+
+        props = pika.BasicProperties(
+            content_encoding=encoding,
+            content_type=serializer.content_type,
+            reply_to=self._res_queue if not routing_key else routing_key,
+            correlation_id=cid,
+            headers=headers,
+            timestamp=int(timestamp or time.time()),
+            delivery_mode=2 if persistent else None,
+            priority=priority,
+            expiration="%d" % (expiration * 1000),
+        )
+
+        if callback is None:
+            callback = self.loop.create_future()
+
+        self.callbacks_hash[cid] = callback
+        self._publish(exchange=exchange, routing_key=qname, properties=props, body=data)
+
+        if isinstance(callback, asyncio.Future):
+            return callback
+
+        return cid
+
+    def _on_subscribed_message(self, channel, method, props, body):
+        try:
+            key = (props.headers or {}).get('x-channel-name')
+            cb = self._subscribe_cache.get(key)
+            if cb is None:
+                log.error("[PubSub] Method callback %s is not found", key)
+                return
+
+            body = self.parse_body(body, props)
+        finally:
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+
+        result = cb(body)
+        if asyncio.iscoroutine(result):
+            self.loop.create_task(result)
+
+    def subscribe(self, channel, callback):
+        self._subscribe_cache[channel] = callback
+
+        if self.is_connected:
+            self.channel.queue_bind(
+                None, self._pubsub_queue, exchange="crew.PUBSUB", arguments={"x-channel-name": channel}
+            )
+
+    def unsubscribe(self, channel):
+        self._subscribe_cache.pop(channel, None)
+
+        if self.is_connected:
+            self.channel.queue_unbind(
+                queue=self._pubsub_queue, exchange="crew.PUBSUB", arguments={"x-channel-name": channel}
+            )
+
+    def publish(self, channel, message, serializer='pickle'):
+        serializer = codecs.get(serializer)
+
+        self._publish(
+            exchange='crew.PUBSUB',
+            routing_key='',
+            body=serializer.dumps(message),
+            properties=pika.BasicProperties(
+                content_type=serializer.content_type, delivery_mode=1,
+                headers={"x-channel-name": channel}
+            )
+        )
+
+    def _custom_consumer(self, callback):
+        def consumer(channel, method, props, body):
+            try:
+                body = self.parse_body(body, props)
+                result = callback(body, headers=props.headers)
+                if asyncio.iscoroutine(result):
+                    self.loop.create_task(result)
+            finally:
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+
+        return consumer
+
+    def consume(self, queue, callback):
+        self._consumers[queue] = callback
+
+        if self.is_connected:
+            self.channel.basic_consume(self._custom_consumer(callback), queue=queue)
+
+    def parallel(self):
+        return MultitaskCall(self)
+
+    async def close(self):
+        self._closing = True
+
+        if self.connection is None or self.connection.is_closed:
+            return
+
+        closed, callback = self._callback()
+        self.connection.add_on_close_callback(callback)
+        self.connection.close()
+        await closed
+
+
+__all__ = ("Client",)
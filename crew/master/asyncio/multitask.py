@@ -0,0 +1,23 @@
+# encoding: utf-8
+import asyncio
+
+
+class MultitaskCall(object):
+    def __init__(self, client):
+        self.__futures = list()
+        self.client = client
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def call(self, channel, **kwargs):
+        assert 'callback' not in kwargs
+        self.__futures.append(self.client.call(channel, **kwargs))
+
+    def result(self):
+        # Errors are returned in place of the results, like the replies of the failed tasks
+        futures, self.__futures = self.__futures, []
+        return asyncio.gather(*futures, return_exceptions=True)
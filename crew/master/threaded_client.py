@@ -1,22 +1,26 @@
 #!/usr/bin/env python
 # encoding: utf-8
+import itertools
 import logging
-import json
-import zlib
-import time
 import sys
+import threading
+import time
 import pika
+from collections import deque
 from pika.adapters.blocking_connection import BlockingConnection
 from pika import ConnectionParameters, PlainCredentials
-from functools import wraps
+from functools import partial, wraps
 from shortuuid import uuid
-from crew import ExpirationError, DuplicateTaskId, TimeoutError
+from crew import ExpirationError, DuplicateTaskId, TimeoutError, codecs, blobstore
+from crew.cache import LRU
+from crew.compression import CompressionPolicy
+from crew.timer import Timer
 from threading import Thread
 
 if sys.version_info >= (3,):
-    import pickle
+    from queue import Queue, Empty
 else:
-    import cPickle as pickle
+    from Queue import Queue, Empty
 
 
 log = logging.getLogger("crew.client.blocking")
@@ -25,9 +29,15 @@ log = logging.getLogger("crew.client.blocking")
 def close_result(func):
     @wraps(func)
     def wrap(self, *args, **kwargs):
-        assert not self._closed, "Result already closed"
-        res = func(self, *args, **kwargs)
-        self._closed = True
+        with self._lock:
+            assert not self._closed, "Result already closed"
+            res = func(self, *args, **kwargs)
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            self._run_callback(callback)
+
         return res
     return wrap
 
@@ -35,28 +45,46 @@ def close_result(func):
 class Result(object):
 
     def __init__(self):
-        self.__oid = object()
-        self._closed = False
-        self.result = self.__oid
+        self.result = None
         self.headers = {}
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def _closed(self):
+        return self._event.is_set()
+
+    def done(self):
+        return self._closed
 
     @close_result
     def set_result(self, result, headers=None):
         self.result = result
         self.headers = headers or {}
-        self._closed = True
 
     @close_result
     def set_exception(self, exc):
         self.result = exc
 
+    def add_done_callback(self, callback):
+        """ Calls ``callback(result)`` when it's set, immediately if it's set already """
+        with self._lock:
+            if not self._closed:
+                self._callbacks.append(callback)
+                return
+
+        self._run_callback(callback)
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception as e:
+            log.exception(e)
+
     def wait(self, timeout=60):
-        start = time.time()
-        while not self._closed:
-            if (start + timeout) < time.time():
-                raise TimeoutError("Waiting timeout")
-            else:
-                time.sleep(0.0001)
+        if not self._event.wait(timeout):
+            raise TimeoutError("Waiting timeout")
 
         if isinstance(self.result, Exception):
             raise self.result
@@ -64,91 +92,250 @@ class Result(object):
             return self.result
 
 
-class Client(object):
-    SERIALIZERS = {
-        'json': 'application/json',
-        'pickle': 'application/python-pickle',
-        'text': 'text/plain',
-    }
+def wait_all(results, timeout=None):
+    """ Blocks until all the results are set or the timeout is over, returns the done and the pending ones """
+    results = list(results)
+    remaining = [len(results)]
+    lock, event = threading.Lock(), threading.Event()
 
-    _CHNUM = 1
+    def on_done(result):
+        with lock:
+            remaining[0] -= 1
+            if not remaining[0]:
+                event.set()
 
-    def __init__(self, host='127.0.0.1', port=5672, user=None, password=None, vhost='/'):
-        if user:
-            credentials = PlainCredentials(username=user, password=password)
-        else:
-            credentials = None
+    if results:
+        for result in results:
+            result.add_done_callback(on_done)
 
-        self.__conn_params = ConnectionParameters(
-            host=host,
-            port=port,
-            virtual_host=vhost,
-            credentials=credentials
-        )
+        event.wait(timeout)
 
-        self.callbacks_hash = {}
-        self._res_queue = "crew.master.%s" % uuid()
-        self.__active = True
-        self._connect()
+    done = [result for result in results if result.done()]
+    pending = [result for result in results if not result.done()]
+    return done, pending
+
+
+def as_completed(results, timeout=None):
+    """ Yields the results in the order they are set, raises TimeoutError when the timeout is over """
+    results = list(results)
+    deadline = None if timeout is None else time.time() + timeout
+    completed = Queue()
+
+    for result in results:
+        result.add_done_callback(completed.put)
+
+    for _ in range(len(results)):
+        try:
+            yield completed.get(timeout=None if deadline is None else max(deadline - time.time(), 0))
+        except Empty:
+            raise TimeoutError("Waiting timeout")
 
-    def parse_body(self, body, props):
-        content_type = getattr(props, 'content_type', 'text/plain')
 
-        if props.content_encoding == 'gzip':
-            body = zlib.decompress(body)
+class Connection(object):
+    """ Connection of the pool with its own I/O thread and reply queue.
 
-        if 'application/json' in content_type:
-            return json.loads(body)
-        elif 'application/python-pickle' in content_type:
-            return pickle.loads(body)
+    Only the I/O thread touches the pika connection, the other threads append
+    the messages to the lock-free outbox and wake it up.
+    """
+
+    RECONNECT_TIMEOUT = 5
+
+    def __init__(self, client, parameters):
+        self.client = client
+        self.parameters = parameters
+        self.res_queue = "crew.master.%s" % uuid()
+        self.connection = None
+        self.channel = None
+        self.published = 0
+
+        self._outbox = deque()
+        self._active = True
+        self._stopped = threading.Event()
+        self._connect()
+
+        self.thread = Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
 
     def _connect(self):
         log.debug(
             "Starting new connection to amqp://%s:%d/%s",
-            self.__conn_params.host,
-            self.__conn_params.port,
-            self.__conn_params.virtual_host
+            self.parameters.host,
+            self.parameters.port,
+            self.parameters.virtual_host
         )
 
-        self.connection = BlockingConnection(self.__conn_params)
-        self._CHNUM += 1
-
-        log.debug("Opening channel %d", self._CHNUM)
-        self.channel = self.connection.channel(self._CHNUM)
+        self.connection = BlockingConnection(self.parameters)
+        self.channel = self.connection.channel()
 
         self.channel.exchange_declare("crew.DLX", auto_delete=True, exchange_type="headers")
 
         self.channel.queue_declare(queue="crew.DLX", auto_delete=False)
         self.channel.queue_declare(
-            queue=self._res_queue, exclusive=True, durable=False,
+            queue=self.res_queue, exclusive=True, durable=False,
             auto_delete=True, arguments={"x-message-ttl": 60000}
         )
 
         self.channel.basic_qos(prefetch_count=1)
 
-        self.channel.queue_bind("crew.DLX", "crew.DLX", arguments={"x-original-sender": self._res_queue})
+        self.channel.queue_bind("crew.DLX", "crew.DLX", arguments={"x-original-sender": self.res_queue})
+
+        self.channel.basic_consume(self.client._on_dlx_received, queue="crew.DLX")
+        self.channel.basic_consume(self.client._on_result, queue=self.res_queue)
+
+    def publish(self, **kwargs):
+        self._outbox.append(kwargs)
+
+        try:
+            self.connection.add_callback_threadsafe(self._flush)
+        except Exception as e:
+            # The I/O thread flushes the outbox once it's connected again
+            log.debug('Publishing deferred: %r', e)
+
+    def _flush(self):
+        while self._outbox:
+            self.channel.basic_publish(**self._outbox[0])
+            self._outbox.popleft()
+            self.published += 1
+
+    def _loop(self):
+        while self._active:
+            try:
+                self._flush()
+                # Woken up by the publishers, the deferred messages wait a second at most
+                self.connection.process_data_events(time_limit=1)
+            except:
+                while self._active:
+                    try:
+                        self._connect()
+                        break
+                    except:
+                        # Closing the client interrupts the pause
+                        self._stopped.wait(self.RECONNECT_TIMEOUT)
+
+        try:
+            self.channel.close()
+            self.connection.close()
+        except Exception as e:
+            log.debug('Closing connection failed: %r', e)
+
+    @property
+    def stats(self):
+        return {
+            'queue': self.res_queue,
+            'published': self.published,
+            'outbox': len(self._outbox),
+        }
+
+    def close(self):
+        self._active = False
+        self._stopped.set()
+
+        try:
+            self.connection.add_callback_threadsafe(lambda: None)
+        except Exception:
+            pass
+
+
+class Client(object):
+    """ Thread-safe client, the calls are spread over a pool of ``pool_size`` connections """
+
+    # Time given to the dead letter of the expired call to arrive
+    EXPIRATION_GRACE = 1
+
+    # Deprecated aliases of the codec registry
+    SERIALIZERS = codecs.content_types
+    get_serializer = staticmethod(codecs.get_serializer)
+
+    def __init__(self, host='127.0.0.1', port=5672, user=None, password=None, vhost='/', compression=None,
+                 blob_store=None, cache=None, pool_size=1):
+        if user:
+            credentials = PlainCredentials(username=user, password=password)
+        else:
+            credentials = None
+
+        self.__conn_params = ConnectionParameters(
+            host=host,
+            port=port,
+            virtual_host=vhost,
+            credentials=credentials
+        )
+
+        self.callbacks_hash = {}
+        self.compression = compression or CompressionPolicy()
+        self._compression = {}
+        self.blob_store = blob_store
+        self.cache = cache
+        self._cache_ttl = {}
+        self._cache_keys = {}
+        self.connections = [Connection(self, self.__conn_params) for _ in range(pool_size)]
+        self._next = itertools.count()
+        self._timer = Timer()
+
+    def set_compression(self, channel, policy):
+        """ Compression policy of the requests sent to the channel """
+        self._compression[channel] = policy
+
+    def get_compression(self, channel):
+        return self._compression.get(channel, self.compression)
+
+    @property
+    def cache_stats(self):
+        return self.cache.stats if self.cache is not None else None
+
+    @property
+    def compression_stats(self):
+        stats = dict((channel, policy.stats) for channel, policy in self._compression.items())
+        stats[None] = self.compression.stats
+        return stats
+
+    def set_cache_ttl(self, channel, ttl):
+        """ Replies of the channel are cached for ``ttl`` seconds, the x-cache-ttl reply header overrides it """
+        if ttl:
+            self._cache_ttl[channel] = ttl
+        else:
+            self._cache_ttl.pop(channel, None)
+
+    def _remember(self, cid, body, props, result):
+        entry = self._cache_keys.pop(cid, None)
+        if entry is None or isinstance(result, Exception):
+            return
 
-        self.channel.basic_consume(self._on_dlx_received, queue="crew.DLX")
-        self.channel.basic_consume(self._on_result, queue=self._res_queue)
+        channel, key = entry
+        headers = props.headers or {}
+        ttl = headers.get('x-cache-ttl', self._cache_ttl.get(channel))
 
-        self.__connected = True
-        t = Thread(target=self._consumer)
-        t.daemon = True
-        t.start()
+        # The blobs are removed once they are read
+        if ttl and blobstore.HEADER not in headers:
+            self.cache.set(key, (body, props), ttl=ttl)
 
-        while not self.__connected:
-            time.sleep(0.0001)
+    def parse_body(self, body, props):
+        serializer = codecs.resolve(getattr(props, 'content_type', None), props.content_encoding or 'plain')
+        key = (props.headers or {}).get(blobstore.HEADER)
+
+        if key is None:
+            return serializer.loads(body)
+
+        if self.blob_store is None:
+            raise LookupError('Result is stored in the blob {0}, but the blob store is not configured'.format(key))
+
+        try:
+            return serializer.loads(self.blob_store.get(key))
+        finally:
+            self.blob_store.delete(key)
 
     def _on_result(self, channel, method, props, body):
         log.debug('PikaCient: Result message received, tag #%i len %d', method.delivery_tag, len(body))
         correlation_id = getattr(props, 'correlation_id', None)
 
         try:
-            if correlation_id not in self.callbacks_hash:
-                log.info('Got result for task "%d", but no has callback', correlation_id)
+            # The deadline timer may take the callback away concurrently
+            cb = self.callbacks_hash.pop(correlation_id, None)
+            if cb is None:
+                log.info('Got result for task "%s", but no has callback', correlation_id)
             else:
-                cb = self.callbacks_hash.pop(correlation_id)
-                body = self.parse_body(body, props)
+                raw, body = body, self.parse_body(body, props)
+                self._remember(correlation_id, raw, props, body)
                 if isinstance(body, Exception):
                     cb.set_exception(body)
                 else:
@@ -161,10 +348,11 @@ class Client(object):
 
     def _on_dlx_received(self, channel, method, props, body):
         correlation_id = getattr(props, 'correlation_id', None)
+        self._cache_keys.pop(correlation_id, None)
 
-        if correlation_id in self.callbacks_hash:
-            cb = self.callbacks_hash.pop(correlation_id)
+        cb = self.callbacks_hash.pop(correlation_id, None)
 
+        if cb is not None:
             try:
                 dl = props.headers['x-death'][0]
                 body = ExpirationError(
@@ -183,22 +371,29 @@ class Client(object):
             channel.basic_ack(delivery_tag=method.delivery_tag)
             return
 
-    def _consumer(self):
-        while self.__active:
-            try:
-                self.channel.start_consuming()
-            except:
-                self.__connected = False
-                while not self.__connected:
-                    try:
-                        self._connect()
-                    except:
-                        time.sleep(5)
+    def _expire(self, cid, result):
+        if self.callbacks_hash.get(cid) is not result:
+            return
+
+        if self.callbacks_hash.pop(cid, None) is None:
+            # Answered in the meantime
+            return
+
+        self._cache_keys.pop(cid, None)
+        result.set_exception(TimeoutError('Reply for "{0}" was not received in time'.format(cid)))
+
+    @property
+    def stats(self):
+        return {
+            'connections': [connection.stats for connection in self.connections],
+            'pending': len(self.callbacks_hash),
+        }
 
     def close(self):
-        self.__active = False
-        self.channel.close()
-        self.connection.close()
+        self._timer.close()
+
+        for connection in self.connections:
+            connection.close()
 
     def call(self, channel, data=None, serializer='pickle',
              headers=None, persistent=True, priority=0, expiration=86400,
@@ -211,7 +406,7 @@ class Client(object):
 
         qname = "crew.tasks.%s" % channel
 
-        serializer, content_type = self.get_serializer(serializer)
+        serializer = codecs.get(serializer)
 
         if set_cid:
             cid = str(set_cid)
@@ -221,19 +416,37 @@ class Client(object):
         else:
             cid = "{0}.{1}".format(channel, uuid())
 
-        data = serializer(data)
+        data = serializer.dumps(data)
 
-        if gzip is None and data is not None and len(data) > 1024 * 32:
-            gzip = True
+        cache_key = None
+        if self.cache is not None and not set_cid and not routing_key:
+            cache_key = LRU.key(channel, '', serializer.content_type, data)
+            cached = self.cache.get(cache_key)
 
-        data = zlib.compress(data, gzip_level) if gzip else data
+            if cached is not None:
+                result = Result()
+                result.set_result(self.parse_body(*cached), headers=cached[1].headers)
+                return result
 
-        headers.update({"x-original-sender": self._res_queue})
+        if gzip is None:
+            data, encoding = self.get_compression(channel).compress(data)
+        elif gzip:
+            data, encoding = codecs.registry.compressor('gzip').compress(data, gzip_level), 'gzip'
+        else:
+            encoding = 'plain'
+
+        if self.blob_store is not None and self.blob_store.accepts(data):
+            headers[blobstore.HEADER] = self.blob_store.put(data, expiration)
+            data = b''
+
+        # Any thread may call, the connections are taken in turn
+        connection = self.connections[next(self._next) % len(self.connections)]
+        headers.update({"x-original-sender": connection.res_queue})
 
         props = pika.BasicProperties(
-            content_encoding='gzip' if gzip else 'plain',
-            content_type=content_type,
-            reply_to=self._res_queue if not routing_key else routing_key,
+            content_encoding=encoding,
+            content_type=serializer.content_type,
+            reply_to=connection.res_queue if not routing_key else routing_key,
             correlation_id=cid,
             headers=headers,
             timestamp=int(time.time()),
@@ -246,7 +459,15 @@ class Client(object):
 
         self.callbacks_hash[props.correlation_id] = callback
 
-        self.channel.basic_publish(
+        # The reply is lost when it's not received by the expiration, along with the dead letter
+        deadline = time.time() + expiration + self.EXPIRATION_GRACE
+        handle = self._timer.call_at(deadline, partial(self._expire, cid, callback))
+        callback.add_done_callback(lambda result: handle.cancel())
+
+        if cache_key is not None:
+            self._cache_keys[props.correlation_id] = (channel, cache_key)
+
+        connection.publish(
             exchange='',
             routing_key=qname,
             properties=props,
@@ -254,12 +475,3 @@ class Client(object):
         )
 
         return callback
-
-    def get_serializer(self, name):
-        assert name in self.SERIALIZERS
-        if name == 'pickle':
-            return (lambda x: pickle.dumps(x, protocol=2), self.SERIALIZERS[name])
-        elif name == 'json':
-            return (json.dumps, self.SERIALIZERS[name])
-        elif name == 'text':
-            return lambda x: str(x).encode('utf-8')
@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 # encoding: utf-8
+import time
 import pika
 import tornado.ioloop
 import tornado.gen
-from copy import copy
-from crew import ConnectionError
-from functools import wraps, partial
+from collections import OrderedDict
+from crew import ConnectionError, PublishError
+from crew.outbox import Outbox
+from crew.master.tornado.topology import Topology
+from functools import wraps
 from heapq import heappop, heappush
+from itertools import count
 from pika.adapters.tornado_connection import TornadoConnection
+from shortuuid import uuid
 from tornado.concurrent import Future
 from tornado.log import app_log as log
 
@@ -33,7 +38,8 @@ def queued(order=1000):
                 tornado.ioloop.IOLoop.instance().add_callback(call)
             else:
                 log.debug("Queued %r", func)
-                heappush(self._queue, (order, call))
+                # The counter keeps the order of the equal ones and spares comparing the functions
+                heappush(self._queue, (order, next(self._seq), call))
 
             return f
 
@@ -42,25 +48,18 @@ def queued(order=1000):
     return deco
 
 
-def memory(order=1000):
-    def deco(func):
-        @wraps(func)
-        def wrap(self, *args, **kwargs):
-            heappush(self._memory, (order, partial(func, self, *args, **kwargs)))
-            return func(self, *args, **kwargs)
-
-        return wrap
-
-    return deco
-
-
 class TornadoPikaAdapter(object):
     RECONNECT_TIMEOUT = 5
 
+    # The buffer of this size is published without waiting for the next IOLoop iteration
+    FLUSH_BYTES = 1024 * 1024
+
     def _on_close(self, connection, *args):
         log.info('PikaClient: Try to reconnect')
         self.io_loop = tornado.ioloop.IOLoop.current()
 
+        self._fail_unconfirmed(PublishError('Connection was closed before the message was confirmed'))
+
         if self.connected:
             for func in list(self._on_close_listeners):
                 try:
@@ -72,13 +71,38 @@ class TornadoPikaAdapter(object):
         self.connected = False
         self.io_loop.add_callback(self.connect)
 
-    def __init__(self, connection_parameters, io_loop=None):
+    def __init__(self, connection_parameters, io_loop=None, confirm=False, confirm_window=1024, outbox=None):
         assert isinstance(connection_parameters, pika.ConnectionParameters)
+        assert isinstance(confirm_window, int) and confirm_window > 0
         self._connection_parameters = connection_parameters
         self._on_close_listeners = set()
         self._on_open_listeners = set()
         self._queue = list()
-        self._memory = list()
+        self._seq = count()
+        self.topology = Topology()
+        self._replayed = None
+        self._replaying = False
+
+        self.confirm = confirm
+        self.confirm_window = confirm_window
+        self._delivery_tag = 0
+        self.outbox = outbox if outbox is not None else Outbox()
+        self._unconfirmed = OrderedDict()
+        self.published = 0
+        self.confirmed = 0
+        self.nacked = 0
+        self.lost = 0
+
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_future = None
+        self._batch_started = None
+        self._flush_scheduled = False
+        self.flushes = 0
+        self.flushed = 0
+        self.flushed_bytes = 0
+        self.max_batch = 0
+        self.flush_latency = 0
 
         self.io_loop = io_loop if io_loop else tornado.ioloop.IOLoop.current()
 
@@ -112,61 +136,106 @@ class TornadoPikaAdapter(object):
 
     @tornado.gen.coroutine
     def _bethink(self):
-        mem = copy(self._memory)
-        while mem:
-            o, f = heappop(mem)
-            result = f()
-            if isinstance(result, Future):
-                yield result
+        try:
+            yield self.topology.replay(self.channel)
+        except Exception as e:
+            # The channel is closed and reopened on errors
+            log.exception(e)
+            return
+        finally:
+            self._replaying = False
+
+        replayed, self._replayed = self._replayed, None
+        if replayed is not None:
+            replayed.set_result(None)
 
         while self._queue:
-            o, f = heappop(self._queue)
+            o, _, f = heappop(self._queue)
             result = f()
             if isinstance(result, Future):
                 yield result
 
+        self._flush()
+
     def add_close_listener(self, func):
         self._on_close_listeners.add(func)
 
     def add_open_listener(self, func):
         self._on_open_listeners.add(func)
 
-    @queued(10)
-    @memory(10)
-    def exchange_declare(self, exchange, exchange_type='direct', passive=False, durable=False,
-                         auto_delete=False, internal=False, nowait=False, arguments=None, type=None):
+    def _wait_replay(self):
+        # The changes made while the channel is closed share the future
+        if self._replayed is None:
+            self._replayed = Future()
+        return self._replayed
+
+    @property
+    def _topology_ready(self):
+        """ The channel is open and the recorded topology is restored on it """
+        return bool(self.channel and self.channel.is_open) and not self._replaying
+
+    def _apply(self, method, *args, **kwargs):
+        """ Sends the change of the topology, or leaves it to the replay when the channel is closed """
+        if not (self.channel and self.channel.is_open):
+            return self._wait_replay()
+
         f = Future()
 
-        self.channel.exchange_declare(
-            lambda *a: f.set_result(a),
-            exchange=exchange,
+        def call():
+            if not (self.channel and self.channel.is_open):
+                self._wait_replay().add_done_callback(lambda _: f.done() or f.set_result(None))
+                return
+
+            if self._replaying:
+                # The replay has taken its snapshot, the change goes after the re-declarations
+                self._wait_replay().add_done_callback(lambda _: call())
+                return
+
+            try:
+                getattr(self.channel, method)(lambda *a: f.set_result(a), *args, **kwargs)
+            except Exception as e:
+                f.set_exception(e)
+
+        self.io_loop.add_callback(call)
+        return f
+
+    def exchange_declare(self, exchange, exchange_type='direct', passive=False, durable=False,
+                         auto_delete=False, internal=False, nowait=False, arguments=None, type=None):
+        kwargs = dict(
             exchange_type=exchange_type,
             passive=passive,
             durable=durable,
             auto_delete=auto_delete,
             internal=internal,
-            nowait=nowait,
             arguments=arguments,
-            type=type
         )
-        return f
 
-    @queued(20)
-    @memory(20)
+        if type is not None:
+            kwargs['type'] = type
+
+        self.topology.declare_exchange(exchange, **kwargs)
+        return self._apply('exchange_declare', exchange=exchange, **kwargs)
+
     def queue_declare(self, queue='', passive=False, durable=False,
                       exclusive=False, auto_delete=False, nowait=False,
                       arguments=None):
-        f = Future()
-
-        self.channel.queue_declare(
-            lambda *a: f.set_result(a),
-            queue=queue,
+        kwargs = dict(
             passive=passive,
             durable=durable,
             exclusive=exclusive,
             auto_delete=auto_delete,
-            nowait=nowait,
-            arguments=arguments
+            arguments=arguments,
+        )
+
+        self.topology.declare_queue(queue, **kwargs)
+        return self._apply('queue_declare', queue=queue, **kwargs)
+
+    @queued(20)
+    def transient_queue_declare(self, queue, auto_delete=True, arguments=None):
+        """ Queue of a single call, it isn't declared again after a reconnect """
+        f = Future()
+        self.channel.queue_declare(
+            lambda *a: f.set_result(a), queue=queue, auto_delete=auto_delete, arguments=arguments
         )
         return f
 
@@ -174,6 +243,13 @@ class TornadoPikaAdapter(object):
     def _open_channel(self):
         self.channel = yield self._channel()
         self.channel.add_on_close_callback(self._on_channel_close)
+        # Until _bethink restores the topology
+        self._replaying = True
+
+        if self.confirm:
+            # Delivery tags are counted from 1 on every channel
+            self._delivery_tag = 0
+            self.channel.confirm_delivery(self._on_confirm)
         self.io_loop.add_callback(self._on_channel_open)
 
         log.info('Channel "{0}" was opened.'.format(self.channel))
@@ -184,6 +260,11 @@ class TornadoPikaAdapter(object):
         self.connection.channel(on_open_callback=f.set_result)
         return f
 
+    @queued(600)
+    def open_channel(self):
+        """ Extra channel for the consumers with their own QoS, it isn't restored after a reconnect """
+        return self._channel()
+
     def _connect(self):
         future = Future()
 
@@ -218,45 +299,269 @@ class TornadoPikaAdapter(object):
 
         self.io_loop.call_later(self.RECONNECT_TIMEOUT, self._connect)
 
-    @queued(500)
-    @memory(500)
     def queue_bind(self, queue, exchange, routing_key=None, nowait=False, arguments=None):
-        f = Future()
-        self.channel.queue_bind(
-            lambda *a: f.set_result(a), queue, exchange, routing_key=routing_key, nowait=nowait, arguments=arguments
-        )
-        return f
+        self.topology.bind(queue, exchange, routing_key, arguments)
+        return self._apply('queue_bind', queue, exchange, routing_key=routing_key, arguments=arguments)
 
-    @queued(600)
-    @memory(600)
-    def consume(self, queue, callback):
+    def queue_unbind(self, queue='', exchange=None, routing_key=None, arguments=None):
+        self.topology.unbind(queue, exchange, routing_key, arguments)
+
+        if not (self.channel and self.channel.is_open):
+            # The binding isn't restored, there is nothing to remove
+            f = Future()
+            f.set_result(None)
+            return f
+
+        return self._apply('queue_unbind', queue=queue, exchange=exchange, routing_key=routing_key, arguments=arguments)
+
+    def consume(self, queue, callback, consumer_tag=None):
+        """ Starts the consumer, returns the future of its tag which stays the same after a reconnect """
         assert callable(callback)
-        return self.channel.basic_consume(consumer_callback=callback, queue=queue, no_ack=False)
+        consumer_tag = consumer_tag or 'crew.ctag.{0}'.format(uuid())
+        self.topology.consume(consumer_tag, queue, callback)
 
-    @queued(900)
-    @memory(900)
-    def cancel(self, consumer_tag='', nowait=False):
         f = Future()
-        self.channel.basic_cancel(callback=lambda *a: f.set_result(a), consumer_tag=consumer_tag, nowait=nowait)
+
+        def call():
+            if self._topology_ready:
+                self.channel.basic_consume(callback, queue=queue, no_ack=False, consumer_tag=consumer_tag)
+            f.set_result(consumer_tag)
+
+        if self._topology_ready:
+            self.io_loop.add_callback(call)
+        else:
+            # Started by the replay, which reads the consumers after the declarations
+            f.set_result(consumer_tag)
+
         return f
 
-    @queued(500)
-    @memory(500)
-    def queue_unbind(self, queue='', exchange=None, routing_key=None, arguments=None):
-        f = Future()
-        self.channel.queue_unbind(
-            callback=lambda *a: f.set_result(a), queue=queue,
-            exchange=exchange, routing_key=routing_key, arguments=arguments
+    def cancel(self, consumer_tag='', nowait=False):
+        self.topology.cancel(consumer_tag)
+
+        if not self._topology_ready:
+            # The replay doesn't start it
+            f = Future()
+            f.set_result(None)
+            return f
+
+        return self._apply('basic_cancel', consumer_tag=consumer_tag)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False, immediate=False,
+                      wait=True):
+        """ Buffers the message, the buffer is published once per IOLoop iteration
+
+        The returned future is shared by the messages of the batch, in the
+        confirm mode it's resolved when the broker confirms the message. With
+        ``wait=False`` no future is created and ``None`` is returned.
+        """
+        kwargs = dict(
+            exchange=exchange, routing_key=routing_key, body=body,
+            properties=properties, mandatory=mandatory, immediate=immediate,
         )
-        return f
+        return self.basic_publish_many([kwargs], wait=wait)[0]
+
+    def basic_publish_many(self, messages, wait=True):
+        """ Buffers the messages together, returns a future for each of them
+
+        ``messages`` are the dicts of the ``basic_publish`` arguments.
+        """
+        messages = list(messages)
+
+        if self.confirm or self.outbox or not (self.channel and self.channel.is_open):
+            return self._enqueue(messages, wait)
+
+        future = None
+        if wait:
+            if self._batch_future is None:
+                self._batch_future = Future()
+            future = self._batch_future
+
+        if not self._batch:
+            self._batch_started = time.time()
+
+        self._batch.extend(messages)
+        self._batch_bytes += sum(len(kwargs['body']) for kwargs in messages)
+
+        if self._batch_bytes >= self.FLUSH_BYTES:
+            self._flush()
+        else:
+            self._schedule_flush()
+
+        return [future] * len(messages)
+
+    def _enqueue(self, messages, wait):
+        # Every message may be rejected, dropped or expire on its own
+        futures = []
+
+        for kwargs in messages:
+            future = Future() if wait else None
+            self.outbox.append(future, kwargs)
+            futures.append(future)
+
+        self._schedule_flush()
+        return futures
+
+    def _schedule_flush(self):
+        if self._flush_scheduled or not (self.channel and self.channel.is_open):
+            # The channel flushes the buffers when it's opened
+            return
+
+        self._flush_scheduled = True
+        self.io_loop.add_callback(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+
+        if self.confirm:
+            self._flush_pending()
+        else:
+            # The batch holds the messages buffered before the channel was lost, they are older than the outbox
+            self._flush_batch()
+            self._flush_outbox()
+
+    def _flush_outbox(self):
+        """ Replays up to FLUSH_BYTES of the outbox per IOLoop iteration, returns True when it's drained """
+        size = 0
+
+        while self.outbox:
+            if not (self.channel and self.channel.is_open):
+                return False
+
+            if size >= self.FLUSH_BYTES:
+                # Lets the connection write out the frames
+                self._schedule_flush()
+                return False
+
+            try:
+                future, kwargs = self.outbox.popleft()
+            except IndexError:
+                # The rest has expired
+                break
+
+            try:
+                self.channel.basic_publish(**kwargs)
+            except Exception as e:
+                log.exception(e)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+                continue
+
+            size += len(kwargs['body'])
+            if future is not None and not future.done():
+                future.set_result(True)
+
+        return True
+
+    def _flush_batch(self):
+        if not self._batch or not (self.channel and self.channel.is_open):
+            return
+
+        batch, self._batch = self._batch, []
+        future, self._batch_future = self._batch_future, None
+        self.flushes += 1
+        self.flushed += len(batch)
+        self.flushed_bytes += self._batch_bytes
+        self.max_batch = max(self.max_batch, len(batch))
+        self.flush_latency += time.time() - self._batch_started
+        self._batch_bytes = 0
 
-    @queued()
-    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False, immediate=False):
-        return self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body,
-                                          properties=properties, mandatory=mandatory, immediate=immediate)
+        try:
+            for kwargs in batch:
+                self.channel.basic_publish(**kwargs)
+        except Exception as e:
+            log.exception(e)
+            if future is not None:
+                future.set_exception(e)
+            return
+
+        if future is not None:
+            future.set_result(len(batch))
+
+    def _flush_pending(self):
+        while self.outbox and len(self._unconfirmed) < self.confirm_window:
+            if not (self.channel and self.channel.is_open):
+                return
+
+            try:
+                future, kwargs = self.outbox.popleft()
+            except IndexError:
+                # The rest has expired
+                return
+
+            try:
+                self.channel.basic_publish(**kwargs)
+            except Exception as e:
+                if future is not None:
+                    future.set_exception(e)
+                continue
+
+            self._delivery_tag += 1
+            self._unconfirmed[self._delivery_tag] = future
+            self.published += 1
+
+    @property
+    def batch_stats(self):
+        return {
+            'flushes': self.flushes,
+            'messages': self.flushed,
+            'bytes': self.flushed_bytes,
+            'max_batch': self.max_batch,
+            'average_batch': float(self.flushed) / self.flushes if self.flushes else 0,
+            'average_latency': self.flush_latency / self.flushes if self.flushes else 0,
+            'buffered': len(self._batch),
+        }
+
+    def _on_confirm(self, frame):
+        tag = frame.method.delivery_tag
+        futures = []
+
+        if frame.method.multiple:
+            # Tags are growing, the confirmed ones are at the beginning
+            while self._unconfirmed:
+                first = next(iter(self._unconfirmed))
+                if first > tag:
+                    break
+                futures.append(self._unconfirmed.pop(first))
+        elif tag in self._unconfirmed:
+            futures.append(self._unconfirmed.pop(tag))
+
+        if isinstance(frame.method, pika.spec.Basic.Nack):
+            self.nacked += len(futures)
+            for future in futures:
+                if future is not None:
+                    future.set_exception(PublishError('Message was rejected by the broker'))
+        else:
+            self.confirmed += len(futures)
+            for future in futures:
+                if future is not None:
+                    future.set_result(True)
+
+        self._flush_pending()
+
+    def _fail_unconfirmed(self, exc):
+        # The messages may be lost, the publishers decide on retrying them
+        self.lost += len(self._unconfirmed)
+
+        while self._unconfirmed:
+            tag, future = self._unconfirmed.popitem(last=False)
+            if future is not None and not future.done():
+                future.set_exception(exc)
+
+    @property
+    def confirm_stats(self):
+        return {
+            'window': self.confirm_window,
+            'published': self.published,
+            'confirmed': self.confirmed,
+            'nacked': self.nacked,
+            'lost': self.lost,
+            'unconfirmed': len(self._unconfirmed),
+            'pending': len(self.outbox),
+        }
 
     def close(self):
         self.channel.close()
 
     def _on_channel_close(self, channel, code, reason, **kwargs):
+        self._fail_unconfirmed(PublishError('Channel was closed before the message was confirmed: {0}'.format(reason)))
         self.io_loop.call_later(1, self._reconnect)
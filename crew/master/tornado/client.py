@@ -1,8 +1,9 @@
 # encoding: utf-8
-import json
-import zlib
 import time
-import sys
+from copy import copy
+from functools import partial
+from heapq import heapify, heappop, heappush
+from itertools import count
 import tornado.ioloop
 import tornado.gen
 import pika
@@ -10,23 +11,23 @@ from shortuuid import uuid
 from tornado.concurrent import Future
 from tornado.log import app_log as log
 from pika.credentials import ExternalCredentials, PlainCredentials
-from .multitask import MultitaskCall
-from ... import ExpirationError, DuplicateTaskId
-
-if sys.version_info >= (3,):
-    import pickle
-else:
-    import cPickle as pickle
+from .multitask import MultitaskCall, Map
+from .stream import Stream
+from ... import ExpirationError, DuplicateTaskId, TimeoutError, codecs, blobstore
+from ...cache import LRU
+from ...compression import CompressionPolicy
 
 
 class Client(object):
-    SERIALIZERS = {
-        'json': 'application/json',
-        'pickle': 'application/python-pickle',
-        'text': 'text/plain',
-    }
+    # Time given to the dead letter of the expired call to arrive
+    EXPIRATION_GRACE = 1
+
+    # Deprecated aliases of the codec registry
+    SERIALIZERS = codecs.content_types
+    get_serializer = staticmethod(codecs.get_serializer)
 
-    def __init__(self, host='localhost', port=5672, virtualhost='/', credentials=None):
+    def __init__(self, host='localhost', port=5672, virtualhost='/', credentials=None, compression=None,
+                 blob_store=None, confirm=False, confirm_window=1024, cache=None, outbox=None):
         from .adapter import TornadoPikaAdapter
 
         if credentials is not None:
@@ -37,7 +38,7 @@ class Client(object):
             port=port,
             credentials=credentials,
             virtual_host=virtualhost,
-        ))
+        ), confirm=confirm, confirm_window=confirm_window, outbox=outbox)
 
         client_uid = uuid()
         self.io_loop = tornado.ioloop.IOLoop.current()
@@ -45,30 +46,100 @@ class Client(object):
         self._pubsub_queue = "crew.subscribe.%s" % client_uid
         self.callbacks_hash = {}
         self._subscribe_cache = {}
+        self.compression = compression or CompressionPolicy()
+        self._compression = {}
+        self.blob_store = blob_store
+        self.cache = cache
+        self._cache_ttl = {}
+        self._cache_keys = {}
+        self._deadlines = []
+        self._deadline_counter = count()
+        self._expire_at = None
+        self._expire_timeout = None
+        self._coalesce = set()
+        self._inflight = {}
+        self.coalesced = 0
 
         tornado.ioloop.IOLoop.instance().add_callback(self.connect)
 
+    def set_compression(self, channel, policy):
+        """ Compression policy of the requests sent to the channel """
+        self._compression[channel] = policy
+
+    def get_compression(self, channel):
+        return self._compression.get(channel, self.compression)
+
+    @property
+    def cache_stats(self):
+        return self.cache.stats if self.cache is not None else None
+
+    @property
+    def compression_stats(self):
+        stats = dict((channel, policy.stats) for channel, policy in self._compression.items())
+        stats[None] = self.compression.stats
+        return stats
+
+    def set_cache_ttl(self, channel, ttl):
+        """ Replies of the channel are cached for ``ttl`` seconds, the x-cache-ttl reply header overrides it """
+        if ttl:
+            self._cache_ttl[channel] = ttl
+        else:
+            self._cache_ttl.pop(channel, None)
+
+    def _remember(self, cid, body, props, result):
+        entry = self._cache_keys.pop(cid, None)
+        if entry is None or isinstance(result, Exception):
+            return
+
+        channel, key = entry
+        headers = props.headers or {}
+        ttl = headers.get('x-cache-ttl', self._cache_ttl.get(channel))
+
+        # The blobs are removed once they are read
+        if ttl and blobstore.HEADER not in headers:
+            self.cache.set(key, (body, props), ttl=ttl)
+
+    def set_coalesce(self, channel, enabled=True):
+        """ Identical calls of the channel made while one is in flight share its reply """
+        if enabled:
+            self._coalesce.add(channel)
+        else:
+            self._coalesce.discard(channel)
+
     def parse_body(self, body, props):
-        content_type = getattr(props, 'content_type', 'text/plain')
+        serializer = codecs.resolve(getattr(props, 'content_type', None), props.content_encoding or 'plain')
+        key = (props.headers or {}).get(blobstore.HEADER)
 
-        if props.content_encoding == 'gzip':
-            body = zlib.decompress(body)
+        if key is None:
+            return serializer.loads(body)
 
-        if 'application/json' in content_type:
-            return json.loads(body)
-        elif 'application/python-pickle' in content_type:
-            return pickle.loads(body)
+        if self.blob_store is None:
+            raise LookupError('Result is stored in the blob {0}, but the blob store is not configured'.format(key))
+
+        try:
+            return serializer.loads(self.blob_store.get(key))
+        finally:
+            self.blob_store.delete(key)
 
     def _on_result(self, channel, method, props, body):
         log.debug('PikaCient: Result message received, tag #%i len %d', method.delivery_tag, len(body))
 
         correlation_id = getattr(props, 'correlation_id', None)
-        if correlation_id not in self.callbacks_hash:
-            log.info('Got result for task "%d", but no has callback', correlation_id)
 
         try:
-            cb = self.callbacks_hash.pop(correlation_id)
-            body = self.parse_body(body, props)
+            cb = self.callbacks_hash.pop(correlation_id, None)
+            if cb is None:
+                # Late reply of an expired or abandoned call
+                log.debug('Got result for task "%s", but no has callback', correlation_id)
+                self._cache_keys.pop(correlation_id, None)
+
+                key = (props.headers or {}).get(blobstore.HEADER)
+                if key is not None and self.blob_store is not None:
+                    self.blob_store.delete(key)
+                return
+
+            raw, body = body, self.parse_body(body, props)
+            self._remember(correlation_id, raw, props, body)
 
             if isinstance(cb, Future):
                 if isinstance(body, Exception):
@@ -83,6 +154,8 @@ class Client(object):
 
     def _on_dlx_received(self, channel, method, props, body):
         correlation_id = getattr(props, 'correlation_id', None)
+        self._cache_keys.pop(correlation_id, None)
+
         if correlation_id in self.callbacks_hash:
             cb = self.callbacks_hash.pop(correlation_id)
         else:
@@ -132,7 +205,8 @@ class Client(object):
         yield self.channel.connect()
 
     def call(self, channel, data=None, callback=None, serializer='pickle', headers=None, persistent=True, priority=0,
-             expiration=86400, timestamp=None, gzip=None, gzip_level=6, set_cid=None, routing_key=None, exchange=''):
+             expiration=86400, timestamp=None, gzip=None, gzip_level=6, set_cid=None, routing_key=None, exchange='',
+             coalesce=None):
 
         if not headers:
             headers = {}
@@ -142,7 +216,7 @@ class Client(object):
 
         qname = "crew.tasks.%s" % channel
 
-        serializer, content_type = self.get_serializer(serializer)
+        serializer = codecs.get(serializer)
 
         if set_cid:
             cid = str(set_cid)
@@ -152,18 +226,50 @@ class Client(object):
         else:
             cid = "{0}.{1}".format(channel, uuid())
 
-        data = serializer(data)
+        data = serializer.dumps(data)
+
+        if coalesce is None:
+            coalesce = channel in self._coalesce
+
+        cache_key = None
+        if self.cache is not None and callback is None and not set_cid and not routing_key:
+            cache_key = LRU.key(channel, exchange, serializer.content_type, data)
+            cached = self.cache.get(cache_key)
 
-        if gzip is None and data is not None and len(data) > 1024 * 32:
-            gzip = True
+            if cached is not None:
+                future = Future()
+                future.set_result(self.parse_body(*cached))
+                return future
 
-        data = zlib.compress(data, gzip_level) if gzip else data
+        key = None
+        if coalesce and callback is None and not set_cid and not routing_key:
+            # The calls sharing the message must agree on its properties too
+            key = LRU.key(
+                channel, exchange, serializer.content_type, priority, expiration, bool(persistent),
+                sorted(headers.items()), data
+            )
+            inflight = self._inflight.get(key)
+
+            if inflight is not None:
+                self.coalesced += 1
+                return inflight
+
+        if gzip is None:
+            data, encoding = self.get_compression(channel).compress(data)
+        elif gzip:
+            data, encoding = codecs.registry.compressor('gzip').compress(data, gzip_level), 'gzip'
+        else:
+            encoding = 'plain'
+
+        if self.blob_store is not None and self.blob_store.accepts(data):
+            headers[blobstore.HEADER] = self.blob_store.put(data, expiration)
+            data = b''
 
         headers.update({"x-original-sender": self._res_queue})
 
         props = pika.BasicProperties(
-            content_encoding='gzip' if gzip else 'plain',
-            content_type=content_type,
+            content_encoding=encoding,
+            content_type=serializer.content_type,
             reply_to=self._res_queue if not routing_key else routing_key,
             correlation_id=cid,
             headers=headers,
@@ -176,20 +282,214 @@ class Client(object):
         if callback is None:
             callback = Future()
 
+        if key is not None:
+            # Every waiter gets the same future, resolved by the single reply
+            self._inflight[key] = callback
+            callback.add_done_callback(lambda f: self._inflight.pop(key, None))
+
         self.callbacks_hash[props.correlation_id] = callback
+        self._track(props.correlation_id, callback, time.time() + expiration + self.EXPIRATION_GRACE)
 
-        self.channel.basic_publish(
+        if cache_key is not None:
+            self._cache_keys[props.correlation_id] = (channel, cache_key)
+
+        # The call waits for the publish, a message rejected by the broker or the outbox fails it at once
+        published = self.channel.basic_publish(
             exchange=exchange,
             routing_key=qname,
             properties=props,
             body=data
         )
+        published.add_done_callback(partial(self._on_published, props.correlation_id))
 
         if isinstance(callback, Future):
             return callback
         else:
             return props.correlation_id
 
+    def call_many(self, channel, payloads, serializer='pickle', headers=None, persistent=True, priority=0,
+                  expiration=86400, timestamp=None, gzip=None, gzip_level=6, exchange=''):
+        """ Calls the task with every payload at once, returns the list of futures of the results
+
+        The properties are built once and copied for every message, the ids
+        share a random prefix and all the messages are published by a single
+        IOLoop callback.
+        """
+        assert priority <= 255
+        assert isinstance(expiration, int) and expiration > 0
+
+        qname = "crew.tasks.%s" % channel
+        serializer = codecs.get(serializer)
+        compression = self.get_compression(channel)
+        prefix = "{0}.{1}".format(channel, uuid())
+        deadline = time.time() + expiration + self.EXPIRATION_GRACE
+
+        headers = dict(headers or {})
+        headers["x-original-sender"] = self._res_queue
+
+        template = pika.BasicProperties(
+            content_type=serializer.content_type,
+            reply_to=self._res_queue,
+            headers=headers,
+            timestamp=int(timestamp or time.time()),
+            delivery_mode=2 if persistent else None,
+            priority=priority,
+            expiration="%d" % (expiration * 1000),
+        )
+
+        futures, messages, cids = [], [], []
+
+        for number, data in enumerate(payloads):
+            data = serializer.dumps(data)
+
+            if gzip is None:
+                data, encoding = compression.compress(data)
+            elif gzip:
+                data, encoding = codecs.registry.compressor('gzip').compress(data, gzip_level), 'gzip'
+            else:
+                encoding = 'plain'
+
+            props = copy(template)
+            props.correlation_id = "{0}.{1}".format(prefix, number)
+            props.content_encoding = encoding
+
+            if self.blob_store is not None and self.blob_store.accepts(data):
+                props.headers = dict(headers)
+                props.headers[blobstore.HEADER] = self.blob_store.put(data, expiration)
+                data = b''
+
+            future = Future()
+            self.callbacks_hash[props.correlation_id] = future
+            self._track(props.correlation_id, future, deadline)
+
+            futures.append(future)
+            cids.append(props.correlation_id)
+            messages.append(dict(exchange=exchange, routing_key=qname, properties=props, body=data))
+
+        for cid, published in zip(cids, self.channel.basic_publish_many(messages)):
+            published.add_done_callback(partial(self._on_published, cid))
+
+        return futures
+
+    def _track(self, cid, callback, deadline):
+        heappush(self._deadlines, (deadline, next(self._deadline_counter), cid, callback))
+
+        # Entries of the answered calls are dropped when they are due, or here when there are too many of them
+        if len(self._deadlines) > 2 * len(self.callbacks_hash) + 64:
+            self._deadlines = [item for item in self._deadlines if self.callbacks_hash.get(item[2]) is item[3]]
+            heapify(self._deadlines)
+
+        if self._expire_at is None or deadline < self._expire_at:
+            self._schedule_expiration(deadline)
+
+    def _schedule_expiration(self, deadline):
+        if self._expire_timeout is not None:
+            self.io_loop.remove_timeout(self._expire_timeout)
+
+        self._expire_at = deadline
+        self._expire_timeout = self.io_loop.call_later(max(deadline - time.time(), 0), self._expire)
+
+    def _expire(self):
+        self._expire_at = self._expire_timeout = None
+        now = time.time()
+
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, _, cid, callback = heappop(self._deadlines)
+            if self.callbacks_hash.get(cid) is not callback:
+                continue
+
+            del self.callbacks_hash[cid]
+            self._cache_keys.pop(cid, None)
+            exc = TimeoutError('Reply for "{0}" was not received in time'.format(cid))
+
+            try:
+                if isinstance(callback, Future):
+                    if not callback.done():
+                        callback.set_exception(exc)
+                elif callable(callback):
+                    callback(exc, headers=None)
+            except Exception as e:
+                log.exception(e)
+
+        if self._deadlines:
+            self._schedule_expiration(self._deadlines[0][0])
+
+    @property
+    def pending(self):
+        return len(self.callbacks_hash)
+
+    def _on_published(self, cid, future):
+        exc = future.exception()
+        if exc is None:
+            return
+
+        cb = self.callbacks_hash.pop(cid, None)
+        self._cache_keys.pop(cid, None)
+        log.error('Task "%s" was not published: %r', cid, exc)
+
+        if isinstance(cb, Future):
+            if not cb.done():
+                cb.set_exception(exc)
+        elif callable(cb):
+            cb(exc, headers=None)
+
+    def call_stream(self, channel, data=None, buffer_size=16, **kwargs):
+        """ Calls a generator task, returns the stream of the items it yields """
+        cid = "{0}.{1}".format(channel, uuid())
+        stream = Stream(self, cid, buffer_size)
+        self.io_loop.add_callback(
+            stream.open,
+            partial(self.call, channel, data, callback=stream, set_cid=cid, routing_key=stream.queue, **kwargs)
+        )
+        return stream
+
+    def call_upload(self, channel, chunks, serializer='pickle', expiration=86400, **kwargs):
+        """ Calls a task with the input sent in chunks, the handler gets an iterator over them """
+        cid = "{0}.{1}".format(channel, uuid())
+        queue = "crew.upload.%s" % cid
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers['x-upload-queue'] = queue
+
+        # The queue of an abandoned upload is dropped by the broker
+        self.channel.transient_queue_declare(queue, arguments={"x-expires": expiration * 1000})
+        result = self.call(
+            channel, None, serializer=serializer, headers=headers, expiration=expiration, set_cid=cid, **kwargs
+        )
+        self.io_loop.add_callback(self._upload, channel, queue, chunks, serializer, expiration)
+        return result
+
+    @tornado.gen.coroutine
+    def _upload(self, channel, queue, chunks, serializer, expiration):
+        serializer = codecs.get(serializer)
+        compression = self.get_compression(channel)
+        seq, error = 0, None
+
+        try:
+            for chunk in chunks:
+                data, encoding = compression.compress(serializer.dumps(chunk))
+                # Waiting for each chunk lets the IOLoop write it out before the next one is read
+                yield self.channel.basic_publish(
+                    exchange='', routing_key=queue, body=data,
+                    properties=pika.BasicProperties(
+                        content_type=serializer.content_type, content_encoding=encoding,
+                        headers={'x-upload-seq': seq}, expiration="%d" % (expiration * 1000),
+                    )
+                )
+                seq += 1
+        except Exception as e:
+            log.exception(e)
+            error = e
+
+        # The end is marked by the header, only the error is sent in the body
+        end = codecs.get('pickle')
+        yield self.channel.basic_publish(
+            exchange='', routing_key=queue, body=end.dumps(error) if error is not None else b'',
+            properties=pika.BasicProperties(
+                content_type=end.content_type if error is not None else None, content_encoding='plain',
+                headers={'x-upload-seq': seq, 'x-upload-end': True}, expiration="%d" % (expiration * 1000),
+            )
+        )
+
     def _on_subscribed_message(self, channel, method, props, body):
         key = props.headers['x-channel-name']
         cb = self._subscribe_cache.get(key, None)
@@ -214,32 +514,30 @@ class Client(object):
         self._subscribe_cache[channel] = callback
 
     @tornado.gen.coroutine
-    def unsubscribe(self, qname, callback):
+    def unsubscribe(self, qname, callback=None):
         log.debug('Cancelling subscription for channel: "%s"', qname)
-        yield self.channel.cancel(qname)
-
-    def get_serializer(self, name):
-        assert name in self.SERIALIZERS
-        if name == 'pickle':
-            return (lambda x: pickle.dumps(x, protocol=2), self.SERIALIZERS[name])
-        elif name == 'json':
-            return (json.dumps, self.SERIALIZERS[name])
-        elif name == 'text':
-            return lambda x: str(x).encode('utf-8')
+        self._subscribe_cache.pop(qname, None)
+        yield self.channel.queue_unbind(
+            queue=self._pubsub_queue, exchange="crew.PUBSUB", arguments={"x-channel-name": qname}
+        )
 
-    def publish(self, channel, message, serializer='pickle'):
-        assert serializer in self.SERIALIZERS
+    def publish(self, channel, message, serializer='pickle', wait=False):
+        """ Publishes the message to the subscribers
 
-        serializer, t = self.get_serializer(serializer)
+        Nothing is returned unless ``wait`` is set, then it's the future of
+        the publish, resolved by the broker confirmation in the confirm mode.
+        """
+        serializer = codecs.get(serializer)
 
-        self.channel.basic_publish(
+        return self.channel.basic_publish(
             exchange='crew.PUBSUB',
             routing_key='',
-            body=serializer(message),
+            body=serializer.dumps(message),
             properties=pika.BasicProperties(
-                content_type=t, delivery_mode=1,
+                content_type=serializer.content_type, delivery_mode=1,
                 headers={"x-channel-name": channel}
-            )
+            ),
+            wait=wait,
         )
 
     def _on_custom_consume(self, callback, channel, method, props, body):
@@ -257,6 +555,10 @@ class Client(object):
     def parallel(self):
         return MultitaskCall(self)
 
+    def map(self, channel, iterable, concurrency=64, ordered=False, **kwargs):
+        """ Calls the task with every item, keeping at most ``concurrency`` calls in flight """
+        return Map(self, channel, iterable, concurrency=concurrency, ordered=ordered, **kwargs)
+
     @tornado.gen.coroutine
     def close(self):
         yield self.channel.close()
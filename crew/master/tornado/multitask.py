@@ -1,14 +1,22 @@
 #!/usr/bin/env python
 # encoding: utf-8
+from collections import deque
+from functools import partial
+
+import tornado.gen
 from shortuuid import uuid
 from tornado.concurrent import Future
+from tornado.log import app_log as log
+
+from .stream import StopAsyncIteration
 
 
 class MultitaskCall(object):
     def __init__(self, client):
         self.__calls = list()
         self.__results = {}
-        self.__result_future = Future()
+        self.__pending = 0
+        self.__result_future = None
         self.client = client
 
     def __enter__(self):
@@ -22,26 +30,193 @@ class MultitaskCall(object):
         assert not 'set_cid' in kwargs
 
         cid = "{0}.{1}".format(channel, uuid())
-        def set_result(result, headers):
-            self.__result_cb(result, cid)
 
-        self.client.call(channel, callback=set_result, set_cid=cid, **kwargs)
+        self.client.call(channel, callback=partial(self.__result_cb, cid), set_cid=cid, **kwargs)
         self.__calls.append(cid)
+        self.__pending += 1
 
     def result(self):
-        self.__queue = list(self.__calls)
-        return self.__result_future
+        # Errors are returned in place of the results of the failed tasks
+        future = self.__result_future = Future()
+        self.__resolve()
+        return future
 
-    def __result_cb(self, result, cid):
+    def __result_cb(self, cid, result, headers=None):
         self.__results[cid] = result
-        self.__queue.remove(cid)
+        self.__pending -= 1
+        self.__resolve()
+
+    def __resolve(self):
+        if self.__pending or self.__result_future is None:
+            return
 
-        if not self.__queue:
-            self.__result_future.set_result([self.__results[i] for i in self.__calls])
-            self.__clean()
+        future = self.__result_future
+        results = [self.__results[i] for i in self.__calls]
+        self.__clean()
+        future.set_result(results)
 
     def __clean(self):
         self.__calls = []
-        self.__queue = []
         self.__results = {}
-        self.__result_future = Future()
+        self.__result_future = None
+
+
+class Map(object):
+    """ Calls the task with every item of the iterable, ``concurrency`` calls at a time.
+
+    The items are taken from the iterable only when there is a place for
+    their calls, and the results are yielded as they arrive, or in the order
+    of the items when ``ordered`` is set. Errors are yielded in place of the
+    results of the failed calls. Iterate it with ``async for``, or call
+    ``next()`` from the coroutines.
+    """
+
+    def __init__(self, client, channel, iterable, concurrency=64, ordered=False, **kwargs):
+        assert isinstance(concurrency, int) and concurrency > 0
+        assert 'callback' not in kwargs
+        assert 'set_cid' not in kwargs
+
+        self.client = client
+        self.channel = channel
+        self.concurrency = concurrency
+        self.ordered = ordered
+        self.kwargs = kwargs
+        self.sent = 0
+        self.received = 0
+
+        self._items = iter(iterable)
+        self._exhausted = False
+        self._inflight = {}
+        self._ready = deque()
+        self._reordered = {}
+        self._position = 0
+        self._waiter = None
+
+    @property
+    def pending(self):
+        return len(self._inflight)
+
+    @property
+    def finished(self):
+        return self._exhausted and not self._inflight and not self._ready
+
+    def _buffered(self):
+        return len(self._inflight) + len(self._ready) + len(self._reordered)
+
+    def _fill(self):
+        # Results waiting for the consumer hold their places, so a slow consumer stops the calls
+        while not self._exhausted and self._buffered() < self.concurrency:
+            try:
+                item = next(self._items)
+            except StopIteration:
+                self._exhausted = True
+                break
+            except Exception as e:
+                log.exception(e)
+                self._exhausted = True
+                self._store(self.sent, e)
+                self.sent += 1
+                break
+
+            index, cid = self.sent, "{0}.{1}".format(self.channel, uuid())
+            self.sent += 1
+            self._inflight[index] = cid
+
+            try:
+                self.client.call(
+                    self.channel, item, callback=partial(self._on_result, index), set_cid=cid, **self.kwargs
+                )
+            except Exception as e:
+                log.exception(e)
+                self._on_result(index, e)
+
+    def _on_result(self, index, result, headers=None):
+        if self._inflight.pop(index, None) is None:
+            return
+
+        self.received += 1
+        self._store(index, result)
+        self._wakeup()
+
+    def _store(self, index, result):
+        # The indexes travel with the results, gather() sorts by them
+        if not self.ordered:
+            self._ready.append((index, result))
+            return
+
+        self._reordered[index] = (index, result)
+        while self._position in self._reordered:
+            self._ready.append(self._reordered.pop(self._position))
+            self._position += 1
+
+    def _wakeup(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    @tornado.gen.coroutine
+    def next(self):
+        index, result = yield self._next()
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def _next(self):
+        self._fill()
+
+        while not self._ready:
+            if self._exhausted and not self._inflight:
+                raise StopAsyncIteration()
+
+            self._waiter = Future()
+            yield self._waiter
+
+        pair = self._ready.popleft()
+        self._fill()
+        raise tornado.gen.Return(pair)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.next()
+
+    @tornado.gen.coroutine
+    def first(self, count):
+        """ Results of the first ``count`` finished calls, the rest are abandoned """
+        results = []
+
+        while len(results) < count:
+            try:
+                results.append((yield self.next()))
+            except StopAsyncIteration:
+                break
+
+        self.close()
+        raise tornado.gen.Return(results)
+
+    @tornado.gen.coroutine
+    def gather(self):
+        """ Results of all the calls in the order of the items, with the errors in place """
+        pairs = []
+
+        while True:
+            try:
+                pairs.append((yield self._next()))
+            except StopAsyncIteration:
+                break
+
+        pairs.sort(key=lambda pair: pair[0])
+        raise tornado.gen.Return([result for _, result in pairs])
+
+    def close(self):
+        """ Stops taking the items and forgets the calls in flight, their replies are dropped """
+        self._exhausted = True
+
+        for cid in self._inflight.values():
+            self.client.callbacks_hash.pop(cid, None)
+
+        self._inflight.clear()
+        self._wakeup()
+
+
+__all__ = ("MultitaskCall", "Map")
@@ -0,0 +1,167 @@
+# encoding: utf-8
+from collections import deque
+
+import tornado.gen
+from tornado.concurrent import Future
+from tornado.log import app_log as log
+
+from ...exceptions import ConnectionError
+
+try:
+    StopAsyncIteration = StopAsyncIteration
+except NameError:
+    class StopAsyncIteration(Exception):
+        pass
+
+
+class Stream(object):
+    """ Items yielded by a generator task, in order.
+
+    The chunks are consumed from a dedicated queue through a separate channel
+    whose prefetch is ``buffer_size``. A chunk is acknowledged when it's taken
+    from the stream, so the client holds at most ``buffer_size`` of them and
+    the rest are waiting in the broker.
+
+    Iterate it with ``async for``, or call ``next()`` from the coroutines.
+    """
+
+    def __init__(self, client, cid, buffer_size=16):
+        assert isinstance(buffer_size, int) and buffer_size > 0
+        self.client = client
+        self.cid = cid
+        self.queue = "crew.stream.%s" % cid
+        self.buffer_size = buffer_size
+        self.channel = None
+        self.received = 0
+
+        self._items = deque()
+        self._waiter = None
+        self._finished = False
+        self._error = None
+
+    @tornado.gen.coroutine
+    def open(self, call):
+        try:
+            future = yield self.client.channel.open_channel()
+            self.channel = yield future
+            self.channel.add_on_close_callback(self._on_close)
+
+            future = Future()
+            self.channel.basic_qos(lambda *a: future.set_result(a), prefetch_count=self.buffer_size)
+            yield future
+
+            future = Future()
+            self.channel.queue_declare(
+                lambda *a: future.set_result(a), queue=self.queue,
+                exclusive=True, auto_delete=True, arguments={"x-message-ttl": 60000}
+            )
+            yield future
+
+            self.channel.basic_consume(self._on_message, queue=self.queue, no_ack=False)
+
+            # The reply queue must exist before the task is sent
+            call()
+        except Exception as e:
+            log.exception(e)
+            self._finish(e)
+
+    def __call__(self, body, headers=None):
+        # Dead letters and the results sent to the common queue
+        if isinstance(body, Exception):
+            self._finish(body)
+        else:
+            self._push(body, None)
+            self._finish()
+
+    def _on_message(self, channel, method, props, body):
+        headers = props.headers or {}
+
+        if headers.get('x-stream-end') and not body:
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            return self._finish()
+
+        try:
+            body = self.client.parse_body(body, props)
+        except Exception as e:
+            log.exception(e)
+            body = e
+
+        if 'x-stream-seq' not in headers:
+            # Not a generator, the whole result is the only item
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            return self(body)
+
+        if headers.get('x-stream-end'):
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            return self._finish(body if isinstance(body, Exception) else None)
+
+        if headers['x-stream-seq'] != self.received:
+            log.warning('Stream %s chunk #%s received instead of #%d', self.cid, headers['x-stream-seq'], self.received)
+
+        self.received += 1
+        self._push(body, method.delivery_tag)
+
+    def _on_close(self, channel, code, reason):
+        # The chunks not taken yet are redelivered to nobody, the queue is gone with the channel
+        self._finish(ConnectionError('Stream channel was closed: ({0}) {1}'.format(code, reason)))
+
+    def _push(self, body, tag):
+        self._items.append((body, tag))
+        self._wakeup()
+
+    def _finish(self, error=None):
+        if self._finished:
+            return
+
+        self._finished = True
+        self._error = error
+        self.client.callbacks_hash.pop(self.cid, None)
+        self._wakeup()
+
+        if self.channel is not None and not self._items:
+            self.close()
+
+    def _wakeup(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def close(self):
+        if self.channel is not None and self.channel.is_open:
+            # The queue is deleted along with its only consumer
+            self.channel.close()
+
+    @property
+    def finished(self):
+        return self._finished and not self._items
+
+    @tornado.gen.coroutine
+    def next(self):
+        while not self._items:
+            if self._finished:
+                self.close()
+
+                if self._error is not None:
+                    raise self._error
+
+                raise StopAsyncIteration()
+
+            self._waiter = Future()
+            yield self._waiter
+
+        body, tag = self._items.popleft()
+
+        if tag is not None and self.channel.is_open:
+            # Frees the place for the next chunk
+            self.channel.basic_ack(delivery_tag=tag)
+
+        raise tornado.gen.Return(body)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.next()
+
+
+__all__ = ("Stream",)
@@ -0,0 +1,90 @@
+# encoding: utf-8
+from collections import OrderedDict
+
+import tornado.gen
+from tornado.concurrent import Future
+
+
+class Topology(object):
+    """ Exchanges, queues, bindings and consumers declared on the channel.
+
+    Every entity is kept once under its identity: declaring it again replaces
+    the arguments, unbinding and cancelling remove it. After a reconnect only
+    this net state is declared, so it doesn't grow with the subscriptions
+    coming and going.
+    """
+
+    def __init__(self):
+        self.exchanges = OrderedDict()
+        self.queues = OrderedDict()
+        self.bindings = OrderedDict()
+        self.consumers = OrderedDict()
+
+    def __len__(self):
+        return len(self.exchanges) + len(self.queues) + len(self.bindings) + len(self.consumers)
+
+    @staticmethod
+    def _binding(queue, exchange, routing_key, arguments):
+        return queue, exchange, routing_key, tuple(sorted((k, repr(v)) for k, v in (arguments or {}).items()))
+
+    def declare_exchange(self, exchange, **kwargs):
+        if not kwargs.get('passive'):
+            self.exchanges[exchange] = kwargs
+
+    def declare_queue(self, queue, **kwargs):
+        # The names given by the broker are not restored
+        if queue and not kwargs.get('passive'):
+            self.queues[queue] = kwargs
+
+    def bind(self, queue, exchange, routing_key=None, arguments=None):
+        self.bindings[self._binding(queue, exchange, routing_key, arguments)] = dict(
+            queue=queue, exchange=exchange, routing_key=routing_key, arguments=arguments
+        )
+
+    def unbind(self, queue, exchange, routing_key=None, arguments=None):
+        self.bindings.pop(self._binding(queue, exchange, routing_key, arguments), None)
+
+    def consume(self, consumer_tag, queue, callback):
+        self.consumers[consumer_tag] = (queue, callback)
+
+    def cancel(self, consumer_tag):
+        self.consumers.pop(consumer_tag, None)
+
+    @tornado.gen.coroutine
+    def replay(self, channel):
+        """ Declares everything on the fresh channel.
+
+        The broker handles the methods of a channel in order, so they are sent
+        without waiting for the replies, and only the reply of the last one is
+        waited for before the consumers are started.
+        """
+        methods = [
+            (channel.exchange_declare, dict(kwargs, exchange=exchange))
+            for exchange, kwargs in self.exchanges.items()
+        ]
+        methods.extend((channel.queue_declare, dict(kwargs, queue=queue)) for queue, kwargs in self.queues.items())
+        methods.extend((channel.queue_bind, dict(kwargs)) for kwargs in self.bindings.values())
+
+        for method, kwargs in methods[:-1]:
+            method(None, nowait=True, **kwargs)
+
+        if methods:
+            future = Future()
+            method, kwargs = methods[-1]
+            method(lambda *a: future.set_result(a), **kwargs)
+            yield future
+
+        for consumer_tag, (queue, callback) in self.consumers.items():
+            channel.basic_consume(callback, queue=queue, no_ack=False, consumer_tag=consumer_tag)
+
+    @property
+    def stats(self):
+        return {
+            'exchanges': len(self.exchanges),
+            'queues': len(self.queues),
+            'bindings': len(self.bindings),
+            'consumers': len(self.consumers),
+        }
+
+
+__all__ = ("Topology",)
@@ -0,0 +1,237 @@
+# encoding: utf-8
+import logging
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import time
+from collections import deque
+
+from .exceptions import ExpirationError, PublishError
+
+log = logging.getLogger(__name__)
+
+
+class Journal(object):
+    """ Append-only memory-mapped file of the pickled records.
+
+    It's read from the beginning while the records are appended to the end,
+    and it's truncated once everything is read. The journal lives as long as
+    the process, it isn't replayed after a restart.
+    """
+
+    LENGTH = struct.Struct('!I')
+    CHUNK = 16 * 1024 * 1024
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(tempfile.gettempdir(), 'crew-outbox')
+
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+
+        fd, self.filename = tempfile.mkstemp(prefix='outbox-', suffix='.journal', dir=self.path)
+        self._file = os.fdopen(fd, 'r+b')
+        self._map = None
+        self._size = 0
+        self._read = 0
+        self._write = 0
+
+    def __len__(self):
+        return self._write - self._read
+
+    def append(self, record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        start = self._write + self.LENGTH.size
+        end = start + len(data)
+
+        if end > self._size:
+            self._grow(end)
+
+        self.LENGTH.pack_into(self._map, self._write, len(data))
+        self._map[start:end] = data
+        self._write = end
+
+    def popleft(self):
+        if self._read >= self._write:
+            raise IndexError('pop from an empty journal')
+
+        length, = self.LENGTH.unpack_from(self._map, self._read)
+        start = self._read + self.LENGTH.size
+        record = pickle.loads(self._map[start:start + length])
+        self._read = start + length
+
+        if self._read == self._write:
+            self._truncate()
+
+        return record
+
+    def _grow(self, end):
+        size = max(self._size * 2, self.CHUNK)
+        while size < end:
+            size *= 2
+
+        if self._map is not None:
+            self._map.close()
+
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._size = size
+
+    def _truncate(self):
+        # Gives the disk space back
+        self._map.close()
+        self._map = None
+        self._file.truncate(0)
+        self._size = self._read = self._write = 0
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        self._file.close()
+
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+
+
+class Outbox(object):
+    """ Messages waiting for the channel, published in order when it's open.
+
+    It holds up to ``maxsize`` messages and ``max_bytes`` of their bodies.
+    When it's full the ``policy`` decides: ``reject`` fails the new message,
+    ``drop`` fails the oldest ones, and ``spill`` appends the new ones to a
+    journal in the ``path`` directory until the outbox is drained. Messages
+    whose ``expiration`` has passed are dropped instead of being published.
+
+    The items are the futures of the publishers (or ``None``) and the
+    arguments of ``basic_publish``.
+    """
+
+    POLICIES = ('reject', 'drop', 'spill')
+
+    def __init__(self, maxsize=100000, max_bytes=256 * 1024 * 1024, policy='reject', path=None):
+        assert policy in self.POLICIES
+        assert maxsize > 0
+
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.path = path
+
+        self._messages = deque()
+        self._bytes = 0
+        self._journal = None
+        self._spilled = deque()
+
+        self.rejected = 0
+        self.dropped = 0
+        self.expired = 0
+        self.spilled = 0
+
+    def __len__(self):
+        return len(self._messages) + len(self._spilled)
+
+    def __bool__(self):
+        return bool(self._messages or self._spilled)
+
+    __nonzero__ = __bool__
+
+    def _full(self, size):
+        return bool(self._messages) and (
+            len(self._messages) >= self.maxsize or
+            (self.max_bytes is not None and self._bytes + size > self.max_bytes)
+        )
+
+    def append(self, future, kwargs):
+        """ Returns ``False`` when the message is rejected, its future is failed then """
+        size = len(kwargs['body'])
+        deadline = self._deadline(kwargs.get('properties'))
+
+        if self._spilled or (self.policy == 'spill' and self._full(size)):
+            # Once spilled, the messages go to the journal until it's drained, it keeps them in order
+            if self._journal is None:
+                self._journal = Journal(self.path)
+
+            kwargs = dict(kwargs, body=bytes(kwargs['body']))
+            self._journal.append((kwargs, deadline))
+            self._spilled.append(future)
+            self.spilled += 1
+            return True
+
+        if self._full(size):
+            if self.policy == 'reject':
+                self.rejected += 1
+                self._fail(future, PublishError('Outbox is full'))
+                return False
+
+            while self._full(size):
+                dropped, old, _ = self._messages.popleft()
+                self._bytes -= len(old['body'])
+                self.dropped += 1
+                self._fail(dropped, PublishError('Message was dropped from the full outbox'))
+
+        self._messages.append((future, kwargs, deadline))
+        self._bytes += size
+        return True
+
+    def popleft(self):
+        """ The oldest message which is not expired yet """
+        now = time.time()
+
+        while True:
+            if self._messages:
+                future, kwargs, deadline = self._messages.popleft()
+                self._bytes -= len(kwargs['body'])
+            elif self._spilled:
+                future = self._spilled.popleft()
+                kwargs, deadline = self._journal.popleft()
+            else:
+                raise IndexError('pop from an empty outbox')
+
+            if deadline is None or deadline > now:
+                return future, kwargs
+
+            self.expired += 1
+            self._fail(future, ExpirationError('Message expired in the outbox'))
+
+    @staticmethod
+    def _deadline(properties):
+        expiration = getattr(properties, 'expiration', None)
+        if not expiration:
+            return None
+
+        return time.time() + int(expiration) / 1000.0
+
+    @staticmethod
+    def _fail(future, exc):
+        if future is not None and not future.done():
+            future.set_exception(exc)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    @property
+    def stats(self):
+        return {
+            'policy': self.policy,
+            'messages': len(self),
+            'bytes': self._bytes,
+            'spilled_bytes': len(self._journal) if self._journal is not None else 0,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'expired': self.expired,
+            'spilled': self.spilled,
+        }
+
+
+__all__ = ("Outbox", "Journal")
@@ -0,0 +1,105 @@
+# encoding: utf-8
+import logging
+import threading
+import time
+from heapq import heappush, heappop, heapify
+from itertools import count
+
+
+log = logging.getLogger(__name__)
+
+
+class TimerHandle(object):
+
+    def __init__(self, timer, deadline, callback):
+        self.timer = timer
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.timer._cancel(self)
+
+
+class Timer(object):
+    """ One thread firing the callbacks at their deadlines """
+
+    def __init__(self):
+        self._heap = list()
+        self._cancelled = 0
+        self._counter = count()
+        self._condition = threading.Condition()
+        self._active = True
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def call_at(self, deadline, callback):
+        handle = TimerHandle(self, deadline, callback)
+
+        with self._condition:
+            heappush(self._heap, (deadline, next(self._counter), handle))
+            if self._heap[0][2] is handle:
+                self._condition.notify()
+
+        return handle
+
+    def call_later(self, delay, callback):
+        return self.call_at(time.time() + delay, callback)
+
+    def _cancel(self, handle):
+        with self._condition:
+            if handle.cancelled:
+                return
+
+            handle.cancelled = True
+            self._cancelled += 1
+
+            # Don't let finished tasks hold their entries until the deadline
+            if self._cancelled * 2 > len(self._heap):
+                self._heap = [item for item in self._heap if not item[2].cancelled]
+                heapify(self._heap)
+                self._cancelled = 0
+
+    def _next(self):
+        with self._condition:
+            while self._active:
+                while self._heap and self._heap[0][2].cancelled:
+                    heappop(self._heap)
+                    self._cancelled -= 1
+
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                handle = heappop(self._heap)[2]
+                handle.cancelled = True
+                return handle
+
+    def _run(self):
+        while self._active:
+            handle = self._next()
+            if handle is None:
+                return
+
+            try:
+                handle.callback()
+            except Exception as e:
+                log.exception(e)
+
+    def close(self):
+        with self._condition:
+            self._active = False
+            self._condition.notify()
+
+
+__all__ = ("Timer",)
@@ -3,3 +3,4 @@ from .listener import Listener
 from .run import run, NODE_UUID, UUID
 from .context import Context, context
 from .task import Task
+from ..cache import LRU
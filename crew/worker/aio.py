@@ -0,0 +1,325 @@
+# encoding: utf-8
+import asyncio
+import inspect
+import logging
+import time
+import traceback
+import types
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from .context import context
+from .listener import Listener, cache_channel
+from ..compression import CompressionPolicy
+from .pubsub import PubSub
+from ..exceptions import TimeoutError, ConnectionError
+
+log = logging.getLogger(__name__)
+
+
+def call_sync(worker, delivery, body):
+    context.headers = delivery.headers
+
+    try:
+        return worker(body)
+    finally:
+        delivery.headers = context.headers
+
+
+class AsyncPubSub(PubSub):
+
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+
+    def schedule(self, func):
+        # Synchronous handlers are running in the executor threads
+        self.connection.loop.call_soon_threadsafe(func)
+
+
+class AsyncListener(Listener):
+    """ Listener running the handlers on the asyncio event loop.
+
+    Coroutine handlers are awaited on the loop, so thousands of them may
+    be in flight at once. Plain functions are run in the default executor.
+    """
+
+    def __init__(self, handlers, host='localhost', port=5672, set_context=None, concurrency=1024,
+                 io_loop=None, compression=None, blob_store=None, **kwargs):
+        assert isinstance(port, int)
+        assert isinstance(concurrency, int) and concurrency > 0
+
+        self._handlers = handlers
+
+        for queue in handlers:
+            task = context.tasks.get(queue)
+            if task is not None and task.executor == 'process':
+                raise ValueError('Task "{0}" needs the process executor, which is not available '
+                                 'in the asyncio mode'.format(queue))
+
+        self._tasks = set()
+        self._parameters = pika.ConnectionParameters(host=host, port=port, **kwargs)
+        self.io_loop = io_loop or asyncio.get_event_loop()
+        self.context = set_context
+        self.concurrency = concurrency
+        self.compression = compression or CompressionPolicy()
+        self.blob_store = blob_store
+        self.caches = self.create_caches()
+        self.batches = {}
+        self.connection = None
+        self.channel = None
+        self.closed = None
+
+    def _callback(self):
+        future = self.io_loop.create_future()
+
+        def callback(result=None, *args):
+            if not future.done():
+                future.set_result(result)
+
+        return future, callback
+
+    async def connect(self):
+        opened, callback = self._callback()
+        self.closed = self.io_loop.create_future()
+
+        self.connection = AsyncioConnection(
+            self._parameters,
+            on_open_callback=callback,
+            on_open_error_callback=lambda *a: opened.set_exception(ConnectionError(a)),
+            on_close_callback=self._on_close,
+            custom_ioloop=self.io_loop,
+        )
+        await opened
+
+        future, callback = self._callback()
+        self.connection.channel(on_open_callback=callback)
+        self.channel = await future
+
+        # The timeouts of the batches are run by the connection
+        self.batches = self.create_batches()
+
+        future, callback = self._callback()
+        self.channel.basic_qos(
+            callback=callback, prefetch_count=max([self.concurrency] + [b.size for b in self.batches.values()])
+        )
+        await future
+
+        future, callback = self._callback()
+        pubsub_channel = self.connection.channel(on_open_callback=callback)
+        await future
+
+        future, callback = self._callback()
+        pubsub_channel.exchange_declare(callback, exchange='pubsub', exchange_type='fanout', durable=True)
+        await future
+
+        context.pubsub = AsyncPubSub(self.connection, pubsub_channel)
+
+        if self.caches:
+            await self.subscribe_invalidation()
+
+        for queue, handler in self._handlers.items():
+            if isinstance(handler, tuple):
+                handler, args = handler
+            else:
+                args = {}
+
+            future, callback = self._callback()
+            self.channel.queue_declare(
+                callback,
+                queue=queue,
+                arguments={
+                    "x-dead-letter-exchange": "crew.DLX",
+                    "x-message-ttl": 600000,  # 10 minutes
+                },
+                auto_delete=False
+            )
+            await future
+
+            self.channel.basic_consume(self.on_request, queue=queue, **args)
+
+    async def subscribe_invalidation(self):
+        future, callback = self._callback()
+        self.channel.exchange_declare(callback, exchange="crew.PUBSUB", exchange_type="headers", auto_delete=True)
+        await future
+
+        future, callback = self._callback()
+        self.channel.queue_declare(callback, queue='', exclusive=True, auto_delete=True)
+        queue = (await future).method.queue
+
+        for name in self.caches:
+            future, callback = self._callback()
+            self.channel.queue_bind(
+                callback, queue=queue, exchange="crew.PUBSUB", arguments={"x-channel-name": cache_channel(name)}
+            )
+            await future
+
+        self.channel.basic_consume(self.on_invalidate, queue=queue, no_ack=True)
+
+    def _on_close(self, connection, code, reason):
+        log.error('Connection closed: (%s) %s', code, reason)
+        if not self.closed.done():
+            self.closed.set_exception(ConnectionError(code, reason))
+
+    def submit(self, delivery):
+        batch = self.batches.get(delivery.routing_key)
+        if batch is not None and delivery.upload is None:
+            return batch.add(delivery)
+
+        self._spawn(self.execute(delivery))
+
+    def submit_batch(self, deliveries):
+        self._spawn(self.execute_batch(deliveries))
+
+    def _spawn(self, coro):
+        task = self.io_loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def execute(self, delivery):
+        timeout = (delivery.timestamp + delivery.expiration) - time.time()
+
+        try:
+            result = await asyncio.wait_for(self.process(delivery), timeout)
+        except asyncio.TimeoutError:
+            log.error('Task "%s" cancelled by timeout', delivery.w_name)
+            result = TimeoutError('Function lasted longer than {0} seconds'.format(int(timeout)))
+        except Exception as e:
+            result = e
+
+        self.finish(delivery, result)
+
+    async def execute_batch(self, deliveries):
+        timeout = min(delivery.timestamp + delivery.expiration for delivery in deliveries) - time.time()
+
+        try:
+            results = await asyncio.wait_for(self.handle_batch(deliveries), timeout)
+        except asyncio.TimeoutError:
+            log.error('Batch of "%s" cancelled by timeout', deliveries[0].routing_key)
+            results = TimeoutError('Function lasted longer than {0} seconds'.format(int(timeout)))
+        except Exception as e:
+            results = e
+
+        self.finish_batch(deliveries, results)
+
+    async def handle_batch(self, deliveries):
+        worker = self.get_worker(deliveries[0])
+
+        if not asyncio.iscoroutinefunction(worker):
+            return await self.io_loop.run_in_executor(None, self.process_batch, deliveries)
+
+        results, indexes, bodies = self.batch_bodies(deliveries)
+        if not bodies:
+            return results
+
+        context.headers = {}
+
+        try:
+            replies = self.batch_replies(await worker(bodies), bodies)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.debug(traceback.format_exc())
+            log.error('Task error: {0}'.format(str(e)))
+            replies = [e] * len(bodies)
+
+        return self.batch_results(deliveries, results, indexes, replies)
+
+    async def process(self, delivery):
+        if delivery.upload is not None:
+            # The handler waits for the chunks, so it runs in a thread
+            return await self.io_loop.run_in_executor(None, self.process_upload, delivery)
+
+        try:
+            body = delivery.deserializer(delivery.body)
+        except Exception as e:
+            log.info(traceback.format_exc())
+            log.critical(repr(e))
+            return e
+
+        result = await self.handle(delivery, body)
+
+        if inspect.isasyncgen(result):
+            return await self.stream_async(delivery, result)
+
+        if isinstance(result, types.GeneratorType):
+            return await self.io_loop.run_in_executor(None, self.stream, delivery, result)
+
+        return result
+
+    def process_upload(self, delivery):
+        worker = self.get_worker(delivery)
+        if asyncio.iscoroutinefunction(worker) or inspect.isasyncgenfunction(worker):
+            return TypeError('Task "{0}" is a coroutine, uploads are served by plain functions'.format(
+                delivery.w_name))
+
+        result = Listener.handle(self, delivery, delivery.upload)
+
+        if isinstance(result, types.GeneratorType):
+            return self.stream(delivery, result)
+
+        return result
+
+    async def stream_async(self, delivery, items):
+        delivery.stream = True
+
+        try:
+            async for item in items:
+                self.send_chunk(delivery, item)
+                # Gives the connection a chance to write the chunk out
+                await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.debug(traceback.format_exc())
+            log.error('Task error: {0}'.format(str(e)))
+            return e
+
+    async def handle(self, delivery, body):
+        worker = self.get_worker(delivery)
+
+        try:
+            if asyncio.iscoroutinefunction(worker):
+                context.headers = delivery.headers
+                try:
+                    return await worker(body)
+                finally:
+                    delivery.headers = context.headers
+
+            if inspect.isasyncgenfunction(worker):
+                context.headers = delivery.headers
+                return worker(body)
+
+            return await self.io_loop.run_in_executor(None, call_sync, worker, delivery, body)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.debug(traceback.format_exc())
+            log.error('Task error: {0}'.format(str(e)))
+            return e
+
+    @property
+    def stats(self):
+        return {
+            'tasks': len(self._tasks),
+            'batches': dict((queue, batch.stats) for queue, batch in self.batches.items()),
+            'caches': dict((queue, cache.stats) for queue, cache in self.caches.items()),
+            'compression': self.compression_stats,
+            'blobs': self.blob_store.stats if self.blob_store is not None else None,
+        }
+
+    def loop(self):
+        try:
+            self.io_loop.run_until_complete(self.connect())
+            self.io_loop.run_until_complete(self.closed)
+        except Exception as e:
+            log.error(traceback.format_exc())
+            log.fatal('FATAL ERROR: {0}'.format(e))
+            raise
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+
+
+__all__ = ("AsyncListener",)
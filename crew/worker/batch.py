@@ -0,0 +1,63 @@
+# encoding: utf-8
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class Batch(object):
+    """ Collects the deliveries of one task until the batch is full or the wait is over """
+
+    def __init__(self, connection, size, max_wait, callback):
+        assert isinstance(size, int) and size > 0
+        self.connection = connection
+        self.size = size
+        self.max_wait = max_wait
+        self.callback = callback
+        self.deliveries = list()
+        self._timeout = None
+
+        self.flushes = 0
+        self.items = 0
+
+    def __len__(self):
+        return len(self.deliveries)
+
+    def add(self, delivery):
+        self.deliveries.append(delivery)
+
+        if len(self.deliveries) >= self.size:
+            self.flush()
+        elif self._timeout is None:
+            self._timeout = self.connection.add_timeout(self.max_wait, self._on_timeout)
+
+    def _on_timeout(self):
+        self._timeout = None
+        self.flush()
+
+    def flush(self):
+        if self._timeout is not None:
+            self.connection.remove_timeout(self._timeout)
+            self._timeout = None
+
+        if not self.deliveries:
+            return
+
+        deliveries, self.deliveries = self.deliveries, list()
+        self.flushes += 1
+        self.items += len(deliveries)
+
+        log.debug('Flushing batch of %d deliveries', len(deliveries))
+        self.callback(deliveries)
+
+    @property
+    def stats(self):
+        return {
+            'size': self.size,
+            'flushes': self.flushes,
+            'items': self.items,
+            'pending': len(self.deliveries),
+        }
+
+
+__all__ = ("Batch",)
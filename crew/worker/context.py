@@ -1,6 +1,12 @@
 import sys
+import threading
 import types
 
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
 
 class Context(object):
 
@@ -18,11 +24,27 @@ class UniqueDict(dict):
         super(UniqueDict, self).__setitem__(key, value)
 
 
+class LocalVar(object):
+    """ threading.local based fallback for contextvars.ContextVar """
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self._default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self._default)
+
+    def set(self, value):
+        self._local.value = value
+
+
 class ContextModule(types.ModuleType):
     _STORAGE = {
         's': None,
-        'h': None,
+        'h': (ContextVar or LocalVar)('crew.headers', default=None),
         'f': UniqueDict(),
+        't': UniqueDict(),
         'p': None,
     }
 
@@ -36,16 +58,20 @@ class ContextModule(types.ModuleType):
 
     @property
     def headers(self):
-        return self.__class__._STORAGE['h']
+        return self.__class__._STORAGE['h'].get()
 
     @headers.setter
     def headers(self, value):
-        self.__class__._STORAGE['h'] = value
+        self.__class__._STORAGE['h'].set(value)
 
     @property
     def handlers(self):
         return self.__class__._STORAGE['f']
 
+    @property
+    def tasks(self):
+        return self.__class__._STORAGE['t']
+
     @property
     def pubsub(self):
         return self.__class__._STORAGE['p']
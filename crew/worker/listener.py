@@ -1,45 +1,116 @@
 # encoding: utf-8
-import json
 import logging
+import threading
 import traceback
 import time
-import zlib
+import types
 import pika
-import sys
+from functools import partial
 
-from .thread import KillableThread
+from .batch import Batch
+from .pool import ThreadPool
+from .process import ProcessPool, Serialized
+from .upload import Upload
 from .pubsub import PubSub
-
-if sys.version_info >= (3,):
-    import pickle
-else:
-    import cPickle as pickle
-
 from .context import context
-from ..exceptions import TimeoutError, ExpirationError
+from .. import codecs, blobstore
+from ..cache import LRU
+from ..compression import CompressionPolicy
+from ..timer import Timer
+from ..exceptions import ExpirationError
 
 log = logging.getLogger(__name__)
 
 
-def thread_inner(func, results, *args):
-    try:
-        results.append(func(*args))
-    except Exception as e:
-        tb = traceback.format_exc()
-        log.debug(tb)
-        e._tb = tb
-        results.append(e)
+# Not available before Python 3.6
+ASYNC_GENERATOR = getattr(types, 'AsyncGeneratorType', ())
+
+
+def cache_channel(queue):
+    return "crew.cache.%s" % queue[len("crew.tasks."):]
+
+
+class Delivery(object):
+
+    def __init__(self, method, props, body):
+        self.content_type = getattr(props, 'content_type', 'text/plain')
+        self.content_encoding = getattr(props, 'content_encoding', 'plain')
+        self.cid = props.correlation_id
+        self.dst = props.reply_to
+        self.timestamp = int(getattr(props, 'timestamp')) if getattr(props, 'timestamp') else int(time.time())
+        self.expiration = (int(getattr(props, 'expiration')) if getattr(props, 'expiration') else 86400000) / 1000
+        self.start = time.time()
+        self.delivery_tag = method.delivery_tag
+        self.routing_key = method.routing_key
+        self.headers = getattr(props, 'headers', None) or {}
+        self.body = body
+        self.w_name = None
+        self.cache_key = None
+        self.request_headers = None
+        self.blob = None
+        self.stream = False
+        self.seq = 0
+        self.upload = None
+
+    def __getstate__(self):
+        # Body is passed to the other processes separately
+        state = self.__dict__.copy()
+        state['body'] = None
+        return state
+
+    @property
+    def codec(self):
+        return codecs.resolve(self.content_type, self.content_encoding)
+
+    @property
+    def reply_codec(self):
+        # Replies are compressed by the policy, regardless of the request encoding
+        return codecs.resolve(self.content_type)
+
+    @property
+    def serializer(self):
+        return self.reply_codec.dumps
+
+    @property
+    def deserializer(self):
+        return self.codec.loads
 
 
 class Listener(object):
+    # Chunks of a streamed result produced ahead of the connection
+    STREAM_WINDOW = 16
 
-    def __init__(self, handlers, host='localhost', port=5672, set_context=None, **kwargs):
+    def __init__(self, handlers, host='localhost', port=5672, set_context=None, concurrency=1, compression=None,
+                 blob_store=None, **kwargs):
         assert isinstance(port, int)
+        assert isinstance(concurrency, int) and concurrency > 0
+
         self._handlers = handlers
+        self.context = set_context
+        self.concurrency = concurrency
+        self.compression = compression or CompressionPolicy()
+        self.blob_store = blob_store
+
+        # Forking before the connection and the threads are started
+        self.executors = self.create_executors()
+
         self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=port, **kwargs))
         self.channel = self.connection.channel()
-        self.channel.basic_qos(prefetch_count=1)
-        self.context = set_context
+        self.timer = Timer()
+        self.pool = ThreadPool(concurrency, timer=self.timer)
+
+        for executor in self.executors.values():
+            executor.timer = self.timer
+
+        self.batches = self.create_batches()
+        # Every subprocess of the pools is kept busy along with the threads
+        self.channel.basic_qos(prefetch_count=max([concurrency] + [b.size for b in self.batches.values()]) + sum(
+            executor.size for executor in self.executors.values()
+        ))
+
+        self.caches = self.create_caches()
+        if self.caches:
+            self.subscribe_invalidation()
 
         context.pubsub = PubSub(self.connection)
 
@@ -60,163 +131,399 @@ class Listener(object):
 
             self.channel.basic_consume(self.on_request, queue=queue, **args)
 
-    def get_worker(self, key):
-        worker = self._handlers[key]
-        self.w_name = worker.__name__
+    def create_executors(self):
+        executors = {}
+
+        for queue in self._handlers:
+            task = context.tasks.get(queue)
+            if task is not None and task.executor == 'process':
+                log.info('Starting %d processes for "%s"', task.workers, queue)
+                executors[queue] = ProcessPool(task.workers, settings=self.context)
+
+        return executors
+
+    def create_batches(self):
+        batches = {}
+
+        for queue in self._handlers:
+            task = context.tasks.get(queue)
+            if task is not None and task.batch_size:
+                batches[queue] = Batch(
+                    self.connection, task.batch_size, task.max_wait_ms / 1000., self.submit_batch
+                )
+
+        return batches
+
+    def get_compression(self, delivery):
+        task = context.tasks.get(delivery.routing_key)
+        if task is not None and task.compression is not None:
+            return task.compression
+
+        return self.compression
+
+    def create_caches(self):
+        caches = {}
+
+        for queue in self._handlers:
+            task = context.tasks.get(queue)
+            if task is not None and task.cache is not None:
+                caches[queue] = task.cache
+
+        return caches
+
+    def subscribe_invalidation(self):
+        self.channel.exchange_declare(exchange="crew.PUBSUB", exchange_type="headers", auto_delete=True)
+        queue = self.channel.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+
+        for name in self.caches:
+            self.channel.queue_bind(
+                queue=queue, exchange="crew.PUBSUB", arguments={"x-channel-name": cache_channel(name)}
+            )
+
+        self.channel.basic_consume(self.on_invalidate, queue=queue, no_ack=True)
+
+    def on_invalidate(self, channel, method, props, body):
+        delivery = Delivery(method, props, body)
+        name = delivery.headers.get('x-channel-name', '')
+        cache = self.caches.get(name.replace("crew.cache.", "crew.tasks.", 1))
+
+        if cache is None:
+            return
+
+        try:
+            key = delivery.deserializer(body)
+        except Exception as e:
+            log.exception(e)
+            return
+
+        log.info('Invalidating cache of "%s" for %s', name, key or 'all keys')
+        cache.invalidate(key)
+
+    def lookup(self, delivery):
+        cache = self.caches.get(delivery.routing_key)
+        if cache is None:
+            return None
+
+        delivery.cache_key = LRU.key(delivery.content_type, delivery.content_encoding, delivery.body)
+        delivery.headers['x-cache-key'] = delivery.cache_key
+
+        cached = cache.get(delivery.cache_key)
+        if cached is None:
+            delivery.request_headers = dict(delivery.headers)
+            return None
+
+        reply, headers = cached
+        delivery.headers.update(headers)
+        return reply
+
+    def remember(self, delivery, reply):
+        # Only the headers set by the handler are stored
+        headers = dict(
+            (key, value) for key, value in delivery.headers.items()
+            if key not in delivery.request_headers or delivery.request_headers[key] != value
+        )
+        self.caches[delivery.routing_key].set(delivery.cache_key, (reply, headers))
+
+    def get_worker(self, delivery):
+        worker = self._handlers[delivery.routing_key]
+        delivery.w_name = worker.__name__
         if hasattr(worker, 'im_self'):
-            self.w_name = worker.im_self.__name__
+            delivery.w_name = worker.im_self.__name__
         context.settings = self.context
         return worker
 
-    def set_env(self, props, method):
-        self.content_type = getattr(props, 'content_type', 'text/plain')
-        self.content_encoding = getattr(props, 'content_encoding', 'plain')
-        self.gzip = self.content_encoding == 'gzip'
-        self.cid = props.correlation_id
-        self.dst = props.reply_to
-        self.timestamp = int(getattr(props, 'timestamp')) if getattr(props, 'timestamp') else int(time.time())
-        self.expiration = (int(getattr(props, 'expiration')) if getattr(props, 'expiration') else 86400000) / 1000
-        self.start = time.time()
-        self.delivery_tag = method.delivery_tag
-        self.routing_key = method.routing_key
-        context.headers = getattr(props, 'headers', {})
-
-    def reset_env(self):
-        self.content_type = 'text/plain'
-        self.content_encoding = 'plain'
-        self.gzip = False
-        self.cid = None
-        self.dst = None
-        self.timestamp = 0
-        self.expiration = 0
-        self.delivery_tag = None
-        self.routing_key = None
-        context.headers = {}
+    def handle(self, delivery, body):
+        worker = self.get_worker(delivery)
+        context.headers = delivery.headers
 
-    def handle(self, body):
-        results = list()
-        thread = KillableThread(
-            target=thread_inner, args=(self.get_worker(self.routing_key), results, body))
-        timeout = (int((self.timestamp + self.expiration) - time.time()))
-        time_edge = time.time() + timeout
+        try:
+            res = worker(body)
+        except Exception as e:
+            log.debug(traceback.format_exc())
+            log.error('Task error: {0}'.format(str(e)))
+            res = e
+        finally:
+            delivery.headers = context.headers
 
-        thread.start()
+        return res
+
+    def process(self, delivery):
+        try:
+            body = delivery.upload if delivery.upload is not None else delivery.deserializer(delivery.body)
+        except Exception as e:
+            log.info(traceback.format_exc())
+            log.critical(repr(e))
+            return e
 
-        while time.time() < time_edge and not len(results):
-            time.sleep(0.001)
+        result = self.handle(delivery, body)
 
-        if not results:
-            thread.kill()
-            res = TimeoutError(
-                'Function lasted longer than {0} seconds'.format(timeout))
-            log.debug('Task finished.')
-        else:
-            res = results.pop(0)
-            if isinstance(res, Exception):
-                log.debug(res._tb)
-                log.error('Task error: {0}'.format(str(res)))
+        if isinstance(result, types.GeneratorType):
+            return self.stream(delivery, result)
 
-        return res
+        if isinstance(result, ASYNC_GENERATOR):
+            return TypeError('Task "{0}" is an asynchronous generator, run the worker with --mode asyncio'.format(
+                delivery.w_name))
+
+        return result
+
+    def stream(self, delivery, items):
+        """ Sends the items yielded by the handler as separate replies, the final reply closes the stream """
+        delivery.stream = True
+        window = threading.Semaphore(self.STREAM_WINDOW)
+
+        try:
+            for item in items:
+                window.acquire()
+                self.threadsafe(self.send_chunk, delivery, item, window.release)
+        except Exception as e:
+            log.debug(traceback.format_exc())
+            log.error('Task error: {0}'.format(str(e)))
+            return e
+
+    def send_chunk(self, delivery, item, release=None):
+        try:
+            self.reply(delivery, item, headers={'x-stream-seq': delivery.seq})
+            delivery.seq += 1
+        except Exception as e:
+            log.exception(e)
+        finally:
+            if release is not None:
+                release()
+
+    def process_batch(self, deliveries):
+        results, indexes, bodies = self.batch_bodies(deliveries)
+        if not bodies:
+            return results
+
+        worker = self.get_worker(deliveries[0])
+        context.headers = {}
+
+        try:
+            replies = self.batch_replies(worker(bodies), bodies)
+        except Exception as e:
+            log.debug(traceback.format_exc())
+            log.error('Task error: {0}'.format(str(e)))
+            replies = [e] * len(bodies)
+
+        return self.batch_results(deliveries, results, indexes, replies)
+
+    @staticmethod
+    def batch_bodies(deliveries):
+        results = [None] * len(deliveries)
+        indexes, bodies = list(), list()
+
+        for index, delivery in enumerate(deliveries):
+            try:
+                bodies.append(delivery.deserializer(delivery.body))
+                indexes.append(index)
+            except Exception as e:
+                log.info(traceback.format_exc())
+                log.critical(repr(e))
+                results[index] = e
+
+        return results, indexes, bodies
+
+    @staticmethod
+    def batch_replies(replies, bodies):
+        replies = list(replies)
+        if len(replies) != len(bodies):
+            raise ValueError('Batch handler returned {0} results for {1} requests'.format(len(replies), len(bodies)))
+
+        return replies
+
+    @staticmethod
+    def batch_results(deliveries, results, indexes, replies):
+        headers = context.headers or {}
+
+        for index, reply in zip(indexes, replies):
+            results[index] = reply
+            deliveries[index].w_name = deliveries[0].w_name
+            deliveries[index].headers.update(headers)
+
+        return results
+
+    def claim(self, delivery):
+        key = delivery.headers.pop(blobstore.HEADER, None)
+        if key is None:
+            return
+
+        if self.blob_store is None:
+            raise LookupError('Body is stored in the blob {0}, but the blob store is not configured'.format(key))
+
+        delivery.blob = key
+        delivery.body = self.blob_store.get(key)
 
     def on_request(self, channel, method, props, body):
+        delivery = Delivery(method, props, body)
+
         try:
-            self.set_env(props, method)
+            self.claim(delivery)
+        except Exception as e:
+            log.error('Failed to load the request body: %r', e)
+            return self.finish(delivery, e)
+
+        if delivery.timestamp + delivery.expiration < delivery.start:
+            log.error('Rejecting task because this expired of %.3f sec' % (
+                delivery.start - (delivery.timestamp + delivery.expiration)))
+            return self.finish(delivery, ExpirationError("Task now expired"))
+
+        log.info('Got "{2}" call request with content type "{0}" and length {1} bytes.'.format(
+            delivery.content_type, len(delivery.body) if delivery.body else 0, delivery.routing_key))
+
+        upload = delivery.headers.pop('x-upload-queue', None)
+        if upload is not None:
+            # The input is coming in chunks, the handler consumes them in a thread
+            delivery.upload = Upload(self, upload, delivery.timestamp + delivery.expiration)
+            delivery.upload.start(self.channel)
+            return self.submit(delivery)
+
+        cached = self.lookup(delivery)
+        if cached is not None:
+            self.get_worker(delivery)
+            log.debug('Reply for "%s" found in the cache', delivery.routing_key)
+            return self.finish(delivery, cached)
+
+        self.submit(delivery)
+
+    def submit(self, delivery):
+        callback = partial(self.threadsafe, self.finish, delivery)
+        deadline = delivery.timestamp + delivery.expiration
+        executor = self.executors.get(delivery.routing_key)
+
+        if executor is not None and delivery.upload is None:
+            self.get_worker(delivery)
+            return executor.submit(delivery, callback, deadline=deadline)
+
+        batch = self.batches.get(delivery.routing_key)
+        if batch is not None and delivery.upload is None:
+            return batch.add(delivery)
+
+        self.pool.submit(partial(self.process, delivery), callback, deadline=deadline)
+
+    def submit_batch(self, deliveries):
+        self.pool.submit(
+            partial(self.process_batch, deliveries),
+            partial(self.threadsafe, self.finish_batch, deliveries),
+            deadline=min(delivery.timestamp + delivery.expiration for delivery in deliveries),
+        )
+
+    def finish_batch(self, deliveries, results):
+        if isinstance(results, Exception):
+            results = [results] * len(deliveries)
 
-            if self.timestamp + self.expiration < self.start:
-                log.error('Rejecting task because this expired of %.3f sec' % (
-                    self.start - (self.timestamp + self.expiration)))
-                return self.reply(ExpirationError("Task now expired"))
+        for delivery, result in zip(deliveries, results):
+            self.finish(delivery, result)
 
-            log.info('Got "{2}" call request with content type "{0}" and length {1} bytes.'.format(
-                self.content_type, len(body) if body else 0, method.routing_key))
+    def threadsafe(self, func, *args):
+        self.connection.add_callback_threadsafe(partial(func, *args))
 
-            body = self.deserializer(body)
+    def finish(self, delivery, result):
+        headers = {'x-stream-seq': delivery.seq, 'x-stream-end': True} if delivery.stream else None
 
-            self.reply(self.handle(body))
+        try:
+            if delivery.stream and not isinstance(result, Exception):
+                self.end_stream(delivery, headers)
+                return
+
+            reply = self.reply(delivery, result, headers=headers)
+
+            if delivery.request_headers is not None and reply is not None and not isinstance(result, Exception) \
+                    and not delivery.stream:
+                self.remember(delivery, reply)
         except Exception as e:
             log.info(traceback.format_exc())
             log.critical(repr(e))
-            self.reply(e)
+            # Errors can't be encoded by every codec (e.g. binary), pickle is understood by all the clients
+            self.reply(delivery, result if isinstance(result, Exception) else e, codecs.get('pickle'), headers)
         finally:
-            self.channel.basic_ack(delivery_tag=method.delivery_tag)
-            self.reset_env()
+            self.channel.basic_ack(delivery_tag=delivery.delivery_tag)
 
-    def reply(self, data):
-        if self.cid is None:
-            log.info("Correlation id not presented, skip answering.")
+            if delivery.blob is not None:
+                self.blob_store.delete(delivery.blob)
+
+            if delivery.upload is not None:
+                delivery.upload.stop(self.channel)
+
+    def end_stream(self, delivery, headers):
+        """ The end of the stream is marked by the headers, the codec of the items may not encode ``None`` """
+        if delivery.cid is None:
             return
-        body = self.serializer(data)
+
         self.channel.basic_publish(
             exchange='',
-            routing_key=str(self.dst),
+            routing_key=str(delivery.dst),
             properties=pika.BasicProperties(
-                correlation_id=self.cid,
-                content_type=self.content_type,
-                headers=context.headers,
-                content_encoding=self.content_encoding,
+                correlation_id=delivery.cid,
+                headers=dict(delivery.headers, **headers),
+                content_encoding='plain',
                 timestamp=time.time(),
-                expiration=str(self.expiration * 1000)
+                expiration=str(delivery.expiration * 1000)
             ),
-            body=body
+            body=b''
         )
-        log.info('Handle "%s" for %06f sec. Length of response: %s' % (
-            self.w_name, time.time() - self.start, len(body) if body else str(body)))
-
-    @property
-    def serializer(self):
-        def pickle_encoder(obj):
-            return pickle.dumps(obj, protocol=2)
-
-        def json_encoder(obj):
-            return json.dumps(obj)
 
-        def compressor(func):
-            def wrap(obj):
-                return zlib.compress(func(obj))
-            return wrap
+    def reply(self, delivery, data, serializer=None, headers=None):
+        if delivery.cid is None:
+            log.info("Correlation id not presented, skip answering.")
+            return
 
-        def text_encoder(obj):
-            return str(obj).encode('utf-8')
+        serializer = serializer or delivery.reply_codec
 
-        if 'application/python-pickle' in self.content_type:
-            dumper = pickle_encoder
-        elif 'application/json' in self.content_type:
-            dumper = json_encoder
+        if isinstance(data, Serialized):
+            body, encoding = data.body, data.encoding
         else:
-            dumper = text_encoder
+            body, encoding = serializer.dumps(data), 'plain'
 
-        if self.gzip:
-            dumper = compressor(dumper)
+        if encoding == 'plain':
+            body, encoding = self.get_compression(delivery).compress(body)
 
-        return dumper
+        headers = dict(delivery.headers, **headers) if headers else delivery.headers
+        payload = body
 
-    @property
-    def deserializer(self):
-        def pickle_loader(obj):
-            return pickle.loads(obj)
+        if self.blob_store is not None and self.blob_store.accepts(body):
+            headers = dict(headers)
+            headers[blobstore.HEADER] = self.blob_store.put(body, delivery.expiration)
+            payload = b''
 
-        def json_loader(obj):
-            return json.loads(obj)
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=str(delivery.dst),
+            properties=pika.BasicProperties(
+                correlation_id=delivery.cid,
+                content_type=serializer.content_type,
+                headers=headers,
+                content_encoding=encoding,
+                timestamp=time.time(),
+                expiration=str(delivery.expiration * 1000)
+            ),
+            body=payload
+        )
+        log.info('Handle "%s" for %06f sec. Length of response: %s' % (
+            delivery.w_name, time.time() - delivery.start, len(body) if body else str(body)))
 
-        def decompress(func):
-            def wrap(obj):
-                return func(zlib.decompress(obj))
-            return wrap
+        return Serialized(body, encoding)
 
-        def text_loader(obj):
-            return str(obj).decode('utf-8')
+    @property
+    def stats(self):
+        return {
+            'pool': self.pool.stats,
+            'executors': dict((queue, executor.stats) for queue, executor in self.executors.items()),
+            'batches': dict((queue, batch.stats) for queue, batch in self.batches.items()),
+            'caches': dict((queue, cache.stats) for queue, cache in self.caches.items()),
+            'compression': self.compression_stats,
+            'blobs': self.blob_store.stats if self.blob_store is not None else None,
+        }
 
-        if 'application/python-pickle' in self.content_type:
-            loader = pickle_loader
-        elif 'application/json' in self.content_type:
-            loader = json_loader
-        else:
-            loader = text_loader
+    @property
+    def compression_stats(self):
+        stats = {'default': self.compression.stats}
 
-        if self.gzip:
-            loader = decompress(loader)
+        for queue in self._handlers:
+            task = context.tasks.get(queue)
+            if task is not None and task.compression is not None:
+                stats[queue] = task.compression.stats
 
-        return loader
+        return stats
 
     def loop(self):
         try:
@@ -225,6 +532,12 @@ class Listener(object):
             log.error(traceback.format_exc())
             log.fatal('FATAL ERROR: {0}'.format(e))
             raise
+        finally:
+            self.pool.close()
+            self.timer.close()
+
+            for executor in self.executors.values():
+                executor.close()
 
 
 
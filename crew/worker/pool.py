@@ -0,0 +1,177 @@
+# encoding: utf-8
+import logging
+import threading
+import time
+import sys
+
+from .thread import KillableThread
+from ..exceptions import TimeoutError
+
+if sys.version_info >= (3,):
+    from queue import Queue
+else:
+    from Queue import Queue
+
+
+log = logging.getLogger(__name__)
+
+
+class Job(object):
+
+    def __init__(self, func, callback):
+        self.func = func
+        self.callback = callback
+        self.thread = None
+        self.timer = None
+        self.done = False
+        self._lock = threading.Lock()
+
+    def start(self, thread):
+        with self._lock:
+            if self.done:
+                return False
+
+            self.thread = thread
+            return True
+
+    def finish(self, result):
+        with self._lock:
+            self.thread = None
+            if self.done:
+                return False
+
+            self.done = True
+
+        if self.timer is not None:
+            self.timer.cancel()
+
+        self._callback(result)
+        return True
+
+    def expire(self, exc, retire):
+        with self._lock:
+            if self.done:
+                return False
+
+            self.done = True
+
+            # The lock guarantees the thread is still busy with this job
+            if self.thread is not None:
+                retire(self.thread)
+                self.thread.kill(wait=False)
+
+        self._callback(exc)
+        return True
+
+    def _callback(self, result):
+        try:
+            self.callback(result)
+        except Exception as e:
+            log.exception(e)
+
+
+class ThreadPool(object):
+
+    def __init__(self, size, timer=None):
+        assert isinstance(size, int) and size > 0
+        self.size = size
+        self.timer = timer
+        self._tasks = Queue()
+        self._threads = set()
+        self._lock = threading.Lock()
+
+        self.busy = 0
+        self.processed = 0
+        self.timeouts = 0
+        self.replaced = 0
+
+        with self._lock:
+            for _ in range(size):
+                self._spawn()
+
+    def _spawn(self):
+        thread = KillableThread(target=self._worker)
+        thread.daemon = True
+        self._threads.add(thread)
+        thread.start()
+
+    def _replenish(self):
+        with self._lock:
+            while len(self._threads) < self.size:
+                self._spawn()
+                self.replaced += 1
+                log.debug("Handler thread replaced. Pool stats: %r", self.stats)
+
+    def submit(self, func, callback, deadline=None):
+        self._replenish()
+
+        job = Job(func, callback)
+
+        if deadline is not None:
+            assert self.timer is not None, "Timer is required for deadlines"
+            timeout = int(deadline - time.time())
+            job.timer = self.timer.call_at(deadline, lambda: self._expire(job, timeout))
+
+        self._tasks.put(job)
+        return job
+
+    def _expire(self, job, timeout):
+        if job.expire(TimeoutError('Function lasted longer than {0} seconds'.format(timeout)), self._retire):
+            with self._lock:
+                self.timeouts += 1
+
+    def _retire(self, thread):
+        # Killed thread is gone, the next submit spawns a new one
+        with self._lock:
+            self._threads.discard(thread)
+
+    def _worker(self):
+        thread = threading.current_thread()
+
+        try:
+            self._run(thread)
+        except SystemExit:
+            # Killed by the expired job, the next submit spawns a thread in its place
+            log.debug("Handler thread %s was killed", thread.name)
+
+    def _run(self, thread):
+        while thread in self._threads:
+            job = self._tasks.get()
+            if job is None:
+                return
+
+            if not job.start(thread):
+                continue
+
+            with self._lock:
+                self.busy += 1
+
+            try:
+                result = job.func()
+            except Exception as e:
+                log.exception(e)
+                result = e
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    self.processed += 1
+
+            job.finish(result)
+
+    @property
+    def stats(self):
+        return {
+            'size': self.size,
+            'threads': len(self._threads),
+            'busy': self.busy,
+            'processed': self.processed,
+            'timeouts': self.timeouts,
+            'replaced': self.replaced,
+        }
+
+    def close(self):
+        for _ in range(len(self._threads)):
+            self._tasks.put(None)
+
+
+__all__ = ("ThreadPool",)
@@ -0,0 +1,243 @@
+# encoding: utf-8
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import traceback
+from functools import partial
+from itertools import count
+
+from .context import context
+from .pool import Job
+from ..exceptions import TimeoutError
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    SharedMemory = None
+
+
+log = logging.getLogger(__name__)
+
+
+class Serialized(object):
+    """ Reply body already encoded by the delivery serializer """
+
+    __slots__ = ('body', 'encoding')
+
+    def __init__(self, body, encoding='plain'):
+        self.body = body
+        self.encoding = encoding
+
+
+class SharedBuffer(object):
+    """ Bytes handed over to another process through the shared memory """
+
+    def __init__(self, data):
+        self.size = len(data)
+        shm = SharedMemory(create=True, size=max(self.size, 1))
+        shm.buf[:self.size] = data
+        self.name = shm.name
+        shm.close()
+
+    def consume(self, func):
+        shm = SharedMemory(name=self.name)
+        view = shm.buf[:self.size]
+
+        try:
+            return func(view)
+        finally:
+            view.release()
+
+            try:
+                shm.close()
+            except BufferError:
+                # Decoded objects are still referring to the segment, the mapping goes away with them
+                log.warning('Shared memory segment %s is still in use', self.name)
+
+    def unlink(self):
+        try:
+            shm = SharedMemory(name=self.name)
+        except OSError:
+            return
+
+        shm.close()
+        shm.unlink()
+
+
+def share(data, threshold):
+    if SharedMemory is None or data is None or len(data) < threshold:
+        return data
+
+    return SharedBuffer(data)
+
+
+# Jobs started by the process are reported to the pool, which kills it when the job expires
+started = None
+
+
+def initializer(settings, queue):
+    global started
+    started = queue
+    context.settings = settings
+    # Connection sockets are inherited from the listener and must not be used here
+    context.pubsub = None
+
+
+def execute(job_id, deadline, delivery, payload, threshold):
+    if deadline is not None and deadline <= time.time():
+        # Expired while waiting for the process, the result is dropped anyway
+        return None, delivery.headers
+
+    started.put((job_id, os.getpid()))
+
+    if isinstance(payload, SharedBuffer):
+        # Zero-copy codecs are referring to the segment, so the handler is called while it's mapped
+        return payload.consume(partial(call, delivery, threshold))
+
+    return call(delivery, threshold, payload)
+
+
+def call(delivery, threshold, data):
+    body = delivery.deserializer(data)
+    handler = context.handlers[delivery.routing_key]
+    context.headers = delivery.headers
+
+    try:
+        data = delivery.serializer(handler(body))
+        result = Serialized(share(data if isinstance(data, bytes) else bytes(data), threshold))
+    except Exception as e:
+        log.debug(traceback.format_exc())
+        log.error('Task error: {0}'.format(str(e)))
+        result = e
+
+    return result, context.headers
+
+
+class ProcessPool(object):
+    SHARED_MEMORY_THRESHOLD = 64 * 1024
+
+    def __init__(self, size, settings=None, timer=None):
+        assert isinstance(size, int) and size > 0
+        self.size = size
+        self.timer = timer
+
+        if SharedMemory is not None:
+            # Workers must share the tracker, otherwise they drop the segments on exit
+            resource_tracker.ensure_running()
+
+        self._started = multiprocessing.SimpleQueue()
+        self._running = {}
+        self._expired = set()
+        self._ids = count()
+        self._lock = threading.Lock()
+        self.pool = multiprocessing.Pool(size, initializer=initializer, initargs=(settings, self._started))
+
+        self.processed = 0
+        self.timeouts = 0
+        self.replaced = 0
+        self.shared = 0
+
+    def submit(self, delivery, callback, deadline=None):
+        job = Job(None, callback)
+        job_id = next(self._ids)
+
+        if deadline is not None:
+            timeout = int(deadline - time.time())
+            job.timer = self.timer.call_at(deadline, partial(self._expire, job, job_id, timeout))
+
+        payload = share(delivery.body, self.SHARED_MEMORY_THRESHOLD)
+        if isinstance(payload, SharedBuffer):
+            with self._lock:
+                self.shared += 1
+
+        on_result = partial(self._on_result, job, job_id, delivery, payload)
+        self.pool.apply_async(
+            execute, (job_id, deadline, delivery, payload, self.SHARED_MEMORY_THRESHOLD),
+            callback=on_result, error_callback=on_result,
+        )
+
+        return job
+
+    def _collect_started(self):
+        # Called with the lock held
+        while not self._started.empty():
+            job_id, pid = self._started.get()
+
+            if job_id in self._expired:
+                # Expired before its start was reported
+                self._expired.discard(job_id)
+                self._kill(pid)
+            else:
+                self._running[job_id] = pid
+
+    def _kill(self, pid):
+        # The pool starts a new process in place of the killed one
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            return
+
+        self.replaced += 1
+        log.debug("Process %d running the expired job was killed", pid)
+
+    def _on_result(self, job, job_id, delivery, payload, outcome):
+        with self._lock:
+            # The process reports the start before the result, so it's collected by now
+            self._collect_started()
+            self._running.pop(job_id, None)
+            self._expired.discard(job_id)
+            self.processed += 1
+
+        if isinstance(payload, SharedBuffer):
+            payload.unlink()
+
+        if isinstance(outcome, BaseException):
+            result = outcome
+        else:
+            result, delivery.headers = outcome
+
+            if isinstance(result, Serialized) and isinstance(result.body, SharedBuffer):
+                buffer = result.body
+                result = Serialized(buffer.consume(bytes))
+                buffer.unlink()
+
+                with self._lock:
+                    self.shared += 1
+
+        # Result of the expired job is dropped
+        job.finish(result)
+
+    def _expire(self, job, job_id, timeout):
+        if not job.expire(TimeoutError('Function lasted longer than {0} seconds'.format(timeout)), None):
+            return
+
+        with self._lock:
+            self.timeouts += 1
+            self._collect_started()
+            pid = self._running.pop(job_id, None)
+
+            if pid is None:
+                # Not started yet, the process skips it or it's killed once the start is reported
+                self._expired.add(job_id)
+            else:
+                self._kill(pid)
+
+    @property
+    def stats(self):
+        return {
+            'size': self.size,
+            'processed': self.processed,
+            'timeouts': self.timeouts,
+            'replaced': self.replaced,
+            'shared': self.shared,
+        }
+
+    def close(self):
+        self.pool.terminate()
+
+
+__all__ = ("ProcessPool", "Serialized")
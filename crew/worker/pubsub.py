@@ -1,45 +1,34 @@
 #!/usr/bin/env python
 # encoding: utf-8
-import json
-import sys
 import pika
-
-if sys.version_info >= (3,):
-    import pickle
-else:
-    import cPickle as pickle
+from functools import partial
+from .. import codecs
 
 
 class PubSub(object):
-    SERIALIZERS = {
-        'json': 'application/json',
-        'pickle': 'application/python-pickle',
-        'text': 'text/plain'
-    }
+
+    # Deprecated aliases of the codec registry
+    SERIALIZERS = codecs.content_types
+    get_serializer = staticmethod(codecs.get_serializer)
 
     def __init__(self, connection):
+        self.connection = connection
         self.channel = connection.channel()
         self.channel.exchange_declare(
             exchange='pubsub', exchange_type='fanout', durable=True)
 
-    def get_serializer(self, name):
-        assert name in self.SERIALIZERS
-        if name == 'pickle':
-            return (lambda x: pickle.dumps(x, protocol=2), self.SERIALIZERS[name])
-        elif name == 'json':
-            return (json.dumps, self.SERIALIZERS[name])
-        elif name == 'text':
-            return (lambda x: str(x).encode('utf-8'), self.SERIALIZERS[name])
+    def schedule(self, func):
+        # Handlers are running outside of the connection thread
+        self.connection.add_callback_threadsafe(func)
 
     def publish(self, channel, message, serializer='pickle'):
-        assert serializer in self.SERIALIZERS
-
-        serializer, t = self.get_serializer(serializer)
+        serializer = codecs.get(serializer)
 
-        self.channel.basic_publish(
+        self.schedule(partial(
+            self.channel.basic_publish,
             exchange='crew.PUBSUB',
             routing_key='',
-            body=serializer(message),
+            body=serializer.dumps(message),
             properties=pika.BasicProperties(
-                content_type=t, delivery_mode=1, headers={'x-channel-name': channel})
-        )
+                content_type=serializer.content_type, delivery_mode=1, headers={'x-channel-name': channel})
+        ))
@@ -9,24 +9,43 @@ from optparse import OptionParser
 from socket import getfqdn
 from .listener import Listener
 from .context import Context, context
+from ..blobstore import LocalBlobStore
 
 
 NODE_UUID = uuid(getfqdn())
 UUID = uuid()
 
 
-def listener_process(port, host, credentials, virtual_host, handlers, set_context):
-    exit(Listener(
+MODES = ('thread', 'asyncio')
+
+
+def get_listener(mode):
+    if mode == 'asyncio':
+        from .aio import AsyncListener
+        return AsyncListener
+
+    return Listener
+
+
+def listener_process(port, host, credentials, virtual_host, handlers, set_context, mode, concurrency,
+                     blob_dir=None, blob_threshold=None):
+    options = {'concurrency': concurrency} if concurrency else {}
+
+    if blob_dir:
+        options['blob_store'] = LocalBlobStore(blob_dir, threshold=blob_threshold)
+
+    exit(get_listener(mode)(
         port=port,
         host=host,
         credentials=pika.PlainCredentials(**credentials) if credentials else None,
         virtual_host=virtual_host,
         handlers=handlers,
-        set_context=Context(**set_context)
+        set_context=Context(**set_context),
+        **options
     ).loop())
 
 
-def run(**kwargs):
+def run(mode=None, **kwargs):
     parser = OptionParser(usage="Usage: %prog [options]")
     parser.add_option("-v", "--verbose", action="store_true",
                       dest="verbose", default=False, help="make lots of noise")
@@ -49,6 +68,22 @@ def run(**kwargs):
     parser.add_option(
         "--forks", dest="forks", default=1, help="Create multiple process", type=int)
 
+    parser.add_option(
+        "--concurrency", dest="concurrency", default=None, type=int,
+        help="Tasks processed simultaneously by each process")
+
+    parser.add_option(
+        "--mode", dest="mode", default=mode or 'thread', type='choice', choices=MODES,
+        help="Run handlers in threads or on the asyncio event loop")
+
+    parser.add_option(
+        "--blob-dir", dest="blob_dir", default=None,
+        help="Directory shared with the clients for the oversized payloads")
+
+    parser.add_option(
+        "--blob-threshold", dest="blob_threshold", default=1024 * 1024, type=int,
+        help="Replies of this size and larger are stored in the blob directory")
+
     (options, args) = parser.parse_args()
 
     log_level = getattr(logging, options.logging.upper(), logging.INFO)
@@ -69,7 +104,11 @@ def run(**kwargs):
             node_uuid=NODE_UUID,
             uuid=UUID,
             **kwargs
-        )
+        ),
+        mode=options.mode,
+        concurrency=options.concurrency,
+        blob_dir=options.blob_dir,
+        blob_threshold=options.blob_threshold,
     )
 
     def create_proc():
@@ -104,4 +143,4 @@ def run(**kwargs):
 
     else:
         logging.info("Running single process")
-        Listener(**arguments).loop()
+        listener_process(**arguments)
@@ -1,15 +1,33 @@
 # encoding: utf-8
+import multiprocessing
 from functools import wraps
 from .context import context
+from ..compression import CompressionPolicy
 
 
 class Task(object):
+    EXECUTORS = ('thread', 'process')
 
-    def __init__(self, task_id, force_gzip=False):
+    def __init__(self, task_id, force_gzip=False, executor='thread', workers=None, batch_size=None, max_wait_ms=5,
+                 cache=None, compression=None):
+        assert executor in self.EXECUTORS
+        assert not (batch_size and executor == 'process'), "Batches are served by threads only"
         self.task_id = "crew.tasks.%s" % task_id
+        self.executor = executor
+        self.workers = workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self.cache = cache
+
+        if compression is None and force_gzip:
+            # Every reply is compressed, as before the policies
+            compression = CompressionPolicy(threshold=0, force=True)
+
+        self.compression = compression
 
     def __call__(self, func):
         context.handlers[self.task_id] = func
+        context.tasks[self.task_id] = self
 
         @wraps(func)
         def wrap(*args, **kwargs):
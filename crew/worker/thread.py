@@ -5,8 +5,8 @@ import time
 
 class KillableThread(threading.Thread):
 
-    def kill(self, exc=SystemExit):
-        if not self.isAlive():
+    def kill(self, exc=SystemExit, wait=True):
+        if not self.is_alive():
             return False
 
         res = ctypes.pythonapi.PyThreadState_SetAsyncExc(
@@ -18,7 +18,7 @@ class KillableThread(threading.Thread):
             ctypes.pythonapi.PyThreadState_SetAsyncExc(self.ident, None)
             raise SystemError("PyThreadState_SetAsyncExc failed")
 
-        while self.isAlive():
+        while wait and self.is_alive():
             time.sleep(0.01)
 
         return True
@@ -0,0 +1,88 @@
+# encoding: utf-8
+import logging
+import sys
+import time
+
+from .. import codecs
+from ..exceptions import TimeoutError
+
+if sys.version_info >= (3,):
+    from queue import Queue, Empty
+else:
+    from Queue import Queue, Empty
+
+
+log = logging.getLogger(__name__)
+
+
+class Upload(object):
+    """ Iterator over the chunks of the request input, given to the handler instead of the body.
+
+    Chunks are consumed from the queue of the call. They are acknowledged
+    when the handler takes them, so the prefetch of the channel bounds the
+    chunks held by the worker.
+    """
+
+    # Lets the thread killed by the timeout notice the exception
+    POLL_INTERVAL = 1
+
+    def __init__(self, listener, queue, deadline):
+        self.listener = listener
+        self.queue = queue
+        self.deadline = deadline
+        self.consumer_tag = None
+        self.received = 0
+        self._chunks = Queue()
+        self._done = False
+
+    def start(self, channel):
+        self.consumer_tag = channel.basic_consume(self.on_chunk, queue=self.queue)
+
+    def stop(self, channel):
+        if self.consumer_tag is not None:
+            # The queue is deleted along with its only consumer
+            channel.basic_cancel(consumer_tag=self.consumer_tag)
+            self.consumer_tag = None
+
+    def on_chunk(self, channel, method, props, body):
+        self._chunks.put((method.delivery_tag, props, body))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+
+        tag, props, body = self._get()
+        self.listener.threadsafe(self.listener.channel.basic_ack, tag)
+
+        headers = props.headers or {}
+
+        if headers.get('x-upload-end'):
+            self._done = True
+
+            # The end marker carries a body only when the upload has failed
+            if body:
+                raise codecs.resolve(props.content_type, props.content_encoding or 'plain').loads(body)
+
+            raise StopIteration
+
+        self.received += 1
+        return codecs.resolve(props.content_type, props.content_encoding or 'plain').loads(body)
+
+    next = __next__
+
+    def _get(self):
+        while True:
+            timeout = self.deadline - time.time()
+            if timeout <= 0:
+                raise TimeoutError('Upload {0} was not finished in time'.format(self.queue))
+
+            try:
+                return self._chunks.get(timeout=min(timeout, self.POLL_INTERVAL))
+            except Empty:
+                continue
+
+
+__all__ = ("Upload",)
@@ -39,6 +39,6 @@ setup(
         'Programming Language :: Python',
     ],
     long_description=open('README.rst').read(),
-    packages=['crew', 'crew.worker', 'crew.master', 'crew.master.tornado'],
+    packages=['crew', 'crew.worker', 'crew.master', 'crew.master.tornado', 'crew.master.asyncio'],
     **supports
 )
@@ -86,6 +86,17 @@ class Multitaskhandler(tornado.web.RequestHandler):
             self.write("Test result: {0}\nStat result: {1}".format(test_result, stat_result))
 
 
+class BatchHandler(tornado.web.RequestHandler):
+    @tornado.gen.coroutine
+    def get(self, *args, **kwargs):
+        with self.application.crew.parallel() as mc:
+            for i in range(1, 4):
+                mc.call('double', data=i)
+
+            results = yield mc.result()
+            self.write(", ".join(str(result) for result in results))
+
+
 application = tornado.web.Application(
     [
         (r"/", MainHandler),
@@ -96,6 +107,7 @@ application = tornado.web.Application(
         (r'/publish', PublishHandler),
         (r'/publish2', PublishHandler2),
         (r'/parallel', Multitaskhandler),
+        (r'/batch', BatchHandler),
     ],
     autoreload=True,
     debug=True,
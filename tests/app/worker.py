@@ -30,3 +30,8 @@ def publish(req):
 def sleeper(rew):
     sleep(3)
     return 1
+
+
+@Task('double', batch_size=16, max_wait_ms=5)
+def double(items):
+    return [item * 2 for item in items]
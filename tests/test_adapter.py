@@ -0,0 +1,251 @@
+# encoding: utf-8
+import pika
+from pika.spec import Basic
+from tornado import testing
+from tornado.gen import sleep
+
+from crew.exceptions import PublishError
+from crew.master.tornado.client import Client
+from crew.master.tornado.adapter import TornadoPikaAdapter
+from crew.master.tornado.topology import Topology
+
+
+class FakeChannel(object):
+    """ Records the methods, the replies are sent by the test """
+
+    def __init__(self):
+        self.is_open = True
+        self.calls = []
+        self.callbacks = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            if name not in ('basic_publish', 'basic_consume') and args and (args[0] is None or callable(args[0])):
+                callback, args = args[0], args[1:]
+                if callback is not None:
+                    self.callbacks.append(callback)
+            self.calls.append((name, args, kwargs))
+
+        return method
+
+    def names(self):
+        return [name for name, _, _ in self.calls]
+
+    def reply(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(None)
+
+
+def frame(method, delivery_tag, multiple=False):
+    return pika.frame.Method(1, method(delivery_tag=delivery_tag, multiple=multiple))
+
+
+class TestConfirmWindow(testing.AsyncTestCase):
+    def setUp(self):
+        super(TestConfirmWindow, self).setUp()
+        self.adapter = TornadoPikaAdapter(
+            pika.ConnectionParameters(), io_loop=self.io_loop, confirm=True, confirm_window=3
+        )
+        self.adapter.channel = FakeChannel()
+
+    def publish(self, count):
+        return [self.adapter.basic_publish('', 'test', b'body') for _ in range(count)]
+
+    def published(self):
+        return self.adapter.channel.names().count('basic_publish')
+
+    @testing.gen_test
+    def test_window(self):
+        self.publish(5)
+        yield sleep(0)
+
+        self.assertEqual(self.published(), 3)
+        self.assertEqual(self.adapter.confirm_stats['pending'], 2)
+
+        self.adapter._on_confirm(frame(Basic.Ack, 1))
+        self.assertEqual(self.published(), 4)
+
+    @testing.gen_test
+    def test_multiple_ack(self):
+        futures = self.publish(5)
+        yield sleep(0)
+
+        self.adapter._on_confirm(frame(Basic.Ack, 2, multiple=True))
+
+        self.assertEqual([future.done() for future in futures], [True, True, False, False, False])
+        self.assertTrue(futures[0].result())
+        self.assertEqual(self.published(), 5)
+        self.assertEqual(self.adapter.confirm_stats['confirmed'], 2)
+        self.assertEqual(self.adapter.confirm_stats['unconfirmed'], 3)
+
+    @testing.gen_test
+    def test_multiple_nack(self):
+        futures = self.publish(4)
+        yield sleep(0)
+
+        self.adapter._on_confirm(frame(Basic.Nack, 3, multiple=True))
+
+        for future in futures[:3]:
+            self.assertIsInstance(future.exception(), PublishError)
+        self.assertFalse(futures[3].done())
+        self.assertEqual(self.adapter.confirm_stats['nacked'], 3)
+
+    @testing.gen_test
+    def test_single_confirms_out_of_order(self):
+        futures = self.publish(3)
+        yield sleep(0)
+
+        self.adapter._on_confirm(frame(Basic.Nack, 2))
+        self.adapter._on_confirm(frame(Basic.Ack, 3))
+
+        self.assertFalse(futures[0].done())
+        self.assertIsInstance(futures[1].exception(), PublishError)
+        self.assertTrue(futures[2].result())
+
+    @testing.gen_test
+    def test_lost_with_the_channel(self):
+        futures = self.publish(4)
+        yield sleep(0)
+
+        self.adapter._fail_unconfirmed(PublishError('lost'))
+
+        for future in futures[:3]:
+            self.assertIsInstance(future.exception(), PublishError)
+        # The message waiting for the window is published on the next channel
+        self.assertFalse(futures[3].done())
+        self.assertEqual(self.adapter.confirm_stats['lost'], 3)
+
+
+class OfflineClient(Client):
+    def connect(self):
+        pass
+
+
+class TestBatch(testing.AsyncTestCase):
+    def setUp(self):
+        super(TestBatch, self).setUp()
+        self.adapter = TornadoPikaAdapter(pika.ConnectionParameters(), io_loop=self.io_loop)
+        self.adapter.channel = FakeChannel()
+
+    @testing.gen_test
+    def test_flush_per_iteration(self):
+        futures = [self.adapter.basic_publish('', 'test', b'body') for _ in range(3)]
+
+        self.assertEqual(self.adapter.channel.calls, [])
+        # The messages of a batch share the future
+        self.assertEqual(len(set(futures)), 1)
+
+        self.assertEqual((yield futures[0]), 3)
+        self.assertEqual(self.adapter.channel.names(), ['basic_publish'] * 3)
+        self.assertEqual(self.adapter.batch_stats['flushes'], 1)
+
+    @testing.gen_test
+    def test_flush_by_size(self):
+        self.adapter.basic_publish('', 'test', b'x' * TornadoPikaAdapter.FLUSH_BYTES)
+        self.assertEqual(self.adapter.channel.names(), ['basic_publish'])
+
+    @testing.gen_test
+    def test_no_wait(self):
+        self.assertIsNone(self.adapter.basic_publish('', 'test', b'body', wait=False))
+        yield sleep(0)
+        self.assertEqual(self.adapter.channel.names(), ['basic_publish'])
+
+    @testing.gen_test
+    def test_client_publish_does_not_wait(self):
+        client = OfflineClient(credentials=pika.PlainCredentials('guest', 'guest'), confirm=True)
+        client.channel.channel = FakeChannel()
+
+        self.assertIsNone(client.publish('news', 'message'))
+        published = client.publish('news', 'message', wait=True)
+        yield sleep(0)
+
+        self.assertEqual(list(client.channel._unconfirmed.values()), [None, published])
+
+
+class TestQueued(testing.AsyncTestCase):
+    @testing.gen_test
+    def test_order(self):
+        adapter = TornadoPikaAdapter(pika.ConnectionParameters(), io_loop=self.io_loop)
+
+        # Queued with the same order while disconnected
+        first = adapter.transient_queue_declare('first')
+        second = adapter.transient_queue_declare('second')
+
+        channel = adapter.channel = FakeChannel()
+        yield adapter._bethink()
+        channel.reply()
+        yield [first, second]
+
+        self.assertEqual([kwargs['queue'] for _, _, kwargs in channel.calls], ['first', 'second'])
+
+
+class TestTopology(testing.AsyncTestCase):
+    def test_collapse(self):
+        topology = Topology()
+        topology.declare_exchange('ex', exchange_type='direct')
+        topology.declare_exchange('ex', exchange_type='topic')
+        topology.declare_exchange('passive', passive=True)
+        topology.declare_queue('')
+        topology.bind('q', 'ex', 'a')
+        topology.bind('q', 'ex', 'a')
+        topology.bind('q', 'ex', 'b')
+        topology.unbind('q', 'ex', 'b')
+        topology.bind('q', 'ex', 'a', arguments={'x-match': 'all'})
+        topology.consume('tag', 'q', None)
+        topology.consume('gone', 'q', None)
+        topology.cancel('gone')
+
+        self.assertEqual(topology.exchanges['ex'], {'exchange_type': 'topic'})
+        self.assertEqual(topology.stats, {'exchanges': 1, 'queues': 0, 'bindings': 2, 'consumers': 1})
+
+    @testing.gen_test
+    def test_replay_order(self):
+        topology = Topology()
+        topology.bind('q', 'ex', 'a')
+        topology.declare_queue('q', durable=True)
+        topology.consume('tag', 'q', None)
+        topology.declare_exchange('ex', exchange_type='topic')
+
+        channel = FakeChannel()
+        replay = topology.replay(channel)
+
+        self.assertEqual(channel.names(), ['exchange_declare', 'queue_declare', 'queue_bind'])
+        self.assertEqual(channel.calls[0][2]['nowait'], True)
+        self.assertNotIn('nowait', channel.calls[2][2])
+
+        # The consumers wait for the reply of the last declaration
+        channel.reply()
+        yield replay
+
+        self.assertEqual(channel.names()[-1], 'basic_consume')
+        self.assertEqual(channel.calls[-1][2]['consumer_tag'], 'tag')
+
+    @testing.gen_test
+    def test_changes_during_replay(self):
+        adapter = TornadoPikaAdapter(pika.ConnectionParameters(), io_loop=self.io_loop)
+        adapter.queue_declare('q')
+        adapter.consume('q', lambda *a: None, consumer_tag='tag')
+
+        channel = adapter.channel = FakeChannel()
+        adapter._replaying = True
+        replay = adapter._bethink()
+
+        bound = adapter.queue_bind('q', 'ex', 'a')
+        consumed = adapter.consume('q', lambda *a: None, consumer_tag='other')
+        yield sleep(0)
+
+        # Nothing is sent before the replay is done
+        self.assertEqual(channel.names(), ['queue_declare'])
+        self.assertEqual((yield consumed), 'other')
+
+        channel.reply()
+        yield replay
+        yield sleep(0)
+
+        self.assertEqual(channel.names(), ['queue_declare', 'basic_consume', 'basic_consume', 'queue_bind'])
+        channel.reply()
+        yield bound
@@ -0,0 +1,79 @@
+# encoding: utf-8
+import asyncio
+import unittest
+
+import pika
+
+from crew import codecs
+from crew.master.asyncio import Client
+
+
+class Channel(object):
+    """ Open channel recording the methods """
+
+    def __init__(self):
+        self.is_open = True
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+
+        return method
+
+    def names(self):
+        return [name for name, _, _ in self.calls]
+
+
+class Method(object):
+    delivery_tag = 1
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.client = Client(credentials=pika.PlainCredentials('guest', 'guest'), loop=self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_subscriptions(self):
+        self.client.subscribe('news', lambda message: None)
+        # Bound by connect() while disconnected
+        self.assertIn('news', self.client._subscribe_cache)
+
+        channel = self.client.channel = Channel()
+        self.client.subscribe('sports', lambda message: None)
+        self.client.unsubscribe('news')
+
+        self.assertEqual(channel.names(), ['queue_bind', 'queue_unbind'])
+        self.assertEqual(channel.calls[1][2], dict(
+            queue=self.client._pubsub_queue, exchange='crew.PUBSUB', arguments={'x-channel-name': 'news'}
+        ))
+        self.assertEqual(list(self.client._subscribe_cache), ['sports'])
+
+    def test_unsubscribe_while_disconnected(self):
+        self.client.subscribe('news', lambda message: None)
+        self.client.unsubscribe('news')
+        self.assertEqual(self.client._subscribe_cache, {})
+
+    def test_outbox(self):
+        future = self.client.call('test', 1)
+        self.client.publish('news', 'message')
+        self.assertEqual(len(self.client._outbox), 2)
+
+        channel = self.client.channel = Channel()
+        self.client._flush()
+        self.assertEqual(channel.names(), ['basic_publish', 'basic_publish'])
+
+        props = channel.calls[0][2]['properties']
+        serializer = codecs.get('pickle')
+        self.client._on_result(channel, Method(), pika.BasicProperties(
+            correlation_id=props.correlation_id, content_type=serializer.content_type, headers={}
+        ), serializer.dumps(2))
+
+        self.assertEqual(future.result(), 2)
+        self.assertEqual(channel.names()[-1], 'basic_ack')
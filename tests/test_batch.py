@@ -0,0 +1,93 @@
+# encoding: utf-8
+import unittest
+
+import pika
+
+from crew.worker.batch import Batch
+from crew.worker.listener import Delivery, Listener
+from crew.worker.task import Task
+
+
+class Connection(object):
+    """ Timeouts fired by the test """
+
+    def __init__(self):
+        self.timeouts = {}
+        self._counter = 0
+
+    def add_timeout(self, delay, callback):
+        self._counter += 1
+        self.timeouts[self._counter] = (delay, callback)
+        return self._counter
+
+    def remove_timeout(self, handle):
+        del self.timeouts[handle]
+
+    def fire(self):
+        timeouts, self.timeouts = self.timeouts, {}
+        for delay, callback in timeouts.values():
+            callback()
+
+
+class Method(object):
+    def __init__(self, delivery_tag, routing_key):
+        self.delivery_tag = delivery_tag
+        self.routing_key = routing_key
+
+
+def delivery(tag, body, routing_key='crew.tasks.batch_double'):
+    props = pika.BasicProperties(content_type='application/json', headers={})
+    return Delivery(Method(tag, routing_key), props, body)
+
+
+@Task('batch_double', batch_size=3, max_wait_ms=20)
+def double(values):
+    return [value * 2 for value in values]
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.connection = Connection()
+        self.flushed = []
+        self.batch = Batch(self.connection, 3, 0.02, self.flushed.append)
+
+    def test_flush_by_size(self):
+        for item in range(7):
+            self.batch.add(item)
+
+        self.assertEqual(self.flushed, [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual(len(self.batch), 1)
+        # The timeout of the full batch is removed, the rest has its own
+        self.assertEqual(len(self.connection.timeouts), 1)
+
+    def test_flush_by_time(self):
+        self.batch.add(0)
+        self.batch.add(1)
+
+        self.assertEqual(self.flushed, [])
+        self.assertEqual([delay for delay, _ in self.connection.timeouts.values()], [0.02])
+
+        self.connection.fire()
+        self.assertEqual(self.flushed, [[0, 1]])
+        self.assertEqual(self.batch.stats, {'size': 3, 'flushes': 1, 'items': 2, 'pending': 0})
+
+    def test_empty_flush(self):
+        self.batch.flush()
+        self.assertEqual(self.flushed, [])
+
+    def test_listener_batches(self):
+        listener = Listener.__new__(Listener)
+        listener._handlers = {'crew.tasks.batch_double': double}
+        listener.connection = self.connection
+        listener.context = None
+
+        batches = listener.create_batches()
+        self.assertEqual(batches['crew.tasks.batch_double'].max_wait, 0.02)
+
+        deliveries = [delivery(1, b'1'), delivery(2, b'not json'), delivery(3, b'3')]
+        results = listener.process_batch(deliveries)
+
+        self.assertEqual(results[0], 2)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], 6)
+        self.assertEqual(deliveries[2].w_name, 'double')
@@ -0,0 +1,72 @@
+# encoding: utf-8
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from crew.blobstore import LocalBlobStore
+from crew.exceptions import ExpirationError
+
+
+class TestLocalBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = LocalBlobStore(self.path, threshold=16)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_accepts(self):
+        self.assertFalse(self.store.accepts(None))
+        self.assertFalse(self.store.accepts(b'x' * 15))
+        self.assertTrue(self.store.accepts(b'x' * 16))
+        self.assertFalse(LocalBlobStore(self.path, threshold=None).accepts(b'x' * 16))
+
+    def test_put_get_delete(self):
+        key = self.store.put(b'x' * 1024, 60)
+        blob = self.store.get(key)
+
+        self.assertEqual(blob[:], b'x' * 1024)
+        self.assertEqual(self.store.get(self.store.put(b'', 60)), b'')
+
+        blob.close()
+        self.store.delete(key)
+        self.assertRaises(ExpirationError, self.store.get, key)
+        # Deleting twice is fine
+        self.store.delete(key)
+
+        self.assertEqual(self.store.stats['stored'], 2)
+        self.assertEqual(self.store.stats['loaded'], 2)
+
+    def test_invalid_keys(self):
+        for key in ('', '../etc/passwd', '.hidden', 'a/b'):
+            self.assertRaises(ValueError, self.store.get, key)
+
+    def test_cleanup(self):
+        expired = self.store.put(b'expired', -1)
+        alive = self.store.put(b'alive', 60)
+
+        # Unfinished writes are kept for a while
+        unfinished = os.path.join(self.path, '.unfinished')
+        open(unfinished, 'wb').close()
+        stale = os.path.join(self.path, '.stale')
+        open(stale, 'wb').close()
+        past = time.time() - LocalBlobStore.CLEANUP_INTERVAL - 1
+        os.utime(stale, (past, past))
+
+        self.store.cleanup(force=True)
+
+        self.assertRaises(ExpirationError, self.store.get, expired)
+        self.assertEqual(self.store.get(alive)[:], b'alive')
+        self.assertTrue(os.path.exists(unfinished))
+        self.assertFalse(os.path.exists(stale))
+        self.assertEqual(self.store.stats['expired'], 2)
+
+    def test_cleanup_interval(self):
+        self.store.cleanup(force=True)
+        key = self.store.put(b'expired', -1)
+
+        # The put doesn't scan the directory again within the interval
+        self.store.put(b'other', 60)
+        self.assertEqual(self.store.get(key)[:], b'expired')
@@ -0,0 +1,68 @@
+# encoding: utf-8
+import time
+import unittest
+
+from crew.cache import LRU
+
+
+class TestLRU(unittest.TestCase):
+    def test_hit_and_miss(self):
+        cache = LRU(maxsize=2)
+        cache.set('a', 1)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('b', 'default'), 'default')
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['misses'], 2)
+        self.assertEqual(cache.stats['hit_ratio'], 1. / 3)
+
+    def test_eviction_of_the_least_recently_used(self):
+        cache = LRU(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats['evictions'], 1)
+
+    def test_ttl(self):
+        cache = LRU(maxsize=10, ttl=0.1)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=10)
+        time.sleep(0.2)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.stats['expirations'], 1)
+
+    def test_invalidate(self):
+        cache = LRU()
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        cache.invalidate('a')
+        self.assertNotIn('a', cache)
+        self.assertIn('b', cache)
+
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+    def test_contains_does_not_count(self):
+        cache = LRU()
+        cache.set('a', 1)
+        'a' in cache
+        'b' in cache
+
+        self.assertEqual(cache.stats['hits'], 0)
+        self.assertEqual(cache.stats['misses'], 0)
+
+    def test_key(self):
+        self.assertEqual(LRU.key('task', b'body'), LRU.key('task', b'body'))
+        self.assertNotEqual(LRU.key('task', b'body'), LRU.key('task', b'other'))
+        # The parts are separated
+        self.assertNotEqual(LRU.key('ab', 'c'), LRU.key('a', 'bc'))
@@ -0,0 +1,246 @@
+# encoding: utf-8
+import time
+
+import pika
+from tornado import testing
+from tornado.concurrent import Future
+from tornado.gen import sleep
+
+from crew import TimeoutError, codecs
+from crew.cache import LRU
+from crew.master.tornado.client import Client
+
+
+class OfflineClient(Client):
+    def connect(self):
+        pass
+
+
+class Channel(object):
+    """ Open channel recording the published messages """
+
+    def __init__(self):
+        self.is_open = True
+        self.published = []
+        self.acked = []
+        self.bindings = []
+
+    def basic_publish(self, **kwargs):
+        self.published.append(kwargs)
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def queue_bind(self, callback, queue, exchange, routing_key=None, arguments=None):
+        self.bindings.append((queue, exchange, arguments))
+        callback(None)
+
+    def queue_unbind(self, callback, queue='', exchange=None, routing_key=None, arguments=None):
+        self.bindings.remove((queue, exchange, arguments))
+        callback(None)
+
+
+class Method(object):
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class ClientTestCase(testing.AsyncTestCase):
+    def setUp(self):
+        super(ClientTestCase, self).setUp()
+        self.client = self.create_client()
+        self.channel = self.client.channel.channel = Channel()
+
+    def create_client(self, **kwargs):
+        return OfflineClient(credentials=pika.PlainCredentials('guest', 'guest'), **kwargs)
+
+    def reply(self, message, result, headers=None):
+        serializer = codecs.get('pickle')
+        props = pika.BasicProperties(
+            correlation_id=message['properties'].correlation_id, content_type=serializer.content_type,
+            content_encoding='plain', headers=headers or {},
+        )
+        self.client._on_result(self.channel, Method(len(self.channel.acked) + 1), props, serializer.dumps(result))
+
+
+class TestCache(ClientTestCase):
+    def create_client(self, **kwargs):
+        return super(TestCache, self).create_client(cache=LRU(maxsize=16))
+
+    @testing.gen_test
+    def test_hit(self):
+        self.client.set_cache_ttl('lookup', 30)
+
+        future = self.client.call('lookup', 1)
+        yield sleep(0)
+        self.reply(self.channel.published[0], 2)
+        self.assertEqual((yield future), 2)
+
+        cached = self.client.call('lookup', 1)
+        self.assertTrue(cached.done())
+        self.assertEqual(cached.result(), 2)
+        self.assertEqual(len(self.channel.published), 1)
+        self.assertEqual(self.client.cache_stats['hits'], 1)
+
+    @testing.gen_test
+    def test_channel_without_ttl(self):
+        for _ in range(2):
+            future = self.client.call('lookup', 1)
+            yield sleep(0)
+            self.reply(self.channel.published[-1], 2)
+            yield future
+
+        self.assertEqual(len(self.channel.published), 2)
+
+    @testing.gen_test
+    def test_worker_hint(self):
+        self.client.set_cache_ttl('lookup', 30)
+
+        # The worker disables the caching of its reply
+        future = self.client.call('lookup', 1)
+        yield sleep(0)
+        self.reply(self.channel.published[-1], 2, headers={'x-cache-ttl': 0})
+        yield future
+
+        # And enables it for the channel without a TTL
+        future = self.client.call('other', 1)
+        yield sleep(0)
+        self.reply(self.channel.published[-1], 3, headers={'x-cache-ttl': 30})
+        yield future
+
+        self.assertFalse(self.client.call('lookup', 1).done())
+        self.assertEqual(self.client.call('other', 1).result(), 3)
+
+    @testing.gen_test
+    def test_errors_are_not_cached(self):
+        self.client.set_cache_ttl('lookup', 30)
+
+        future = self.client.call('lookup', 1)
+        yield sleep(0)
+        self.reply(self.channel.published[-1], ValueError('failed'))
+
+        with self.assertRaises(ValueError):
+            yield future
+
+        self.assertFalse(self.client.call('lookup', 1).done())
+
+
+class TestDeadlines(ClientTestCase):
+    @testing.gen_test
+    def test_expire(self):
+        self.client.EXPIRATION_GRACE = 0
+        future = self.client.call('test', 1, expiration=1)
+        answered = self.client.call('test', 2, expiration=1)
+        waiting = self.client.call('test', 3, expiration=60)
+        yield sleep(0)
+
+        self.reply(self.channel.published[1], 4)
+        self.assertEqual(self.client.pending, 2)
+
+        with self.assertRaises(TimeoutError):
+            yield future
+
+        self.assertEqual((yield answered), 4)
+        self.assertFalse(waiting.done())
+        self.assertEqual(list(self.client.callbacks_hash), [self.channel.published[2]['properties'].correlation_id])
+        # The timer waits for the next deadline
+        self.assertEqual(len(self.client._deadlines), 1)
+
+    @testing.gen_test
+    def test_callback(self):
+        results = []
+
+        def callback(result, headers=None):
+            results.append(result)
+
+        self.client.callbacks_hash['test.cid'] = callback
+        self.client._track('test.cid', callback, time.time())
+        yield sleep(0.01)
+
+        self.assertIsInstance(results[0], TimeoutError)
+        self.assertEqual(self.client.callbacks_hash, {})
+
+    def test_answered_entries_are_dropped(self):
+        for index in range(200):
+            cid = 'test.{0}'.format(index)
+            future = Future()
+            self.client.callbacks_hash[cid] = future
+            self.client._track(cid, future, time.time() + 60)
+            # Answered at once
+            del self.client.callbacks_hash[cid]
+
+        self.assertLessEqual(len(self.client._deadlines), 65)
+
+    @testing.gen_test
+    def test_late_reply(self):
+        self.client.EXPIRATION_GRACE = 0
+        future = self.client.call('test', 1, expiration=1)
+        yield sleep(0)
+
+        with self.assertRaises(TimeoutError):
+            yield future
+
+        self.reply(self.channel.published[0], 2)
+        self.assertEqual(self.channel.acked, [1])
+
+
+class TestCallMany(ClientTestCase):
+    @testing.gen_test
+    def test_futures(self):
+        futures = self.client.call_many('test', [1, 2, 3], priority=5, expiration=600)
+        yield sleep(0)
+
+        self.assertEqual(len(self.channel.published), 3)
+        # The properties are shared, the ids are not
+        props = [message['properties'] for message in self.channel.published]
+        self.assertEqual(set(p.priority for p in props), {5})
+        self.assertEqual(len(set(p.correlation_id for p in props)), 3)
+
+        # The replies come in any order
+        for message, result in zip(reversed(self.channel.published), ('c', 'b', 'a')):
+            self.reply(message, result)
+
+        self.assertEqual((yield futures), ['a', 'b', 'c'])
+        self.assertEqual(self.client.pending, 0)
+
+    @testing.gen_test
+    def test_single_flush(self):
+        self.client.call_many('test', range(10))
+        yield sleep(0)
+
+        self.assertEqual(self.client.channel.batch_stats['flushes'], 1)
+        self.assertEqual(self.client.channel.batch_stats['messages'], 10)
+
+    def test_empty(self):
+        self.assertEqual(self.client.call_many('test', []), [])
+
+
+class TestSubscriptions(ClientTestCase):
+    def setUp(self):
+        super(TestSubscriptions, self).setUp()
+        # The topology is restored already
+        self.client.channel._replaying = False
+
+    @testing.gen_test
+    def test_unsubscribe(self):
+        self.client.subscribe('news', lambda message: None)
+        self.client.subscribe('sports', lambda message: None)
+        yield sleep(0)
+
+        yield self.client.unsubscribe('news')
+
+        binding = (self.client._pubsub_queue, 'crew.PUBSUB', {'x-channel-name': 'sports'})
+        self.assertEqual(self.channel.bindings, [binding])
+        self.assertEqual(list(self.client._subscribe_cache), ['sports'])
+        # It isn't bound again after a reconnect
+        self.assertEqual(len(self.client.channel.topology.bindings), 1)
+
+    @testing.gen_test
+    def test_unsubscribe_while_disconnected(self):
+        self.client.subscribe('news', lambda message: None)
+        self.channel.is_open = False
+
+        yield self.client.unsubscribe('news')
+
+        self.assertEqual(self.client._subscribe_cache, {})
+        self.assertEqual(len(self.client.channel.topology.bindings), 0)
@@ -0,0 +1,63 @@
+# encoding: utf-8
+import sys
+import unittest
+import warnings
+
+from crew import codecs
+from crew.master.threaded_client import Client as ThreadedClient
+from crew.master.tornado.client import Client
+from crew.worker.pubsub import PubSub
+
+
+class TestCodecs(unittest.TestCase):
+    PAYLOADS = {
+        'pickle': {'list': [1, 2.5, None], 'tuple': (1, 'a')},
+        'json': {'list': [1, 2.5, None], 'text': u'Привет'},
+        'text': u'Wake up Neo.',
+        'marshal': {'list': [1, 2.5, None], 'bytes': b'\x00\xff'},
+        'binary': b'\x00\xff' * 16,
+    }
+
+    def test_round_trip(self):
+        for name, payload in self.PAYLOADS.items():
+            for encoding in ('plain', 'gzip', 'bz2'):
+                serializer = codecs.get(name, encoding)
+                data = serializer.dumps(payload)
+                loaded = codecs.resolve(serializer.content_type, serializer.content_encoding).loads(data)
+                self.assertEqual(bytes(loaded) if name == 'binary' else loaded, payload, (name, encoding))
+
+    def test_binary_refuses_objects(self):
+        self.assertRaises(TypeError, codecs.get('binary').dumps, u'text')
+
+    def test_unknown(self):
+        self.assertRaises(LookupError, codecs.get, 'unknown')
+        self.assertRaises(LookupError, codecs.registry.compressor, 'unknown')
+        # Unknown content types are treated as text
+        self.assertEqual(codecs.resolve('application/x-unknown').loads(b'text'), u'text')
+
+    def test_compressor_by_algorithm(self):
+        self.assertIs(codecs.registry.compressor('zlib'), codecs.registry.compressor('gzip'))
+
+    def test_deprecated_aliases(self):
+        for cls in (Client, ThreadedClient, PubSub):
+            self.assertEqual(cls.SERIALIZERS['json'], 'application/json')
+            self.assertIn('pickle', cls.SERIALIZERS)
+
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                dumps, content_type = cls.get_serializer('json')
+
+            self.assertEqual(caught[0].category, DeprecationWarning)
+            self.assertEqual(content_type, 'application/json')
+            self.assertEqual(codecs.get('json').loads(dumps([1])), [1])
+
+    @unittest.skipIf(sys.version_info < (3, 8), 'Pickle protocol 5 requires Python 3.8')
+    def test_pickle5_buffers(self):
+        import pickle
+
+        payload = {'buffer': pickle.PickleBuffer(bytearray(b'x' * 1024)), 'value': 1}
+        serializer = codecs.get('pickle5')
+        loaded = serializer.loads(serializer.dumps(payload))
+
+        self.assertEqual(loaded['value'], 1)
+        self.assertEqual(bytes(loaded['buffer']), b'x' * 1024)
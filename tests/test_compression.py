@@ -0,0 +1,46 @@
+# encoding: utf-8
+import os
+import unittest
+
+from crew import codecs
+from crew.compression import CompressionPolicy
+
+
+class TestCompressionPolicy(unittest.TestCase):
+    def test_round_trip(self):
+        data = b'compressible ' * 1024
+
+        for algorithm in ('zlib', 'bz2', 'lzma'):
+            if algorithm == 'lzma' and codecs.lzma is None:
+                continue
+
+            policy = CompressionPolicy(algorithm, threshold=0)
+            compressed, encoding = policy.compress(data)
+
+            self.assertEqual(encoding, policy.encoding)
+            self.assertLess(len(compressed), len(data))
+            self.assertEqual(codecs.registry.compressor(encoding).decompress(compressed), data)
+
+    def test_threshold(self):
+        policy = CompressionPolicy(threshold=1024)
+        self.assertEqual(policy.compress(b'x' * 100), (b'x' * 100, 'plain'))
+
+    def test_incompressible_are_sampled(self):
+        policy = CompressionPolicy(threshold=0, sample_every=4)
+        for _ in range(16):
+            data = os.urandom(1024)
+            self.assertEqual(policy.compress(data), (data, 'plain'))
+
+        self.assertFalse(policy.paying_off())
+        self.assertEqual(policy.stats['compressed'], 0)
+        self.assertEqual(policy.stats['skipped'], 16)
+
+    def test_force(self):
+        policy = CompressionPolicy(threshold=0, force=True)
+        for _ in range(16):
+            data = os.urandom(1024)
+            compressed, encoding = policy.compress(data)
+            self.assertEqual(encoding, 'gzip')
+            self.assertEqual(codecs.registry.compressor(encoding).decompress(compressed), data)
+
+        self.assertEqual(policy.stats['compressed'], 16)
@@ -11,3 +11,9 @@ class TestHttp(TestBaseHandler):
         response = yield self.client('/')
 
         self.assertEqual(response.body, 'str: Wake up Neo.\n')
+
+    @gen_test
+    def test_batch(self):
+        response = yield self.client('/batch')
+
+        self.assertEqual(response.body, '2, 4, 6')
@@ -0,0 +1,101 @@
+# encoding: utf-8
+import random
+
+from tornado import testing
+from tornado.ioloop import IOLoop
+
+from crew.master.tornado.multitask import Map, MultitaskCall
+
+
+class FakeClient(object):
+    """ Replies with the doubled payload after a random delay, fails the payload 3 """
+
+    def __init__(self):
+        self.callbacks_hash = {}
+        self.calls = 0
+        self.max_inflight = 0
+
+    def call(self, channel, data=None, callback=None, set_cid=None, **kwargs):
+        self.callbacks_hash[set_cid] = callback
+        self.calls += 1
+        self.max_inflight = max(self.max_inflight, len(self.callbacks_hash))
+
+        def reply():
+            callback = self.callbacks_hash.pop(set_cid, None)
+            if callback is not None:
+                callback(ValueError(data) if data == 3 else data * 2, headers={})
+
+        IOLoop.current().call_later(random.random() * 0.01, reply)
+
+
+def infinite():
+    index = 0
+    while True:
+        yield index
+        index += 1
+
+
+class TestMap(testing.AsyncTestCase):
+    def setUp(self):
+        super(TestMap, self).setUp()
+        self.client = FakeClient()
+
+    @testing.gen_test
+    def test_concurrency_bound(self):
+        results = []
+        mapping = Map(self.client, 'test', range(200), concurrency=10)
+
+        while not mapping.finished:
+            results.append((yield mapping.next()))
+
+        self.assertEqual(len(results), 200)
+        self.assertEqual(self.client.max_inflight, 10)
+
+    @testing.gen_test
+    def test_ordered(self):
+        mapping = Map(self.client, 'test', range(20), concurrency=5, ordered=True)
+        results = []
+
+        while not mapping.finished:
+            results.append((yield mapping.next()))
+
+        self.assertIsInstance(results[3], ValueError)
+        self.assertEqual(results[:3] + results[4:], [i * 2 for i in range(20) if i != 3])
+
+    @testing.gen_test
+    def test_gather_keeps_the_order_after_next(self):
+        mapping = Map(self.client, 'test', range(30), concurrency=5)
+        first = yield mapping.next()
+        rest = yield mapping.gather()
+
+        self.assertEqual(len(rest), 29)
+        self.assertNotIn(first, rest)
+        values = [result for result in rest if not isinstance(result, ValueError)]
+        self.assertEqual(values, sorted(values))
+
+    @testing.gen_test
+    def test_first(self):
+        results = yield Map(self.client, 'test', infinite(), concurrency=8).first(5)
+
+        self.assertEqual(len(results), 5)
+        # The rest of the calls are abandoned
+        self.assertEqual(self.client.callbacks_hash, {})
+        self.assertLessEqual(self.client.calls, 13)
+
+    @testing.gen_test
+    def test_empty(self):
+        self.assertEqual((yield Map(self.client, 'test', []).gather()), [])
+
+
+class TestMultitaskCall(testing.AsyncTestCase):
+    @testing.gen_test
+    def test_results_in_order(self):
+        client = FakeClient()
+
+        with MultitaskCall(client) as mc:
+            for i in range(5):
+                mc.call('test', data=i)
+            results = yield mc.result()
+
+        self.assertEqual(results[:3] + results[4:], [0, 2, 4, 8])
+        self.assertIsInstance(results[3], ValueError)
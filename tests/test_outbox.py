@@ -0,0 +1,141 @@
+# encoding: utf-8
+import shutil
+import tempfile
+import time
+import unittest
+
+import pika
+from tornado import testing
+from tornado.concurrent import Future
+
+from crew.exceptions import ExpirationError, PublishError
+from crew.outbox import Journal, Outbox
+
+
+def message(body=b'body', expiration=None):
+    return dict(
+        exchange='', routing_key='test', body=body,
+        properties=pika.BasicProperties(expiration=expiration),
+    )
+
+
+def drain(outbox):
+    items = []
+    while True:
+        try:
+            items.append(outbox.popleft())
+        except IndexError:
+            return items
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.journal = Journal(self.path)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.path)
+
+    def test_round_trip(self):
+        records = [{'body': b'x' * i, 'index': i} for i in range(100)]
+        for record in records:
+            self.journal.append(record)
+
+        self.assertEqual([self.journal.popleft() for _ in records], records)
+        self.assertEqual(len(self.journal), 0)
+        self.assertRaises(IndexError, self.journal.popleft)
+
+    def test_grows(self):
+        self.journal.append(b'x' * (Journal.CHUNK + 1))
+        self.assertEqual(len(self.journal.popleft()), Journal.CHUNK + 1)
+
+
+class TestOutbox(testing.AsyncTestCase):
+    def setUp(self):
+        super(TestOutbox, self).setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(TestOutbox, self).tearDown()
+
+    def test_order(self):
+        outbox = Outbox()
+        futures = [Future() for _ in range(3)]
+        for index, future in enumerate(futures):
+            outbox.append(future, message(str(index).encode()))
+
+        items = drain(outbox)
+        self.assertEqual([future for future, _ in items], futures)
+        self.assertEqual([kwargs['body'] for _, kwargs in items], [b'0', b'1', b'2'])
+
+    def test_reject(self):
+        outbox = Outbox(maxsize=2, policy='reject')
+        futures = [Future() for _ in range(3)]
+        results = [outbox.append(future, message()) for future in futures]
+
+        self.assertEqual(results, [True, True, False])
+        self.assertFalse(futures[0].done())
+        self.assertIsInstance(futures[2].exception(), PublishError)
+        self.assertEqual(len(outbox), 2)
+        self.assertEqual(outbox.stats['rejected'], 1)
+
+    def test_reject_by_bytes(self):
+        outbox = Outbox(max_bytes=8, policy='reject')
+
+        self.assertTrue(outbox.append(None, message(b'x' * 6)))
+        self.assertFalse(outbox.append(None, message(b'x' * 6)))
+        # A single message is never rejected
+        self.assertTrue(Outbox(max_bytes=8).append(None, message(b'x' * 16)))
+
+    def test_drop(self):
+        outbox = Outbox(maxsize=2, policy='drop')
+        futures = [Future() for _ in range(3)]
+        for index, future in enumerate(futures):
+            outbox.append(future, message(str(index).encode()))
+
+        self.assertIsInstance(futures[0].exception(), PublishError)
+        self.assertEqual([kwargs['body'] for _, kwargs in drain(outbox)], [b'1', b'2'])
+        self.assertEqual(outbox.stats['dropped'], 1)
+
+    def test_spill(self):
+        outbox = Outbox(maxsize=2, policy='spill', path=self.path)
+        futures = [Future() for _ in range(5)]
+        for index, future in enumerate(futures):
+            self.assertTrue(outbox.append(future, message(str(index).encode())))
+
+        self.assertEqual(len(outbox), 5)
+        self.assertEqual(outbox.stats['spilled'], 3)
+
+        items = drain(outbox)
+        self.assertEqual([future for future, _ in items], futures)
+        self.assertEqual([kwargs['body'] for _, kwargs in items], [b'0', b'1', b'2', b'3', b'4'])
+        self.assertTrue(all(not future.done() for future in futures))
+        outbox.close()
+
+    def test_spill_keeps_the_order(self):
+        outbox = Outbox(maxsize=1, policy='spill', path=self.path)
+        outbox.append(None, message(b'0'))
+        outbox.append(None, message(b'1'))
+        outbox.popleft()
+        # The journal isn't drained yet, the new message goes after it
+        outbox.append(None, message(b'2'))
+
+        self.assertEqual([kwargs['body'] for _, kwargs in drain(outbox)], [b'1', b'2'])
+        outbox.close()
+
+    def test_expired_are_dropped(self):
+        outbox = Outbox(maxsize=2, policy='spill', path=self.path)
+        futures = [Future() for _ in range(4)]
+        outbox.append(futures[0], message(b'0', expiration='100'))
+        outbox.append(futures[1], message(b'1'))
+        outbox.append(futures[2], message(b'2', expiration='100'))
+        outbox.append(futures[3], message(b'3', expiration='60000'))
+        time.sleep(0.2)
+
+        self.assertEqual([kwargs['body'] for _, kwargs in drain(outbox)], [b'1', b'3'])
+        self.assertIsInstance(futures[0].exception(), ExpirationError)
+        self.assertIsInstance(futures[2].exception(), ExpirationError)
+        self.assertEqual(outbox.stats['expired'], 2)
+        outbox.close()
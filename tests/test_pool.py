@@ -0,0 +1,119 @@
+# encoding: utf-8
+import sys
+import threading
+import time
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from crew.exceptions import TimeoutError
+from crew.timer import Timer
+from crew.worker.pool import ThreadPool
+
+
+class Results(object):
+    def __init__(self):
+        self.values = []
+        self.event = threading.Event()
+
+    def __call__(self, result):
+        self.values.append(result)
+        self.event.set()
+
+    def wait(self, timeout=5):
+        assert self.event.wait(timeout), 'No result in {0} seconds'.format(timeout)
+        self.event.clear()
+        return self.values[-1]
+
+
+def sleeper(seconds):
+    def func():
+        # Short sleeps let the thread be killed in between
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            time.sleep(0.01)
+        return seconds
+    return func
+
+
+class TestThreadPool(unittest.TestCase):
+    def setUp(self):
+        self.timer = Timer()
+        self.pool = ThreadPool(2, timer=self.timer)
+
+    def tearDown(self):
+        self.pool.close()
+        self.timer.close()
+
+    def test_result(self):
+        results = Results()
+        self.pool.submit(lambda: 42, results)
+
+        self.assertEqual(results.wait(), 42)
+        self.assertEqual(self.pool.stats['processed'], 1)
+
+    def test_exception_is_the_result(self):
+        results = Results()
+        self.pool.submit(lambda: 1 / 0, results)
+
+        self.assertIsInstance(results.wait(), ZeroDivisionError)
+
+    def test_timeout(self):
+        results = Results()
+        self.pool.submit(sleeper(10), results, deadline=time.time() + 0.2)
+
+        self.assertIsInstance(results.wait(), TimeoutError)
+        self.assertEqual(self.pool.stats['timeouts'], 1)
+
+    def test_timeout_replaces_the_thread(self):
+        results = Results()
+        self.pool.submit(sleeper(10), results, deadline=time.time() + 0.2)
+        results.wait()
+
+        self.assertEqual(self.pool.stats['threads'], 1)
+
+        self.pool.submit(lambda: 'ok', results)
+        self.assertEqual(results.wait(), 'ok')
+        self.assertEqual(self.pool.stats['threads'], 2)
+        self.assertEqual(self.pool.stats['replaced'], 1)
+
+    def test_timeout_is_quiet(self):
+        results = Results()
+        errors = []
+        stderr, sys.stderr = sys.stderr, StringIO()
+        # Not available before Python 3.8, the traceback goes to stderr there
+        excepthook = getattr(threading, 'excepthook', None)
+        if excepthook is not None:
+            threading.excepthook = errors.append
+
+        try:
+            for _ in range(2):
+                self.pool.submit(sleeper(10), results, deadline=time.time() + 0.2)
+                self.assertIsInstance(results.wait(), TimeoutError)
+                # The killed thread notices the exception between the sleeps
+                time.sleep(0.1)
+
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+            if excepthook is not None:
+                threading.excepthook = excepthook
+
+        self.assertEqual(output, '')
+        self.assertEqual(errors, [])
+        self.assertEqual(self.pool.stats['timeouts'], 2)
+        self.assertEqual(self.pool.stats['replaced'], 1)
+
+    def test_finished_job_does_not_expire(self):
+        results = Results()
+        self.pool.submit(lambda: 'fast', results, deadline=time.time() + 0.2)
+
+        self.assertEqual(results.wait(), 'fast')
+        time.sleep(0.4)
+
+        self.assertEqual(results.values, ['fast'])
+        self.assertEqual(self.pool.stats['timeouts'], 0)
+        self.assertEqual(len(self.timer), 0)
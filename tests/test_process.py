@@ -0,0 +1,84 @@
+# encoding: utf-8
+import threading
+import time
+import unittest
+
+import pika
+
+from crew.exceptions import TimeoutError
+from crew.timer import Timer
+from crew.worker.context import context
+from crew.worker.listener import Delivery
+from crew.worker.process import ProcessPool, Serialized
+
+
+def double(value):
+    return value * 2
+
+
+def hang(value):
+    time.sleep(60)
+
+
+context.handlers['crew.tests.process.double'] = double
+context.handlers['crew.tests.process.hang'] = hang
+
+
+class Method(object):
+    def __init__(self, routing_key):
+        self.delivery_tag = 1
+        self.routing_key = routing_key
+
+
+class Results(object):
+    def __init__(self):
+        self.values = []
+        self.event = threading.Event()
+
+    def __call__(self, result):
+        self.values.append(result)
+        self.event.set()
+
+    def wait(self, timeout=10):
+        assert self.event.wait(timeout), 'No result in {0} seconds'.format(timeout)
+        self.event.clear()
+        return self.values[-1]
+
+
+def delivery(task, body):
+    props = pika.BasicProperties(content_type='application/json', headers={})
+    return Delivery(Method('crew.tests.process.' + task), props, body)
+
+
+class TestProcessPool(unittest.TestCase):
+    def setUp(self):
+        self.timer = Timer()
+        self.pool = ProcessPool(1, timer=self.timer)
+
+    def tearDown(self):
+        self.pool.close()
+        self.timer.close()
+
+    def test_result(self):
+        results = Results()
+        self.pool.submit(delivery('double', b'21'), results)
+
+        result = results.wait()
+        self.assertIsInstance(result, Serialized)
+        self.assertEqual(result.body, b'42')
+
+    def test_timeout_frees_the_process(self):
+        results = Results()
+
+        for _ in range(2):
+            self.pool.submit(delivery('hang', b'1'), results, deadline=time.time() + 0.5)
+            self.assertIsInstance(results.wait(), TimeoutError)
+
+        # The only process would be busy for a minute without the replacement
+        self.pool.submit(delivery('double', b'21'), results, deadline=time.time() + 10)
+        self.assertEqual(results.wait().body, b'42')
+
+        stats = self.pool.stats
+        self.assertEqual(stats['timeouts'], 2)
+        self.assertEqual(stats['replaced'], 2)
+        self.assertEqual(stats['processed'], 1)
@@ -0,0 +1,127 @@
+# encoding: utf-8
+import pika
+from tornado import testing
+
+from crew import codecs
+from crew.compression import CompressionPolicy
+from crew.master.tornado.client import Client
+from crew.master.tornado.stream import Stream, StopAsyncIteration
+from crew.worker.listener import Delivery, Listener
+
+
+class OfflineClient(Client):
+    def connect(self):
+        pass
+
+
+class Channel(object):
+    """ Channel recording the published and acknowledged messages """
+
+    def __init__(self):
+        self.is_open = True
+        self.published = []
+        self.acked = []
+
+    def basic_publish(self, **kwargs):
+        self.published.append(kwargs)
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def close(self):
+        self.is_open = False
+
+
+class Method(object):
+    def __init__(self, delivery_tag, routing_key='crew.tasks.test'):
+        self.delivery_tag = delivery_tag
+        self.routing_key = routing_key
+
+
+def listener():
+    # Only the replying part of the listener, without the connection
+    listener = Listener.__new__(Listener)
+    listener.channel = Channel()
+    listener.compression = CompressionPolicy()
+    listener.blob_store = None
+    return listener
+
+
+def delivery(content_type):
+    props = pika.BasicProperties(
+        correlation_id='test.cid', reply_to='crew.stream.test.cid', content_type=content_type, headers={}
+    )
+    return Delivery(Method(1), props, b'')
+
+
+class TestStream(testing.AsyncTestCase):
+    def setUp(self):
+        super(TestStream, self).setUp()
+        self.client = OfflineClient(credentials=pika.PlainCredentials('guest', 'guest'))
+        self.stream = Stream(self.client, 'test.cid')
+        self.stream.channel = Channel()
+
+    def feed(self, messages):
+        for tag, kwargs in enumerate(messages, 100):
+            self.stream._on_message(self.stream.channel, Method(tag), kwargs['properties'], kwargs['body'])
+
+    @testing.gen_test
+    def test_binary_stream(self):
+        worker = listener()
+        request = delivery(codecs.BinaryCodec.content_type)
+        worker.stream(request, iter([]))
+
+        for item in (b'first', b'second'):
+            worker.send_chunk(request, item)
+        worker.finish(request, None)
+
+        end = worker.channel.published[-1]
+        self.assertEqual(end['body'], b'')
+        self.assertTrue(end['properties'].headers['x-stream-end'])
+        self.assertEqual(end['properties'].headers['x-stream-seq'], 2)
+
+        self.feed(worker.channel.published)
+        items = []
+        while True:
+            try:
+                items.append(bytes((yield self.stream.next())))
+            except StopAsyncIteration:
+                break
+
+        self.assertEqual(items, [b'first', b'second'])
+        self.assertFalse(self.stream.channel.is_open)
+
+    @testing.gen_test
+    def test_error_ends_the_stream(self):
+        worker = listener()
+        request = delivery(codecs.BinaryCodec.content_type)
+        worker.stream(request, iter([]))
+
+        worker.send_chunk(request, b'first')
+        worker.finish(request, ValueError('broken'))
+
+        self.feed(worker.channel.published)
+        self.assertEqual((yield self.stream.next()), b'first')
+
+        with self.assertRaises(ValueError):
+            yield self.stream.next()
+
+    @testing.gen_test
+    def test_ack_on_take(self):
+        worker = listener()
+        request = delivery(codecs.JSONCodec.content_type)
+        worker.stream(request, iter([]))
+
+        for item in range(3):
+            worker.send_chunk(request, item)
+
+        self.feed(worker.channel.published)
+        self.assertEqual(self.stream.channel.acked, [])
+
+        self.assertEqual((yield self.stream.next()), 0)
+        self.assertEqual(self.stream.channel.acked, [100])
+
+        self.assertEqual((yield self.stream.next()), 1)
+        self.assertEqual((yield self.stream.next()), 2)
+        self.assertEqual(self.stream.channel.acked, [100, 101, 102])
+        self.assertFalse(self.stream.finished)
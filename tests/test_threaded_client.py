@@ -0,0 +1,201 @@
+# encoding: utf-8
+import itertools
+import threading
+import time
+import unittest
+from collections import deque
+
+from crew.compression import CompressionPolicy
+from crew.exceptions import TimeoutError
+from crew.master.threaded_client import Client, Connection, Result, as_completed, wait_all
+from crew.timer import Timer
+
+
+def resolve_later(result, value, delay):
+    timer = threading.Timer(delay, result.set_result, (value,))
+    timer.start()
+    return timer
+
+
+class TestResult(unittest.TestCase):
+    def test_wait(self):
+        result = Result()
+        resolve_later(result, 42, 0.05)
+
+        self.assertEqual(result.wait(5), 42)
+        self.assertTrue(result.done())
+
+    def test_exception(self):
+        result = Result()
+        result.set_exception(ValueError('failed'))
+
+        self.assertRaises(ValueError, result.wait, 1)
+
+    def test_timeout(self):
+        self.assertRaises(TimeoutError, Result().wait, 0.05)
+
+    def test_set_once(self):
+        result = Result()
+        result.set_result(1)
+
+        self.assertRaises(AssertionError, result.set_result, 2)
+        self.assertEqual(result.wait(0), 1)
+
+    def test_done_callback(self):
+        called = []
+        result = Result()
+        result.add_done_callback(called.append)
+        result.set_result(1, headers={'x-header': 'value'})
+        # Called at once when it's set already
+        result.add_done_callback(called.append)
+
+        self.assertEqual(called, [result, result])
+        self.assertEqual(result.headers, {'x-header': 'value'})
+
+
+class TestWait(unittest.TestCase):
+    def test_wait_all(self):
+        results = [Result() for _ in range(3)]
+        for index, result in enumerate(results):
+            resolve_later(result, index, 0.01 * index)
+
+        done, pending = wait_all(results, timeout=5)
+
+        self.assertEqual(len(done), 3)
+        self.assertEqual(pending, [])
+        self.assertEqual([result.wait(0) for result in done], [0, 1, 2])
+
+    def test_wait_all_timeout(self):
+        results = [Result(), Result()]
+        results[0].set_result(1)
+
+        start = time.time()
+        done, pending = wait_all(results, timeout=0.1)
+
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertEqual(done, results[:1])
+        self.assertEqual(pending, results[1:])
+
+    def test_wait_all_empty(self):
+        self.assertEqual(wait_all([]), ([], []))
+
+    def test_as_completed(self):
+        results = [Result() for _ in range(3)]
+        for result, delay in zip(results, (0.15, 0.01, 0.08)):
+            resolve_later(result, delay, delay)
+
+        order = [result.wait(0) for result in as_completed(results, timeout=5)]
+        self.assertEqual(order, [0.01, 0.08, 0.15])
+
+    def test_as_completed_timeout(self):
+        results = [Result(), Result()]
+        results[0].set_result(1)
+        completed = as_completed(results, timeout=0.1)
+
+        self.assertIs(next(completed), results[0])
+        self.assertRaises(TimeoutError, next, completed)
+
+
+class PikaConnection(object):
+    """ Runs the callbacks of the other threads at once, or refuses them while it's down """
+
+    def __init__(self):
+        self.is_down = False
+
+    def add_callback_threadsafe(self, callback):
+        if self.is_down:
+            raise RuntimeError('Connection is closed')
+        callback()
+
+
+class Channel(object):
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.published = []
+
+    def basic_publish(self, **kwargs):
+        if kwargs['body'] == self.fail_on:
+            self.fail_on = None
+            raise RuntimeError('Channel is closed')
+        self.published.append(kwargs['body'])
+
+
+def connection(name='queue'):
+    # The pool connection without its broker connection and I/O thread
+    connection = Connection.__new__(Connection)
+    connection.res_queue = name
+    connection.connection = PikaConnection()
+    connection.channel = Channel()
+    connection.published = 0
+    connection._outbox = deque()
+    return connection
+
+
+class TestConnection(unittest.TestCase):
+    def test_publish(self):
+        conn = connection()
+        conn.publish(body=b'1')
+        conn.publish(body=b'2')
+
+        self.assertEqual(conn.channel.published, [b'1', b'2'])
+        self.assertEqual(conn.stats['published'], 2)
+        self.assertEqual(conn.stats['outbox'], 0)
+
+    def test_deferred_while_down(self):
+        conn = connection()
+        conn.connection.is_down = True
+        conn.publish(body=b'1')
+        conn.publish(body=b'2')
+
+        self.assertEqual(conn.channel.published, [])
+        self.assertEqual(conn.stats['outbox'], 2)
+
+        # Flushed by the I/O thread once it's connected again
+        conn.connection.is_down = False
+        conn._flush()
+        self.assertEqual(conn.channel.published, [b'1', b'2'])
+
+    def test_failed_message_stays_first(self):
+        conn = connection()
+        conn.channel = Channel(fail_on=b'2')
+        conn._outbox.extend([dict(body=b'1'), dict(body=b'2'), dict(body=b'3')])
+
+        self.assertRaises(RuntimeError, conn._flush)
+        conn._flush()
+
+        self.assertEqual(conn.channel.published, [b'1', b'2', b'3'])
+
+
+class TestPool(unittest.TestCase):
+    def setUp(self):
+        # The client without the broker connections
+        self.client = Client.__new__(Client)
+        self.client.callbacks_hash = {}
+        self.client.compression = CompressionPolicy()
+        self.client._compression = {}
+        self.client.blob_store = None
+        self.client.cache = None
+        self.client._cache_keys = {}
+        self.client.connections = [connection('first'), connection('second')]
+        self.client._next = itertools.count()
+        self.client._timer = Timer()
+
+    def tearDown(self):
+        self.client._timer.close()
+
+    def test_calls_are_spread(self):
+        results = [self.client.call('test', index) for index in range(4)]
+
+        self.assertEqual([conn.published for conn in self.client.connections], [2, 2])
+        self.assertEqual(self.client.stats['pending'], 4)
+        self.assertTrue(all(isinstance(result, Result) for result in results))
+
+    def test_calls_from_threads(self):
+        threads = [threading.Thread(target=self.client.call, args=('test', index)) for index in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sum(conn.published for conn in self.client.connections), 50)
+        self.assertEqual(len(self.client.callbacks_hash), 50)
@@ -0,0 +1,98 @@
+# encoding: utf-8
+import time
+
+import pika
+from tornado import testing
+from tornado.concurrent import Future
+
+from crew.exceptions import TimeoutError
+from crew.master.tornado.client import Client
+from crew.worker.upload import Upload
+
+
+class OfflineClient(Client):
+    def connect(self):
+        pass
+
+
+class Publisher(object):
+    """ Adapter recording the published messages """
+
+    def __init__(self):
+        self.messages = []
+
+    def basic_publish(self, **kwargs):
+        self.messages.append(kwargs)
+        future = Future()
+        future.set_result(True)
+        return future
+
+
+class Method(object):
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class Listener(object):
+    def __init__(self):
+        self.channel = self
+        self.acked = []
+
+    def threadsafe(self, func, *args):
+        func(*args)
+
+    def basic_ack(self, tag):
+        self.acked.append(tag)
+
+
+def chunks(*items):
+    for item in items:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+class TestUpload(testing.AsyncTestCase):
+    def setUp(self):
+        super(TestUpload, self).setUp()
+        self.client = OfflineClient(credentials=pika.PlainCredentials('guest', 'guest'))
+        self.client.channel = Publisher()
+        self.listener = Listener()
+
+    def upload(self, timeout=5):
+        upload = Upload(self.listener, 'queue', time.time() + timeout)
+        for tag, kwargs in enumerate(self.client.channel.messages, 1):
+            upload.on_chunk(None, Method(tag), kwargs['properties'], kwargs['body'])
+        return upload
+
+    @testing.gen_test
+    def test_binary(self):
+        yield self.client._upload('test', 'queue', chunks(b'first', b'second'), 'binary', 60)
+
+        end = self.client.channel.messages[-1]
+        self.assertEqual(end['body'], b'')
+        self.assertTrue(end['properties'].headers['x-upload-end'])
+
+        upload = self.upload()
+        self.assertEqual([bytes(chunk) for chunk in upload], [b'first', b'second'])
+        self.assertEqual(upload.received, 2)
+        self.assertEqual(self.listener.acked, [1, 2, 3])
+        # Nothing is read after the end
+        self.assertEqual(list(upload), [])
+
+    @testing.gen_test
+    def test_error(self):
+        yield self.client._upload('test', 'queue', chunks(b'first', ValueError('broken')), 'binary', 60)
+
+        upload = self.upload()
+        self.assertEqual(next(upload), b'first')
+        self.assertRaises(ValueError, next, upload)
+
+    @testing.gen_test
+    def test_empty(self):
+        yield self.client._upload('test', 'queue', chunks(), 'json', 60)
+        self.assertEqual(list(self.upload()), [])
+
+    def test_deadline(self):
+        upload = Upload(self.listener, 'queue', time.time() + 0.1)
+        self.assertRaises(TimeoutError, next, upload)